@@ -0,0 +1,99 @@
+import numpy as np
+
+from common.entity import DataFrame, UniformGrid, BrickGrid, GRID_KEYS
+from common.method import encode_log
+
+
+# imaging的稀疏分块存储：三维网格按brick_size^3划分为块，只保存含有大于阈值的体素的块，以及每个块是否保存的占用表
+# 阈值与区域检测的阈值相同，区域中的体素都位于保存的块中，因此按区域裁剪的结果与原始数据完全一致；
+# 空块中不大于阈值的体素读取时统一取网格的最小值
+BRICK_SIZES = (8, 16)
+BRICK_THRESHOLD = 1e-6
+
+
+# 将三维网格转换为分块存储，量化存储的网格按编码比较阈值；非三维网格以及分块后不能减少存储的网格直接返回
+def to_bricks(grid: UniformGrid, brick_size: int = 8, threshold: float = BRICK_THRESHOLD):
+    if grid.dim != 3 or grid.data.size == 0:
+        return grid
+    data = np.asarray(grid.data)
+    fill = data.min()
+    counts = [-(-n // brick_size) for n in data.shape]
+    pad = [(0, count * brick_size - n) for count, n in zip(counts, data.shape)]
+    if any(p for _, p in pad):
+        data = np.pad(data, pad, constant_values=fill)
+    blocks = data.reshape(counts[0], brick_size, counts[1], brick_size, counts[2], brick_size) \
+        .transpose(0, 2, 4, 1, 3, 5)
+    maxima = blocks.max(axis=(3, 4, 5))
+    if grid.codec is None:
+        occupancy = maxima > threshold
+    else:
+        occupancy = maxima >= encode_log(np.array([threshold]), grid.codec)[0]
+
+    if occupancy.sum() * brick_size ** 3 * data.itemsize + (occupancy.size + 7) // 8 >= grid.data.nbytes:
+        return grid
+
+    bricked = BrickGrid()
+    bricked.shape = tuple(grid.data.shape)
+    bricked.brick_size = brick_size
+    bricked.occupancy = occupancy
+    bricked.bricks = blocks[occupancy]
+    bricked.fill = fill.item()
+    bricked.bounds = grid.bounds
+    bricked.spacing = grid.spacing
+    bricked.dim = grid.dim
+    bricked.codec = grid.codec
+    return bricked
+
+
+# 分块存储的网格转换为普通网格，普通网格直接返回
+def densify(grid) -> UniformGrid:
+    if not isinstance(grid, BrickGrid):
+        return grid
+    dense = UniformGrid()
+    dense.data = grid.read_box((0, 0, 0), grid.shape)
+    dense.bounds = grid.bounds
+    dense.spacing = grid.spacing
+    dense.dim = grid.dim
+    dense.codec = grid.codec
+    return dense
+
+
+# 将数据帧中分块存储的网格原地转换为普通网格
+def densify_frame(frame: DataFrame) -> DataFrame:
+    for key in GRID_KEYS:
+        setattr(frame, key, densify(getattr(frame, key)))
+    return frame
+
+
+# 分块存储的数据帧，imaging转换为分块存储，其余网格不变，传入的数据帧不变
+def brick_frame(frame: DataFrame, brick_size: int = 8, threshold: float = BRICK_THRESHOLD) -> DataFrame:
+    bricked = DataFrame()
+    bricked.id = frame.id
+    bricked.time_str = frame.time_str
+    for key in GRID_KEYS:
+        setattr(bricked, key, getattr(frame, key))
+    bricked.imaging = to_bricks(frame.imaging, brick_size, threshold)
+    return bricked
+
+
+# 保存的块的体素范围，返回(块数, 6)的数组，每行为[x0, x1, y0, y1, z0, z1](体素序号，包含两端，限制在网格范围内)
+def brick_bounds(grid: BrickGrid) -> np.ndarray:
+    lower = np.argwhere(grid.occupancy) * grid.brick_size
+    upper = np.minimum(lower + grid.brick_size, grid.shape) - 1
+    return np.stack([lower[:, 0], upper[:, 0], lower[:, 1], upper[:, 1], lower[:, 2], upper[:, 2]], axis=1)
+
+
+# 与体素范围[x0, x1, y0, y1, z0, z1](包含两端)相交的块：返回这些块的体素范围和数据(按块的C顺序)
+def bricks_in_bounds(grid: BrickGrid, voxel_bounds) -> tuple:
+    bounds = brick_bounds(grid)
+    inside = np.ones(len(bounds), bool)
+    for axis in range(3):
+        inside &= (bounds[:, axis * 2] <= voxel_bounds[axis * 2 + 1]) & (bounds[:, axis * 2 + 1] >= voxel_bounds[axis * 2])
+    return bounds[inside], grid.bricks[inside]
+
+
+# 网格数据占用的字节数，分块存储时为块数据和按位保存的占用表
+def grid_nbytes(grid) -> int:
+    if isinstance(grid, BrickGrid):
+        return grid.bricks.nbytes + (grid.occupancy.size + 7) // 8
+    return grid.data.nbytes
@@ -0,0 +1,233 @@
+# ============================================================
+# 多普勒数据计算速度场，热通量(不依赖vtk，可视化和预处理共用)
+# ============================================================
+
+import numpy as np
+
+from common.entity import UniformGrid
+from common import method
+from common.resample import sample_linear
+
+th = 3e-5
+lamb = 1.06
+lamb2 = lamb * lamb
+alpha = 0.1
+alpha_T = 1.32e-4
+ro_ref = 1.04e3
+Cp = 3.92e3
+g = 9.8
+
+
+# 按行归一化为单位向量，长度接近0的行保持不变
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.sqrt(np.einsum('ij,ij->i', vectors, vectors))
+    norms[norms < 10 * np.finfo(norms.dtype).eps] = 1.0
+    return vectors / norms[:, np.newaxis]
+
+
+def interpolate_sight_velocity(doppler: UniformGrid, center_line: dict):
+    doppler_data = doppler.data
+    grid_bounds = doppler.bounds
+    grid_spacing = doppler.spacing
+
+    npoints = np.array(center_line['center_points'])
+
+    i = np.array([np.floor((npoints[:, 0] - grid_bounds[0]) / grid_spacing[0]),
+                  np.ceil((npoints[:, 0] - grid_bounds[0]) / grid_spacing[0])]).astype(np.int32)
+    j = np.array([np.floor((npoints[:, 1] - grid_bounds[2]) / grid_spacing[1]),
+                  np.ceil((npoints[:, 1] - grid_bounds[2]) / grid_spacing[1])]).astype(np.int32)
+    k = np.array([np.floor((npoints[:, 2] - grid_bounds[4]) / grid_spacing[2]),
+                  np.ceil((npoints[:, 2] - grid_bounds[4]) / grid_spacing[2])]).astype(np.int32)
+    wx = np.zeros(shape=i.shape)
+    wx[1, :] = np.abs((i[0, :] * grid_spacing[0] + grid_bounds[0]) - npoints[:, 0]) / grid_spacing[0]
+    wx[0, :] = 1 - wx[1, :]
+    wy = np.zeros(shape=i.shape)
+    wy[1, :] = np.abs((j[0, :] * grid_spacing[1] + grid_bounds[2]) - npoints[:, 1]) / grid_spacing[1]
+    wy[0, :] = 1 - wy[1, :]
+    wz = np.zeros(shape=i.shape)
+    wz[1, :] = np.abs((k[0, :] * grid_spacing[2] + grid_bounds[4]) - npoints[:, 2]) / grid_spacing[2]
+    wz[0, :] = 1 - wz[1, :]
+    points_v = np.zeros(len(npoints))
+    for n in range(2):
+        for m in range(2):
+            for l in range(2):
+                w = wx[l, :] * wy[m, :] * wz[n, :]
+                points_v = points_v + doppler_data[i[l, :], j[m, :], k[n, :]] * w
+
+    center_line['sight_velocity'] = points_v
+    return
+
+
+def calculate_center_velocity(center_line: dict, origin=(0.0, 0.0, 0.0)):
+    size = center_line['size']
+    points = center_line['center_points']
+    center_velocity = np.zeros(size)
+
+    tan_vec = np.zeros((size, 3))
+    tan_vec[0] = points[1] - points[0]
+    tan_vec[-1] = points[size - 1] - points[size - 2]
+    tan_vec[1: size - 1] = ((points[1: size - 1] - points[0: size - 2]) + (points[2:] - points[1:size - 1])) / 2
+
+    sight_vec = np.array(points - origin)
+
+    unit_tan_vec = normalize_rows(tan_vec)
+    unit_sight_vec = normalize_rows(sight_vec)
+
+    center_velocity = center_line['sight_velocity'] / np.sum(unit_tan_vec * unit_sight_vec, axis=1)
+    center_line['center_velocity'] = center_velocity
+    center_line['tan_vec'] = unit_tan_vec
+    center_line['sight_vec'] = unit_sight_vec
+
+    return
+
+
+# 由中心线速度计算速度场：水平分量取中心线速度，垂直分量由视线速度反算，按z平面批量计算
+def calculate_velocity_field(doppler, center_line: dict):
+    shape = [doppler.data.shape[0], doppler.data.shape[1], doppler.data.shape[2]]
+    velocity_field = np.zeros((shape + [3]))
+    bounds = [0, doppler.data.shape[0], 0, doppler.data.shape[1], 0, doppler.data.shape[2]]
+    spacing = doppler.spacing
+
+    size = center_line['size']
+    points = center_line['center_points']
+    center_v = center_line['center_velocity']
+    center_tan_vec = center_line['tan_vec']
+
+    for k in range(size):
+        z = points[k][2]
+        zi = k + bounds[4]
+        v_vec = center_v[k] * center_tan_vec[k]
+        plane = doppler.data[:, :, zi]
+        i, j = np.nonzero(~(plane <= 1e-9))
+        vp = plane[i, j]
+        px = bounds[0] + i * spacing[0]
+        py = bounds[1] + j * spacing[1]
+        norm = np.sqrt(px * px + py * py + z * z)
+        wp = (vp - (v_vec[0] * px / norm + v_vec[1] * py / norm)) / (z / norm)
+        velocity_field[i, j, zi, 0] = v_vec[0]
+        velocity_field[i, j, zi, 1] = v_vec[1]
+        velocity_field[i, j, zi, 2] = wp
+
+    return velocity_field
+
+
+def Q_M_estimate(w_field, center_line, spacing):
+    size = center_line['size']
+    points = center_line['center_points']
+    center_v = center_line['center_velocity']
+    center_tan_vec = center_line['tan_vec']
+
+    Q = np.zeros(size)
+    M = np.zeros(size)
+
+    center_w = np.einsum('i, ij->ij', center_v, center_tan_vec)[:, 2]
+
+    for k in range(size):
+        plane_w_field = w_field[:, :, k]
+        plane_w_field[plane_w_field < (center_w[k] * 0.1)] = 0
+        Q[k] = np.sum(plane_w_field * np.power(spacing, 2)) / 0.9
+        M[k] = np.sum(np.power(plane_w_field, 2) * np.power(spacing, 2)) / 0.99
+
+    return Q, M
+
+
+def be_estimate(Q, M):
+    return Q / np.sqrt(2 * np.pi * M)
+
+
+def Zi_estimate(be):
+    return (5 * be) / (6 * alpha)
+
+
+def B0_estimate(Q, Zi):
+    return np.power(Q, 3) / ((3 * np.pi * (1 + lamb2)) / (2 * np.power(5 / (6 * alpha), 4)) * np.power(Zi, 5))
+
+
+def H0_estimate(B0):
+    return (Cp * ro_ref) / (g * alpha_T) * B0
+
+
+def get_H0(v_field, center_line, spacing):
+    w_field = v_field[:, :, :, 2]
+    Q, M = Q_M_estimate(w_field, center_line, spacing)
+    be = be_estimate(Q, M)
+    Zi = Zi_estimate(be)
+    B0 = B0_estimate(Q, Zi)
+    H0 = H0_estimate(B0)
+    return H0
+
+
+def calculate_H_field(v_field, spacing):
+    w_field = v_field[:, :, :, 2]
+    dS = np.power(spacing, 2)
+    Q_field = w_field * dS
+    # M_field = np.power(w_field, 2) * dS
+    be = 1 / np.sqrt(2 * np.pi)
+    Zi = (5 * be) / (6 * alpha)
+    B_field = B0_estimate(Q_field, Zi)
+    H_field = H0_estimate(B_field)
+    return H_field
+
+
+# centerline为预先计算的中心线(fit_centerline的结果)，为None时由image计算
+def get_velocity_field(image: UniformGrid, doppler: UniformGrid, centerline: dict = None):
+    if centerline is None:
+        centerline = method.fit_centerline(image)
+    centerline_points = centerline['points']
+
+    center_line = {
+        'center_points': np.array(centerline_points),
+        'size': len(centerline_points)
+    }
+
+    interpolate_sight_velocity(doppler, center_line)
+    calculate_center_velocity(center_line)
+    v_field = calculate_velocity_field(doppler, center_line)
+
+    return v_field, center_line
+
+
+# 计算热通量场
+def get_heat_flux_field(v_field, center_line, spacing=0.25):
+    H = get_H0(v_field, center_line, spacing)
+    H_field = calculate_H_field(v_field, spacing)
+
+    return H, H_field
+
+
+# 将doppler数据三线性插值到imaging区域的裁剪网格上，区域外的体素置为1e-9
+# doppler保持声纳的原始分辨率，与imaging网格的间距和原点可以不同，超出doppler范围的体素取边界值
+def doppler_bounds_cut(imaging_cut: UniformGrid, doppler: UniformGrid) -> UniformGrid:
+    doppler_cut = UniformGrid()
+    doppler_cut.bounds = imaging_cut.bounds.copy()
+    doppler_cut.spacing = imaging_cut.spacing.copy()
+    doppler_cut.dim = imaging_cut.dim
+    positions = []
+    for axis in range(3):
+        coords = imaging_cut.bounds[axis * 2] + np.arange(imaging_cut.data.shape[axis]) * imaging_cut.spacing[axis]
+        positions.append((coords - doppler.bounds[axis * 2]) / doppler.spacing[axis])
+    doppler_cut.data = sample_linear(doppler.data, positions)
+    doppler_cut.data[imaging_cut.data <= 1e-9] = 1e-9
+    return doppler_cut
+
+
+# 计算一个区域的doppler产品：速度场(用于速度流线)、热通量场以及每个高度的H0
+# 热通量使用换算为m的doppler数据计算，与可视化时的计算方式一致；数组保存为float32
+def doppler_products(imaging_cut: UniformGrid, doppler: UniformGrid, centerline: dict = None) -> dict:
+    if centerline is None:
+        centerline = method.fit_centerline(imaging_cut)
+    doppler_cut = doppler_bounds_cut(imaging_cut, doppler)
+    v_field, center_line = get_velocity_field(imaging_cut, doppler_cut, centerline)
+
+    # convert Doppler Data unit from cm to m
+    doppler_cut.data = doppler_cut.data * 0.01
+    v_field_m, center_line_m = get_velocity_field(imaging_cut, doppler_cut, centerline)
+    H, H_field = get_heat_flux_field(v_field_m, center_line_m)
+    return {
+        'bounds': np.asarray(doppler_cut.bounds, np.float64),
+        'spacing': np.asarray(doppler_cut.spacing, np.float64),
+        'center_points': center_line['center_points'],
+        'velocity': v_field.astype(np.float32),
+        'heat_flux': H_field.astype(np.float32),
+        'H0': H
+    }
@@ -1,6 +1,24 @@
 import numpy as np
 
 
+# 数据帧中的网格
+GRID_KEYS = ('imaging', 'doppler', 'diffuse')
+
+
+# 每帧区域统计表的一行：(帧编号, 区域编号)对应的体素数、该帧内的紧致边界[x0, x1, y0, y1, z0, z1](体素序号，包含两端)、
+# 体素质心、imaging最大值和平均值、最高点的z序号；表按帧编号、区域编号排序
+REGION_TABLE_DTYPE = np.dtype([
+    ('frame', '<i4'),
+    ('region', '<i4'),
+    ('count', '<i8'),
+    ('bounds', '<i4', (6,)),
+    ('centroid', '<f4', (3,)),
+    ('max', '<f4'),
+    ('mean', '<f4'),
+    ('top', '<i4')
+])
+
+
 class Region:
     def __init__(self):
         self.id = 0
@@ -9,6 +27,9 @@ class Region:
 
 
 class UniformGrid:
+    # 量化存储的imaging网格的编码参数(见common.method.log_codec)，未量化时为None
+    codec = None
+
     def __init__(self):
         self.data = np.array([])
         self.bounds = []
@@ -21,8 +42,55 @@ class UniformGrid:
         cp.bounds = self.bounds.copy()
         cp.spacing = self.spacing.copy()
         cp.dim = self.dim
+        cp.codec = self.codec
+        return cp
+
+
+# 稀疏分块存储的三维网格(见common.bricks)：网格按brick_size^3划分为块，只保存非空的块
+# occupancy为每个块是否保存的占用表，bricks按块的C顺序依次保存非空块，空块中的体素取值为fill
+class BrickGrid:
+    codec = None
+
+    def __init__(self):
+        self.shape = (0, 0, 0)
+        self.brick_size = 8
+        self.occupancy = np.zeros((0, 0, 0), bool)
+        self.bricks = np.zeros((0, 8, 8, 8))
+        self.fill = 0.0
+        self.bounds = []
+        self.spacing = []
+        self.dim = 3
+
+    def copy(self):
+        cp = BrickGrid()
+        cp.shape = tuple(self.shape)
+        cp.brick_size = self.brick_size
+        cp.occupancy = self.occupancy.copy()
+        cp.bricks = self.bricks.copy()
+        cp.fill = self.fill
+        cp.bounds = self.bounds.copy()
+        cp.spacing = self.spacing.copy()
+        cp.dim = self.dim
+        cp.codec = self.codec
         return cp
 
+    # 读取体素范围[lo, hi)内的数据，返回C顺序的新数组，只访问与该范围相交的块
+    def read_box(self, lo, hi) -> np.ndarray:
+        size = self.brick_size
+        first = [v // size for v in lo]
+        box = tuple(slice(f, -(-v // size)) for f, v in zip(first, hi))
+        occupancy = self.occupancy[box]
+        if occupancy.shape == self.occupancy.shape:
+            values = self.bricks
+        else:
+            ids = np.cumsum(self.occupancy.ravel()).reshape(self.occupancy.shape)[box][occupancy] - 1
+            values = self.bricks[ids]
+        counts = occupancy.shape
+        data = np.full((counts[0], size, counts[1], size, counts[2], size), self.fill, self.bricks.dtype)
+        data.transpose(0, 2, 4, 1, 3, 5)[occupancy] = values
+        data = data.reshape(counts[0] * size, counts[1] * size, counts[2] * size)
+        return np.ascontiguousarray(data[tuple(slice(v0 - f * size, v1 - f * size) for v0, v1, f in zip(lo, hi, first))])
+
 
 class DataFrame:
     def __init__(self):
@@ -0,0 +1,228 @@
+import os
+import json
+import struct
+import threading
+
+import numpy as np
+
+from common.entity import DataFrame, UniformGrid, BrickGrid
+
+
+# 数据帧打包文件格式：
+#   文件头(64字节)：magic, 版本, 帧数, 偏移表位置, 元数据位置, 元数据长度
+#   数组数据：每个网格的数据以小端字节序连续存放，起始位置按64字节对齐
+#   偏移表：(帧数, 网格数, 2)的uint64数组，记录每个网格数据的起始位置和字节数，按帧编号索引
+#   元数据：json，记录每帧的时间以及每个网格的dtype, shape, bounds, spacing, dim，量化存储的网格还记录编码参数codec
+# 分块存储的网格(版本2)：数据依次为按位保存的占用表和块数据，块数据的起始位置按64字节对齐，
+# 元数据中的dtype和shape为块数据的类型和形状，bricks记录网格形状、块大小、空块取值和块数据相对于网格数据起始位置的偏移
+PACK_MAGIC = b'PVFPACK\0'
+PACK_VERSION = 1
+BRICK_PACK_VERSION = 2
+PACK_GRID_KEYS = ('imaging', 'doppler', 'diffuse')
+HEADER_FORMAT = '<8sIIQQQ'
+HEADER_SIZE = 64
+ALIGNMENT = 64
+# 追加写入时，旧文件中不再使用的字节(被替换或删除的数据帧、旧的偏移表和元数据)超过文件大小的这一比例时先压缩文件
+PACK_COMPACT_RATIO = 0.25
+COPY_CHUNK = 64 << 20
+
+
+def to_little_endian(data: np.ndarray) -> np.ndarray:
+    data = np.ascontiguousarray(data)
+    return data.astype(data.dtype.newbyteorder('<'), copy=False)
+
+
+def grid_meta(grid: UniformGrid, data: np.ndarray) -> dict:
+    meta = {
+        'dtype': data.dtype.str,
+        'shape': list(data.shape),
+        'bounds': np.asarray(grid.bounds, np.float64).tolist(),
+        'spacing': np.asarray(grid.spacing, np.float64).tolist(),
+        'dim': int(grid.dim)
+    }
+    if grid.codec is not None:
+        meta['codec'] = grid.codec
+    return meta
+
+
+# 读取打包文件的偏移表和元数据
+def read_pack_index(file_path: str):
+    with open(file_path, 'rb') as file:
+        header = file.read(struct.calcsize(HEADER_FORMAT))
+        magic, version, frame_count, table_offset, meta_offset, meta_size = struct.unpack(HEADER_FORMAT, header)
+        if magic != PACK_MAGIC:
+            raise ValueError('not a frame pack file: ' + file_path)
+        if version not in (PACK_VERSION, BRICK_PACK_VERSION):
+            raise ValueError('unsupported frame pack version: ' + str(version))
+        file.seek(table_offset)
+        table = np.frombuffer(file.read(frame_count * len(PACK_GRID_KEYS) * 16), '<u8') \
+            .reshape(frame_count, len(PACK_GRID_KEYS), 2)
+        file.seek(meta_offset)
+        meta = json.loads(file.read(meta_size).decode('utf-8'))
+    return table, meta
+
+
+# 写入数据帧打包文件，数据帧可以按任意顺序写入，写入时加锁，可由多个线程同时调用
+# keep_ids不为空时保留已有文件中编号属于keep_ids的数据帧：通常在文件末尾追加，关闭前文件头仍指向原来的偏移表，
+# 中断时原有内容不受影响；不再使用的字节超过PACK_COMPACT_RATIO时，保留的数据帧先复制到临时文件，关闭时替换原文件
+class PackWriter:
+    def __init__(self, file_path: str, keep_ids=None):
+        self.file_path = file_path
+        self.temp_path = None
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.version = PACK_VERSION
+        if keep_ids:
+            table, meta = read_pack_index(file_path)
+            for frame_id in keep_ids:
+                self.entries[frame_id] = ([tuple(int(v) for v in entry) for entry in table[frame_id]],
+                                          meta['frames'][frame_id])
+                if any('bricks' in grid for grid in meta['frames'][frame_id]['grids'].values()):
+                    self.version = BRICK_PACK_VERSION
+            file_size = os.path.getsize(file_path)
+            live = sum(size for offsets, _ in self.entries.values() for _, size in offsets)
+            if file_size - HEADER_SIZE - live > PACK_COMPACT_RATIO * file_size:
+                self.compact()
+            else:
+                self.file = open(file_path, 'r+b')
+                self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(file_path, 'wb')
+            self.file.write(bytes(HEADER_SIZE))
+
+    # 将保留的数据帧按编号顺序复制到临时文件，之后的数据帧写入临时文件
+    def compact(self):
+        self.temp_path = self.file_path + '.tmp'
+        self.file = open(self.temp_path, 'wb')
+        self.file.write(bytes(HEADER_SIZE))
+        with open(self.file_path, 'rb') as source:
+            for frame_id in sorted(self.entries):
+                offsets, meta = self.entries[frame_id]
+                new_offsets = []
+                for offset, size in offsets:
+                    self.file.write(bytes(-self.file.tell() % ALIGNMENT))
+                    new_offsets.append((self.file.tell(), size))
+                    source.seek(offset)
+                    while size > 0:
+                        chunk = source.read(min(size, COPY_CHUNK))
+                        self.file.write(chunk)
+                        size = size - len(chunk)
+                self.entries[frame_id] = (new_offsets, meta)
+        print('compact pack file: ' + self.file_path)
+
+    # frame_id为数据帧在打包文件中的编号，默认使用frame.id
+    def write_frame(self, frame: DataFrame, frame_id: int = None):
+        if frame_id is None:
+            frame_id = frame.id
+        with self.lock:
+            offsets = []
+            grids = {}
+            for key in PACK_GRID_KEYS:
+                grid = getattr(frame, key)
+                self.file.write(bytes(-self.file.tell() % ALIGNMENT))
+                start = self.file.tell()
+                if isinstance(grid, BrickGrid):
+                    data = to_little_endian(grid.bricks)
+                    self.file.write(np.packbits(grid.occupancy.ravel()).tobytes())
+                    self.file.write(bytes(-self.file.tell() % ALIGNMENT))
+                    bricks = {'shape': [int(n) for n in grid.shape], 'size': grid.brick_size, 'fill': grid.fill,
+                              'offset': self.file.tell() - start}
+                    self.version = BRICK_PACK_VERSION
+                else:
+                    data = to_little_endian(grid.data)
+                    bricks = None
+                self.file.write(data.data if data.size > 0 else b'')
+                offsets.append((start, self.file.tell() - start))
+                grids[key] = grid_meta(grid, data)
+                if bricks is not None:
+                    grids[key]['bricks'] = bricks
+            self.entries[frame_id] = (offsets, {'time_str': frame.time_str, 'grids': grids})
+
+    def close(self):
+        with self.lock:
+            frame_count = max(self.entries, default=-1) + 1
+            if sorted(self.entries) != list(range(frame_count)):
+                raise ValueError('frame ids in pack are not contiguous: ' + self.file_path)
+
+            table = np.zeros((frame_count, len(PACK_GRID_KEYS), 2), '<u8')
+            frames_meta = []
+            for frame_id in range(frame_count):
+                offsets, meta = self.entries[frame_id]
+                table[frame_id] = offsets
+                frames_meta.append(meta)
+
+            self.file.write(bytes(-self.file.tell() % ALIGNMENT))
+            table_offset = self.file.tell()
+            self.file.write(table.tobytes())
+            meta_offset = self.file.tell()
+            meta = json.dumps({'grid_keys': PACK_GRID_KEYS, 'frames': frames_meta}).encode('utf-8')
+            self.file.write(meta)
+
+            self.file.seek(0)
+            self.file.write(struct.pack(HEADER_FORMAT, PACK_MAGIC, self.version, frame_count,
+                                        table_offset, meta_offset, len(meta)))
+            self.file.close()
+            if self.temp_path is not None:
+                os.replace(self.temp_path, self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            if self.temp_path is not None:
+                os.remove(self.temp_path)
+
+
+# 读取数据帧打包文件
+# 整个文件以写时复制(copy-on-write)方式映射到内存，读取数据帧时网格数据直接引用映射的内存，不进行拷贝，
+# 对数组的修改不会写回文件
+class PackReader:
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.table, meta = read_pack_index(file_path)
+        self.buffer = np.memmap(file_path, dtype=np.uint8, mode='c').view(np.ndarray)
+        self.grid_keys = tuple(meta['grid_keys'])
+        self.frames_meta = meta['frames']
+
+    def __len__(self) -> int:
+        return len(self.frames_meta)
+
+    def time_strs(self) -> list[str]:
+        return [meta['time_str'] for meta in self.frames_meta]
+
+    # 分块存储的网格返回BrickGrid，块数据直接引用映射的内存
+    def read_grid(self, frame_id: int, key: str):
+        offset, size = (int(v) for v in self.table[frame_id, self.grid_keys.index(key)])
+        meta = self.frames_meta[frame_id]['grids'][key]
+        bricks = meta.get('bricks')
+        if bricks is None:
+            grid = UniformGrid()
+            grid.data = self.buffer[offset:offset + size].view(meta['dtype']).reshape(meta['shape'])
+        else:
+            grid = BrickGrid()
+            grid.shape = tuple(bricks['shape'])
+            grid.brick_size = bricks['size']
+            grid.fill = bricks['fill']
+            counts = tuple(-(-n // grid.brick_size) for n in grid.shape)
+            grid.occupancy = np.unpackbits(self.buffer[offset:offset + bricks['offset']],
+                                           count=int(np.prod(counts))).reshape(counts).astype(bool)
+            grid.bricks = self.buffer[offset + bricks['offset']:offset + size].view(meta['dtype']) \
+                .reshape(meta['shape'])
+        grid.bounds = np.array(meta['bounds'])
+        grid.spacing = meta['spacing']
+        grid.dim = meta['dim']
+        grid.codec = meta.get('codec')
+        return grid
+
+    # 读取数据帧，keys指定需要读取的网格，其余网格为空
+    def read_frame(self, frame_id: int, keys=PACK_GRID_KEYS) -> DataFrame:
+        frame = DataFrame()
+        frame.id = frame_id
+        frame.time_str = self.frames_meta[frame_id]['time_str']
+        for key in keys:
+            setattr(frame, key, self.read_grid(frame_id, key))
+        return frame
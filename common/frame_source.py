@@ -0,0 +1,164 @@
+# ============================================================
+# 数据帧来源：按数据集的存储方式(joblib文件、打包文件、关键帧插值、降采样级别)逐帧读取
+# 构建时(预计算中心线和doppler产品)和可视化时共用
+# ============================================================
+
+import joblib
+from collections import OrderedDict
+
+from common.entity import DataFrame, UniformGrid, GRID_KEYS
+from common.method import blend_frame, encode_grid, decode_intensity
+from common.frame_pack import PackReader
+from common.bricks import densify_frame
+
+
+def read_frame(file_path: str) -> DataFrame:
+    with open(file_path, 'rb') as file:
+        data_file = joblib.load(file)
+        return data_file
+
+
+# 每帧一个joblib文件的数据集
+# 分块存储的imaging在dense为True时转换为普通网格，否则保持为BrickGrid，可按区域只读取相交的块
+# thread_safe表示数据来源能否被多个线程同时读取
+class JoblibFrameSource:
+    thread_safe = True
+
+    def __init__(self, file_dir: str, frame_files: list[str], dense: bool = True):
+        self.file_dir = file_dir
+        self.frame_files = frame_files
+        self.dense = dense
+
+    def __len__(self) -> int:
+        return len(self.frame_files)
+
+    def read_frame(self, frame_id: int) -> DataFrame:
+        frame = read_frame(self.file_dir + '/' + self.frame_files[frame_id])
+        return densify_frame(frame) if self.dense else frame
+
+
+# 打包格式的数据集，数据帧直接引用内存映射的数组，dense的含义与JoblibFrameSource相同
+class PackFrameSource:
+    thread_safe = True
+
+    def __init__(self, file_path: str, dense: bool = True):
+        self.pack = PackReader(file_path)
+        self.dense = dense
+
+    def __len__(self) -> int:
+        return len(self.pack)
+
+    def read_frame(self, frame_id: int) -> DataFrame:
+        frame = self.pack.read_frame(frame_id)
+        return densify_frame(frame) if self.dense else frame
+
+
+# 只保存关键帧的数据集：中间帧在读取时由前后两个关键帧插值得到，与构建时生成的中间帧完全一致
+# 量化存储的imaging先解码为强度再插值，插值结果重新编码，误差在构建时已计入编码步长
+# 最近读取的关键帧和插值用的临时数组会被缓存，因此返回的数据帧不能被原地修改，也不能被多个线程同时读取
+class InterpFrameSource:
+    thread_safe = False
+
+    def __init__(self, source, schedule: list[tuple], cache_size: int = 4):
+        self.source = source
+        self.schedule = schedule
+        self.cache_size = cache_size
+        self.keyframes = OrderedDict()
+        self.decoded = OrderedDict()
+        self.tmp = {}
+
+    def __len__(self) -> int:
+        return len(self.schedule)
+
+    def read_keyframe(self, key_id: int) -> DataFrame:
+        if key_id in self.keyframes:
+            self.keyframes.move_to_end(key_id)
+            return self.keyframes[key_id]
+        frame = self.source.read_frame(key_id)
+        self.keyframes[key_id] = frame
+        if len(self.keyframes) > self.cache_size:
+            self.keyframes.popitem(last=False)
+        return frame
+
+    # 用于插值的关键帧，imaging解码为强度
+    def read_blend_keyframe(self, key_id: int) -> DataFrame:
+        frame = self.read_keyframe(key_id)
+        if frame.imaging.codec is None:
+            return frame
+        if key_id in self.decoded:
+            self.decoded.move_to_end(key_id)
+            return self.decoded[key_id]
+        decoded = DataFrame()
+        for key in GRID_KEYS:
+            setattr(decoded, key, getattr(frame, key))
+        decoded.imaging = decode_imaging(frame.imaging)
+        self.decoded[key_id] = decoded
+        if len(self.decoded) > self.cache_size:
+            self.decoded.popitem(last=False)
+        return decoded
+
+    def read_frame(self, frame_id: int) -> DataFrame:
+        time_str, key0, key1, left, right = self.schedule[frame_id]
+        frame = DataFrame()
+        if key1 < 0:
+            frame0 = self.read_keyframe(key0)
+            for key in GRID_KEYS:
+                setattr(frame, key, getattr(frame0, key))
+        else:
+            codec = self.read_keyframe(key0).imaging.codec
+            blend_frame(self.read_blend_keyframe(key0), self.read_blend_keyframe(key1), left, right, frame, self.tmp)
+            if codec is not None:
+                frame.imaging = encode_grid(frame.imaging, codec)
+        frame.id = frame_id
+        frame.time_str = time_str
+        return frame
+
+
+# 多分辨率数据集：level 0为原始数据帧，level k为分辨率降低2^k倍的数据帧
+# 请求的级别超过已有的最高级别时返回最高级别的数据帧
+class PyramidFrameSource:
+    def __init__(self, sources: list):
+        self.sources = sources
+        self.levels = len(sources) - 1
+
+    def __len__(self) -> int:
+        return len(self.sources[0])
+
+    @property
+    def thread_safe(self) -> bool:
+        return all(source.thread_safe for source in self.sources)
+
+    def read_frame(self, frame_id: int, level: int = 0) -> DataFrame:
+        return self.sources[min(max(level, 0), self.levels)].read_frame(frame_id)
+
+
+# 第level级降采样数据帧的保存目录，level 0为数据集目录本身
+def level_dir(file_dir: str, level: int) -> str:
+    return file_dir if level == 0 else file_dir + '/level-' + str(level)
+
+
+# 根据数据集的存储方式创建数据帧来源，level为降采样级别
+# dense为False时分块存储的imaging不转换为普通网格；只保存关键帧时插值需要普通网格，总是转换
+def frame_source(file_dir: str, frame_files: list[str], frame_pack: str = None, keyframe_files: list[str] = None,
+                 schedule: list[tuple] = None, level: int = 0, dense: bool = True):
+    file_dir = level_dir(file_dir, level)
+    dense = dense or schedule is not None
+    if frame_pack is not None:
+        source = PackFrameSource(file_dir + '/' + frame_pack, dense)
+    else:
+        source = JoblibFrameSource(file_dir, keyframe_files if keyframe_files is not None else frame_files, dense)
+    if schedule is not None:
+        source = InterpFrameSource(source, schedule)
+    return source
+
+
+# 将量化存储的imaging网格解码为强度，返回新的网格；未量化的网格直接返回
+def decode_imaging(grid: UniformGrid) -> UniformGrid:
+    if grid.codec is None:
+        return grid
+    decoded = UniformGrid()
+    decoded.data = decode_intensity(grid.data, grid.codec)
+    decoded.bounds = grid.bounds
+    decoded.spacing = grid.spacing
+    decoded.dim = grid.dim
+    return decoded
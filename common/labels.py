@@ -0,0 +1,82 @@
+import numpy as np
+
+
+# 四维区域标记(时间, x, y, z)的压缩存储：每帧的标记按C顺序展开后进行游程编码，只保存非零的游程
+# 游程按帧依次存放，frame_runs[t]:frame_runs[t + 1]为第t帧的游程；标记使用能容纳所有区域编号的最小整数类型
+# 按帧编号索引(labels[t]、labels[t, x0:x1, ...])时只解码该帧，region_voxels只展开一个区域的游程，都不需要展开整个四维数组
+class CompactLabels:
+    def __init__(self, shape: tuple, dtype):
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        index_dtype = np.uint32 if int(np.prod(self.shape[1:])) < 2 ** 32 else np.int64
+        self.frame_runs = np.zeros(self.shape[0] + 1, np.int64)
+        self.starts = np.zeros(0, index_dtype)
+        self.lengths = np.zeros(0, index_dtype)
+        self.values = np.zeros(0, self.dtype)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return self.frame_runs.nbytes + self.starts.nbytes + self.lengths.nbytes + self.values.nbytes
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self.frame(key[0])[key[1:]]
+        return self.frame(key)
+
+    # 第frame_id帧的游程序号范围
+    def runs(self, frame_id: int) -> slice:
+        frame_id = range(self.shape[0])[frame_id]
+        return slice(int(self.frame_runs[frame_id]), int(self.frame_runs[frame_id + 1]))
+
+    # 解码一帧的标记，返回(x, y, z)的数组
+    def frame(self, frame_id: int) -> np.ndarray:
+        runs = self.runs(frame_id)
+        mark = np.zeros(int(np.prod(self.shape[1:])), self.dtype)
+        mark[run_indices(self.starts[runs], self.lengths[runs])] = np.repeat(self.values[runs], self.lengths[runs])
+        return mark.reshape(self.shape[1:])
+
+    # 区域的体素序号：指定frame_id时返回该帧中的(n, 3)数组[x, y, z]，否则返回所有帧中的(n, 4)数组[t, x, y, z]
+    def region_voxels(self, region_id: int, frame_id: int = None) -> np.ndarray:
+        runs = self.runs(frame_id) if frame_id is not None else slice(0, len(self.values))
+        selected = np.flatnonzero(self.values[runs] == region_id) + runs.start
+        indices = run_indices(self.starts[selected], self.lengths[selected])
+        coords = np.unravel_index(indices, self.shape[1:])
+        if frame_id is None:
+            frames = np.searchsorted(self.frame_runs, selected, side='right') - 1
+            coords = (np.repeat(frames, self.lengths[selected]),) + coords
+        return np.stack(coords, axis=1)
+
+
+# 游程覆盖的所有展开序号
+def run_indices(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    lengths = lengths.astype(np.int64)
+    total = int(lengths.sum())
+    offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.repeat(starts.astype(np.int64), lengths) + offsets
+
+
+# 将四维标记(可以是磁盘上的memmap)逐帧编码为CompactLabels，dtype默认为marks的类型
+def compact_labels(marks, dtype=None) -> CompactLabels:
+    labels = CompactLabels(marks.shape, marks.dtype if dtype is None else dtype)
+    starts, lengths, values = [], [], []
+    for t in range(marks.shape[0]):
+        flat = np.asarray(marks[t]).ravel()
+        frame_starts = np.concatenate([[0], np.flatnonzero(flat[1:] != flat[:-1]) + 1])
+        frame_lengths = np.diff(np.append(frame_starts, flat.size))
+        keep = flat[frame_starts] != 0
+        starts.append(frame_starts[keep])
+        lengths.append(frame_lengths[keep])
+        values.append(flat[frame_starts[keep]])
+        labels.frame_runs[t + 1] = labels.frame_runs[t] + np.count_nonzero(keep)
+    if starts:
+        labels.starts = np.concatenate(starts).astype(labels.starts.dtype)
+        labels.lengths = np.concatenate(lengths).astype(labels.lengths.dtype)
+        labels.values = np.concatenate(values).astype(labels.dtype)
+    return labels
@@ -1,19 +1,348 @@
+from datetime import datetime
+
 import numpy as np
-from scipy.interpolate import interpn
+from scipy.optimize import curve_fit
+
+from common.entity import DataFrame, UniformGrid, BrickGrid, GRID_KEYS
+from common.resample import resample_linear
+
+
+# 三维数据线性重采样，按维度依次插值，结果与在原网格上使用interpn一致
+def scale_data3d(data: np.ndarray, target_size: tuple, dtype=None) -> np.ndarray:
+    return resample_linear(data, target_size, dtype)
+
+
+TIME_FORMAT = '%Y%m%dT%H%M'
+
+
+# 时间字符串与datetime之间的转换，时间字符串格式为 YYYYmmddTHHMM
+def parse_time(time_str: str) -> datetime:
+    return datetime.strptime(time_str, TIME_FORMAT)
+
+
+def format_time(time: datetime) -> str:
+    return time.strftime(TIME_FORMAT)
+
+
+# 对两组数据进行线性插值: left * data1 + right * data0
+# 传入out(以及tmp)时结果写入预先分配的缓冲区，避免每次插值都重新分配内存
+def blend_data(data0: np.ndarray, data1: np.ndarray, left: float, right: float, out=None, tmp=None) -> np.ndarray:
+    if out is None:
+        return left * data1 + right * data0
+    if tmp is None:
+        tmp = right * data0
+    else:
+        np.multiply(data0, right, out=tmp)
+    np.multiply(data1, left, out=out)
+    np.add(out, tmp, out=out)
+    return out
+
+
+# 在out中生成frame0与frame1之间的插值帧，缓冲区不存在或尺寸不符时重新分配
+def blend_frame(frame0: DataFrame, frame1: DataFrame, left: float, right: float, out: DataFrame, tmp: dict) -> DataFrame:
+    for key in GRID_KEYS:
+        grid0 = getattr(frame0, key)
+        if key == 'doppler' and grid0.dim != 3:
+            setattr(out, key, grid0)
+            continue
+        grid = getattr(out, key)
+        if grid is grid0 or grid.data.shape != grid0.data.shape:
+            grid = UniformGrid()
+            grid.data = np.empty_like(grid0.data)
+            setattr(out, key, grid)
+        if key not in tmp or tmp[key].shape != grid0.data.shape:
+            tmp[key] = np.empty_like(grid0.data)
+        blend_data(grid0.data, getattr(frame1, key).data, left, right, out=grid.data, tmp=tmp[key])
+        grid.bounds = grid0.bounds
+        grid.spacing = grid0.spacing
+        grid.dim = grid0.dim
+    return out
+
+
+# imaging的量化存储：log10强度按固定步长编码为uint16，编码参数(codec)为 {'floor': 下限, 'step': 步长}
+# 编码0表示不大于下限的值(包括区域外的体素)，解码强度为0，解码对数为log10(floor)；
+# 编码k(k >= 1)对应 log10(floor) + (k - 1) * step，对数的量化误差不超过step / 2
+LOG_CODE_MAX = 65535
+LOG_FLOOR = 1e-9
+
+
+# 按log10强度的最大误差生成编码参数
+def log_codec(error: float, floor: float = LOG_FLOOR) -> dict:
+    if not error > 0:
+        raise ValueError('quantization error must be positive: ' + str(error))
+    return {'floor': floor, 'step': 2 * error}
+
+
+# 误差不超过step / 2时能够编码的最大log10强度，更大的值被截断为最大编码
+def log_ceiling(codec: dict) -> float:
+    return float(np.log10(codec['floor']) + (LOG_CODE_MAX - 1) * codec['step'] + codec['step'] / 2)
+
+
+# 编码范围能够覆盖最大值max_value所需的最小步长
+def min_log_step(max_value: float, floor: float = LOG_FLOOR) -> float:
+    return float((np.log10(max_value) - np.log10(floor)) / (LOG_CODE_MAX - 0.5))
+
+
+def encode_log(data: np.ndarray, codec: dict) -> np.ndarray:
+    with np.errstate(divide='ignore', invalid='ignore'):
+        codes = (np.log10(data) - np.log10(codec['floor'])) / codec['step'] + 1
+    codes = np.rint(np.nan_to_num(codes, nan=0, neginf=0, posinf=LOG_CODE_MAX))
+    codes[~(data > codec['floor'])] = 0
+    return np.clip(codes, 0, LOG_CODE_MAX).astype(np.uint16)
+
+
+# 解码为log10强度(float32)
+def decode_log(codes: np.ndarray, codec: dict) -> np.ndarray:
+    log_data = np.maximum(codes.astype(np.float32) - 1, 0)
+    log_data *= np.float32(codec['step'])
+    log_data += np.float32(np.log10(codec['floor']))
+    return log_data
+
+
+# 解码为强度(float64)
+def decode_intensity(codes: np.ndarray, codec: dict) -> np.ndarray:
+    data = np.power(10.0, (codes.astype(np.float64) - 1) * codec['step'] + np.log10(codec['floor']))
+    data[codes == 0] = 0
+    return data
+
+
+# 对imaging网格进行量化编码，返回新的网格
+def encode_grid(grid: UniformGrid, codec: dict) -> UniformGrid:
+    encoded = UniformGrid()
+    encoded.data = encode_log(grid.data, codec)
+    encoded.bounds = grid.bounds
+    encoded.spacing = grid.spacing
+    encoded.dim = grid.dim
+    encoded.codec = codec
+    return encoded
+
+
+# 三维数据按factor分块池化(mode为'max'或'mean')，尺寸不能整除时末尾的不完整块只使用其中已有的数据
+# 求平均的累加顺序与内存布局有关，这里统一转换为C顺序，保证相同的数据得到完全相同的结果
+def pool_data3d(data: np.ndarray, factor: int, mode: str = 'max') -> np.ndarray:
+    data = np.ascontiguousarray(data)
+    pad = [(0, -n % factor) for n in data.shape]
+    padded = any(p for _, p in pad)
+    if padded:
+        data = np.pad(data.astype(np.result_type(data.dtype, np.float32), copy=False), pad, constant_values=np.nan)
+    shape = data.shape
+    blocks = data.reshape(shape[0] // factor, factor, shape[1] // factor, factor, shape[2] // factor, factor)
+    if mode == 'max':
+        return np.nanmax(blocks, axis=(1, 3, 5)) if padded else blocks.max(axis=(1, 3, 5))
+    return np.nanmean(blocks, axis=(1, 3, 5)) if padded else blocks.mean(axis=(1, 3, 5))
+
+
+# 三维网格池化降采样，采样点位于每块的中心
+def pool_grid(grid: UniformGrid, factor: int, mode: str = 'max') -> UniformGrid:
+    pooled = UniformGrid()
+    pooled.data = pool_data3d(grid.data, factor, mode)
+    pooled.spacing = [s * factor for s in grid.spacing]
+    bounds = np.array(grid.bounds, np.float64)
+    for axis in range(3):
+        bounds[axis * 2] = bounds[axis * 2] + (factor - 1) / 2 * grid.spacing[axis]
+        bounds[axis * 2 + 1] = bounds[axis * 2] + (pooled.data.shape[axis] - 1) * pooled.spacing[axis]
+    pooled.bounds = bounds
+    pooled.dim = grid.dim
+    return pooled
+
+
+# 生成分辨率减半的数据帧：imaging按mode池化，doppler速度取平均，diffuse为二维数据，保持不变
+def downsample_frame(frame: DataFrame, mode: str = 'max') -> DataFrame:
+    coarse = DataFrame()
+    coarse.id = frame.id
+    coarse.time_str = frame.time_str
+    coarse.imaging = pool_grid(frame.imaging, 2, mode)
+    coarse.doppler = pool_grid(frame.doppler, 2, 'mean') if frame.doppler.dim == 3 else frame.doppler
+    coarse.diffuse = frame.diffuse
+    return coarse
+
+
+# 对均匀网格数据进行裁剪，只拷贝裁剪后的部分；分块存储的网格只读取与裁剪范围相交的块
+def cut_uniform(old_data: UniformGrid, new_bounds: list) -> UniformGrid:
+    old_bounds = old_data.bounds
+    spacing = old_data.spacing
+    dim = old_data.dim
+    size = old_data.shape if isinstance(old_data, BrickGrid) else old_data.data.shape
+
+    delta = []
+    for i in range(dim*2):
+        delta.append(int((abs(new_bounds[i] - old_bounds[i])) / spacing[int(i / 2)]))
+
+    new_data = UniformGrid()
+    new_data.bounds = new_bounds
+    new_data.spacing = spacing.copy()
+    new_data.dim = dim
+    new_data.codec = old_data.codec
+    if dim == 2:
+        new_data.data = old_data.data[delta[0]:size[0]-delta[1], delta[2]:size[1]-delta[3]].copy()
+    elif isinstance(old_data, BrickGrid):
+        new_data.data = old_data.read_box((delta[0], delta[2], delta[4]), (size[0]-delta[1], size[1]-delta[3], size[2]-delta[5]))
+    elif dim == 3:
+        new_data.data = old_data.data[delta[0]:size[0]-delta[1], delta[2]:size[1]-delta[3], delta[4]:size[2]-delta[5]].copy()
+    else:
+        new_data.data = old_data.data.copy()
+    return new_data
+
+
+# 计算imaging、doppler、diffuse的公共边界[min_x, max_x, min_y, max_y, min_z, max_z]，diffuse为二维数据，只限制x、y
+def calculate_bounds(frame: DataFrame) -> list:
+    image = frame.imaging
+    doppler = frame.doppler
+    diffuse = frame.diffuse
+
+    bounds_2d = []
+    bounds_3d = []
+    if image.dim == 3:
+        bounds_2d.append(image.bounds[:4])
+        bounds_3d.append(image.bounds[4:])
+    if doppler.dim == 3:
+        bounds_2d.append(doppler.bounds[:4])
+        bounds_3d.append(doppler.bounds[4:])
+    if diffuse.dim == 2:
+        bounds_2d.append(diffuse.bounds[:4])
+    arr2d = np.array(bounds_2d)
+    arr3d = np.array(bounds_3d)
+    return [max(arr2d[:, 0]), min(arr2d[:, 1]), max(arr2d[:, 2]), min(arr2d[:, 3]), max(arr3d[:, 0]), min(arr3d[:, 1])]
+
+
+# 对数据帧中的所有网格进行裁剪
+def cut_all(frame: DataFrame, bounds: list) -> DataFrame:
+    cut_frame = DataFrame()
+    cut_frame.id = frame.id
+    cut_frame.time_str = frame.time_str
+    for key in GRID_KEYS:
+        grid = getattr(frame, key)
+        setattr(cut_frame, key, cut_uniform(grid, bounds) if grid.dim in (2, 3) else grid)
+    return cut_frame
+
+
+# 按边界裁剪网格，边界向内(outward为True时向外)对齐到网格的采样点，裁剪后的bounds恰好为首末采样点的坐标；
+# 裁剪范围内没有采样点时抛出ValueError
+def crop_grid(grid: UniformGrid, bounds: list, outward: bool = False) -> UniformGrid:
+    shape = grid.data.shape
+    old_bounds = np.asarray(grid.bounds, np.float64)
+    new_bounds = old_bounds.copy()
+    index = []
+    for axis in range(grid.dim):
+        origin, spacing = old_bounds[axis * 2], grid.spacing[axis]
+        lower, upper = (bounds[axis * 2] - origin) / spacing, (bounds[axis * 2 + 1] - origin) / spacing
+        if outward:
+            first, last = int(np.floor(lower + 1e-6)), int(np.ceil(upper - 1e-6))
+        else:
+            first, last = int(np.ceil(lower - 1e-6)), int(np.floor(upper + 1e-6))
+        first, last = max(first, 0), min(last, shape[axis] - 1)
+        if first > last:
+            raise ValueError('crop bounds do not overlap the grid: ' + str([float(v) for v in bounds]))
+        index.append(slice(first, last + 1))
+        new_bounds[axis * 2] = origin + first * spacing
+        new_bounds[axis * 2 + 1] = origin + last * spacing
+
+    cropped = UniformGrid()
+    cropped.data = np.ascontiguousarray(grid.data[tuple(index)])
+    cropped.bounds = new_bounds
+    cropped.spacing = grid.spacing
+    cropped.dim = grid.dim
+    cropped.codec = grid.codec
+    return cropped
+
+
+# 将数据帧的所有网格裁剪到公共边界内，roi不为空时再限制在roi[min_x, max_x, min_y, max_y, min_z, max_z]内
+# 各网格分别对齐到自己的采样点；doppler的分辨率低于imaging，向外对齐，使其覆盖imaging的范围，可视化时插值到imaging网格上
+def crop_frame(frame: DataFrame, roi: list = None) -> DataFrame:
+    bounds = calculate_bounds(frame)
+    if roi is not None:
+        for i in range(0, 6, 2):
+            bounds[i] = max(bounds[i], roi[i])
+            bounds[i + 1] = min(bounds[i + 1], roi[i + 1])
+    cropped = DataFrame()
+    cropped.id = frame.id
+    cropped.time_str = frame.time_str
+    for key in GRID_KEYS:
+        grid = getattr(frame, key)
+        setattr(cropped, key, crop_grid(grid, bounds, key == 'doppler') if grid.dim in (2, 3) else grid)
+    return cropped
+
+
+# 按区域的体素边界[x0, x1, y0, y1, z0, z1]裁剪imaging数据，区域外的体素置为1e-9(量化存储时置为编码0)
+# mark为该帧的区域标记，crop不为空时区域边界再限制在crop范围内
+def region_bounds_cut(imaging: UniformGrid, mark: np.ndarray, region_id: int, voxel_bounds, crop=None) -> UniformGrid:
+    region_bounds = list(voxel_bounds)
+    spacing = imaging.spacing
+    for i in range(len(region_bounds)):
+        region_bounds[i] = region_bounds[i] * spacing[int(i/2)] + imaging.bounds[int(i/2) * 2]
+    if crop is not None:
+        for i in range(0, 6, 2):
+            region_bounds[i] = max(region_bounds[i], crop[i])
+            region_bounds[i + 1] = min(region_bounds[i + 1], crop[i + 1])
+    region_grid = cut_uniform(imaging, region_bounds)
+    mark_grid = UniformGrid()
+    mark_grid.data = mark
+    mark_grid.bounds = imaging.bounds
+    mark_grid.spacing = imaging.spacing
+    mark_grid.dim = imaging.dim
+    region_marks = cut_uniform(mark_grid, region_bounds).data
+    region_grid.data[region_marks != region_id] = 1e-9 if region_grid.codec is None else 0
+    return region_grid
+
+
+# 计算中心线点集：每个z平面上取最大值所在的点
+def calculate_centerline_points(region_grid: UniformGrid, interval=1):
+    bounds = region_grid.bounds
+    spacing = region_grid.spacing
+    points = []
+    for z in range(0, region_grid.data.shape[2], interval):
+        plane_data = region_grid.data[:, :, z]
+        max_v = np.max(plane_data)
+        if max_v > 1e-9:
+            max_points = np.where(plane_data == max_v)
+            points.append((max_points[0][0] * spacing[0] + bounds[0], max_points[1][0] * spacing[1] + bounds[2],
+                        z * spacing[2] + bounds[4]))
+    return points
+
+
+# 多项式函数曲线拟合
+def poly_curve_fit(points):
+    points_array = np.array(points)
+    x = points_array[:, 0]
+    y = points_array[:, 1]
+    z = points_array[:, 2]
+
+    def curve_func(t, a0, a1, a2):
+        return a0 + a1 * t + a2 * t ** 2
+
+    p0 = [1, 1, 1]
+    params_x, pcov_x = curve_fit(curve_func, z, x, p0)
+    params_y, pcov_x = curve_fit(curve_func, z, y, p0)
+
+    xx = curve_func(z, *params_x)
+    yy = curve_func(z, *params_y)
+
+    new_points = []
+    for i in range(len(points)):
+        new_points.append((xx[i], yy[i], z[i]))
+
+    return new_points, [params_x, params_y]
 
 
-def scale_data3d(data: np.ndarray, target_size: tuple) -> np.ndarray:
-    size = data.shape
-    x1 = np.linspace(0, size[0] - 1, size[0])
-    x2 = np.linspace(0, size[1] - 1, size[1])
-    x3 = np.linspace(0, size[2] - 1, size[2])
-    points = (x1, x2, x3)
+# 计算曲率
+def calculate_curvature(points, params):
+    K = []
+    for p in points:
+        (x, y, z) = p
+        x1 = 2*params[0][0]*z + params[0][1]
+        x2 = 2*params[0][0]
+        y1 = 2*params[1][0]*z + params[1][1]
+        y2 = 2*params[1][0]
+        k = abs(x1*y2 - x2*y1)/np.sqrt(x1**2 + y1**2)
+        K.append(k)
+    return K
 
-    x1_new = np.linspace(0, size[0] - 1, target_size[0])
-    x2_new = np.linspace(0, size[1] - 1, target_size[1])
-    x3_new = np.linspace(0, size[2] - 1, target_size[2])
-    xx, yy, zz = np.meshgrid(x1_new, x2_new, x3_new, indexing='ij')
-    new_points = np.array([xx, yy, zz]).T
 
-    result = interpn(points, data, new_points, bounds_error=False, fill_value=True).transpose(2, 1, 0)
-    return result
+# 计算区域的拟合中心线，返回拟合后的点(n, 3)、多项式参数(2, 3)和每个点的曲率(n)
+def fit_centerline(region_grid: UniformGrid) -> dict:
+    points, params = poly_curve_fit(calculate_centerline_points(region_grid))
+    return {
+        'points': np.array(points),
+        'params': np.array(params),
+        'curvature': np.array(calculate_curvature(points, params))
+    }
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+# 线性重采样：源数据的坐标为0..n-1，目标坐标为linspace(0, n-1, m)，与interpn在相同网格上的线性插值一致
+# 多维数据按维度依次进行一维插值(可分离)，不需要构造目标点坐标数组，临时内存约为一份输出大小
+
+
+# 计算一个维度上每个目标点(以源数据的序号为单位的坐标)的左右相邻源点序号和权重，超出0..size-1的坐标取边界值
+def position_weights(size: int, positions: np.ndarray):
+    positions = np.clip(positions, 0, size - 1)
+    index0 = np.minimum(np.floor(positions).astype(np.intp), max(size - 2, 0))
+    index1 = np.minimum(index0 + 1, size - 1)
+    frac = positions - index0
+    return index0, index1, frac
+
+
+# 计算一个维度上每个目标点的左右相邻源点序号和权重，目标点均匀分布在0..size-1上
+def axis_weights(size: int, target: int):
+    return position_weights(size, np.linspace(0, size - 1, target))
+
+
+# 沿axis维度重采样到target个点，结果写入out(如果提供)
+def resample_axis(data: np.ndarray, axis: int, target: int, dtype=None, out: np.ndarray = None) -> np.ndarray:
+    return interp_axis(data, axis, axis_weights(data.shape[axis], target), dtype, out)
+
+
+# 沿axis维度按weights(见position_weights)进行线性插值，结果写入out(如果提供)
+def interp_axis(data: np.ndarray, axis: int, weights: tuple, dtype=None, out: np.ndarray = None) -> np.ndarray:
+    if dtype is None:
+        dtype = out.dtype if out is not None else data.dtype
+    index0, index1, frac = weights
+    target = len(index0)
+    shape = [1] * data.ndim
+    shape[axis] = target
+    frac = frac.reshape(shape).astype(dtype)
+
+    if out is None:
+        out_shape = list(data.shape)
+        out_shape[axis] = target
+        out = np.empty(out_shape, dtype)
+    if data.dtype == out.dtype:
+        np.take(data, index0, axis=axis, out=out, mode='clip')
+    else:
+        out[...] = np.take(data, index0, axis=axis, mode='clip')
+    upper = np.take(data, index1, axis=axis, mode='clip').astype(dtype, copy=False)
+    upper -= out
+    upper *= frac
+    out += upper
+    return out
+
+
+# 将数据线性重采样到target_size，可用于任意维度
+# dtype指定计算和输出的精度(例如np.float32以减少内存)，默认使用输入的浮点类型；out为预先分配的输出数组
+# 缩小的维度先处理、放大的维度后处理，使中间结果尽量小
+def resample_linear(data: np.ndarray, target_size: tuple, dtype=None, out: np.ndarray = None) -> np.ndarray:
+    data = np.asarray(data)
+    if dtype is None:
+        dtype = out.dtype if out is not None else np.result_type(data.dtype, np.float32)
+    axes = [axis for axis in np.argsort([target_size[axis] / data.shape[axis] for axis in range(data.ndim)],
+                                        kind='stable') if target_size[axis] != data.shape[axis]]
+
+    result = data
+    for i, axis in enumerate(axes):
+        last = i == len(axes) - 1
+        result = resample_axis(result, axis, target_size[axis], dtype, out if last else None)
+    if not axes:
+        if out is None:
+            return data.astype(dtype)
+        out[...] = data
+        return out
+    return result
+
+
+# 在任意坐标上线性采样：positions为每个维度上的目标坐标(以源数据的序号为单位)，超出0..n-1的坐标取边界值
+# 结果的形状为各维度目标坐标的个数，按维度依次插值，不需要构造目标点坐标数组
+def sample_linear(data: np.ndarray, positions: list, dtype=None) -> np.ndarray:
+    result = np.asarray(data)
+    if dtype is None:
+        dtype = np.result_type(result.dtype, np.float32)
+    for axis, axis_positions in enumerate(positions):
+        weights = position_weights(result.shape[axis], np.asarray(axis_positions, np.float64))
+        result = interp_axis(result, axis, weights, dtype)
+    return result
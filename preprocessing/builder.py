@@ -1,161 +1,823 @@
 import os
 import sys
+import shutil
+import queue
+import itertools
+import time
+import warnings
+from collections import deque
+from datetime import timedelta
 import numpy as np
 import joblib
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import OptimizeWarning
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
-from common.entity import DataFrame
+from common.entity import DataFrame, UniformGrid, GRID_KEYS
+from common.method import parse_time, format_time, blend_frame, region_bounds_cut, fit_centerline, log_codec, \
+    crop_frame
+from common.frame_pack import PackWriter, read_pack_index
+from common.bricks import BRICK_SIZES
+from common.labels import compact_labels
 from preprocessing import load_from_mat
 from preprocessing import region_detector
+from preprocessing import catalog
+from common.doppler import doppler_products
+from preprocessing.manifest import BuildManifest, text_digest
+from preprocessing import profiler as build_profiler
+from preprocessing.profiler import BuildProfiler
+from common.frame_source import level_dir, frame_source, decode_imaging
+from preprocessing.frame_writer import QUEUE_SIZE, FrameOutput, build_frames, build_frames_pipeline
+
+
+PACK_FILE = 'frames.pack'
+REGION_TABLE_FILE = 'region_table.npy'
+CENTERLINE_FILE = 'centerline.bin'
+MAT_CACHE_DIR = '.matcache'
+PYRAMID_LEVELS = 3
 
 
 def get_parameters():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input_dir', '-i', required=True, help='path for input data')
+    parser.add_argument('--input_dir', '-i', default=None, help='path for input data')
     parser.add_argument('--output_dir', '-o', required=True, help='path for output data')
-    return parser.parse_args()
+    parser.add_argument('--workers', '-w', type=int, default=1, help='number of worker processes/threads')
+    parser.add_argument('--cadence', '-c', type=int, default=10, help='minutes between output frames')
+    parser.add_argument('--format', '-f', choices=['joblib', 'pack'], default='joblib',
+                        help='frame file format: one joblib file per frame, or a single packed file')
+    parser.add_argument('--memory_budget', '-m', type=int, default=2048, help='memory budget (MB) for region detection')
+    parser.add_argument('--tracking', '-t', action='store_true',
+                        help='detect regions by tracking 3D components frame by frame instead of 4D time slabs')
+    parser.add_argument('--keyframes_only', '-k', action='store_true',
+                        help='store measured frames only, intermediate frames are interpolated when read')
+    parser.add_argument('--centerlines', '-l', action='store_true',
+                        help='precompute the fitted centerline of every region in every frame')
+    parser.add_argument('--doppler', '-d', action='store_true',
+                        help='precompute doppler velocity and heat flux products of every region in every frame')
+    parser.add_argument('--quantize', '-q', type=float, default=None,
+                        help='store imaging as uint16 log10 intensity with the given maximum log10 error; '
+                             'the bound does not cover voxels in, or interpolated (-k) from, empty -b bricks')
+    parser.add_argument('--pyramid', '-p', choices=['max', 'mean'], default=None,
+                        help='also store 2x/4x/8x downsampled frames, imaging pooled by max or mean')
+    parser.add_argument('--bricks', '-b', type=int, choices=BRICK_SIZES, default=None,
+                        help='store imaging as sparse bricks of the given size, only bricks above the region threshold')
+    parser.add_argument('--mat_cache', '-a', default=None,
+                        help='directory for parsed .mat files, defaults to .matcache in the input directory')
+    parser.add_argument('--no_mat_cache', action='store_true', help='parse every .mat file without caching')
+    parser.add_argument('--catalog', '-g', default=None,
+                        help='sqlite catalog of raw data directories, the input directory is scanned into it if given')
+    parser.add_argument('--roi', '-r', type=float, nargs=6, default=None,
+                        metavar=('MIN_X', 'MAX_X', 'MIN_Y', 'MAX_Y', 'MIN_Z', 'MAX_Z'),
+                        help='crop all grids to this region of interest (m)')
+    parser.add_argument('--start', '-s', default=None, help='first frame time to build, YYYYmmddTHHMM')
+    parser.add_argument('--end', '-e', default=None, help='last frame time to build, YYYYmmddTHHMM')
+    parser.add_argument('--rebuild', action='store_true', help='ignore the build manifest and rebuild everything')
+    args = parser.parse_args()
+    if args.input_dir is None and args.catalog is None:
+        parser.error('one of --input_dir/-i and --catalog/-g is required')
+    if args.quantize is not None and not args.quantize > 0:
+        parser.error('quantization error must be positive: ' + str(args.quantize))
+    if args.roi is not None and any(args.roi[i] > args.roi[i + 1] for i in range(0, 6, 2)):
+        parser.error('invalid roi: ' + str(args.roi))
+    for time_str in (args.start, args.end):
+        if time_str is not None:
+            try:
+                parse_time(time_str)
+            except ValueError:
+                parser.error('invalid time: ' + time_str)
+    return args
+
+
+# 构建选项，各项的含义见build_all，默认值与命令行参数的默认值一致
+class BuildOptions:
+    def __init__(self, workers: int = 1, cadence: int = 10, memory_budget: int = 2048, file_format: str = 'joblib',
+                 rebuild: bool = False, keyframes_only: bool = False, centerlines: bool = False, doppler: bool = False,
+                 quantize: float = None, mat_cache: str = None, catalog_path: str = None, start: str = None,
+                 end: str = None, pyramid: str = None, bricks: int = None, roi: list = None, tracking: bool = False):
+        self.workers = workers
+        self.cadence = cadence
+        self.memory_budget = memory_budget
+        self.file_format = file_format
+        self.rebuild = rebuild
+        self.keyframes_only = keyframes_only
+        self.centerlines = centerlines
+        self.doppler = doppler
+        self.quantize = quantize
+        self.mat_cache = mat_cache
+        self.catalog_path = catalog_path
+        self.start = start
+        self.end = end
+        self.pyramid = pyramid
+        self.bricks = bricks
+        self.roi = roi
+        self.tracking = tracking
+
+
+# 由命令行参数得到构建选项；mat解析缓存默认位于输入目录(只使用目录索引时为目录索引所在目录)的.matcache中
+def build_options(args) -> BuildOptions:
+    mat_cache = args.mat_cache
+    if args.no_mat_cache:
+        mat_cache = None
+    elif mat_cache is None and args.input_dir is not None:
+        mat_cache = args.input_dir + '/' + MAT_CACHE_DIR
+    elif mat_cache is None:
+        mat_cache = os.path.dirname(os.path.abspath(args.catalog)) + '/' + MAT_CACHE_DIR
+    return BuildOptions(args.workers, args.cadence, args.memory_budget, args.format, args.rebuild,
+                        args.keyframes_only, args.centerlines, args.doppler, args.quantize, mat_cache, args.catalog,
+                        args.start, args.end, args.pyramid, args.bricks, args.roi, args.tracking)
+
+
+# 扫描指定目录，按时间配对imaging/doppler/diffuse文件，返回每一帧需要执行的读取任务
+def collect_jobs(file_dir: str) -> list[dict]:
+    return catalog.pair_jobs(catalog.scan_dir(file_dir))
+
+
+# mat文件读取或跨进程传输得到的数组带有各自新建的dtype对象，会改变pickle中的引用关系，
+# 这里统一替换为numpy内置的dtype，保证并行与串行构建的输出文件完全一致
+def normalize_grid(grid: UniformGrid) -> UniformGrid:
+    if isinstance(grid.data, np.ndarray):
+        grid.data = grid.data.view(np.dtype(grid.data.dtype.str))
+    if isinstance(grid.bounds, np.ndarray):
+        grid.bounds = grid.bounds.view(np.dtype(grid.bounds.dtype.str))
+    return grid
+
+
+# 读取单个mat文件，返回网格和该文件的性能记录，可由进程池调用
+# reset_peak为True时(进程池中)内存峰值只计算读取该文件的部分；cache_dir不为空时使用mat解析缓存，digest为文件的hash
+def timed_load(loader, file_path: str, reset_peak: bool = False, cache_dir: str = None, digest: str = None):
+    if reset_peak:
+        build_profiler.reset_peak_rss()
+    wall0, cpu0 = time.perf_counter(), time.thread_time()
+    read_path = file_path
+    if cache_dir is not None and digest is not None:
+        cached_path = load_from_mat.cache_path(cache_dir, loader, digest)
+        if os.path.exists(cached_path):
+            read_path = cached_path
+    grid = load_from_mat.load_cached(loader, file_path, cache_dir, digest)
+    return grid, build_profiler.file_record('load', file_path, time.perf_counter() - wall0,
+                                            time.thread_time() - cpu0, read_bytes=os.path.getsize(read_path))
+
+
+# 将读取的数据帧裁剪到各网格的公共边界(以及roi)内，各网格对齐到自己的采样点
+def align_frame(data_frame: DataFrame, roi: list = None, profiler: BuildProfiler = None) -> DataFrame:
+    with build_profiler.step(profiler, 'crop'):
+        return crop_frame(data_frame, roi)
+
+
+# 按任务读取一帧对应的所有mat文件，任务中的digests为各文件的hash，用作mat解析缓存的键
+# 读取后裁剪到公共边界，roi不为空时再限制在roi内
+def load_frame(job: dict, profiler: BuildProfiler = None, cache_dir: str = None, roi: list = None) -> DataFrame:
+    data_frame = DataFrame()
+    for key in GRID_KEYS:
+        if key in job:
+            grid, record = timed_load(*job[key], False, cache_dir, job.get('digests', {}).get(key))
+            setattr(data_frame, key, normalize_grid(grid))
+            if profiler is not None:
+                profiler.add_file(record)
+    data_frame.time_str = job['time_str']
+    return align_frame(data_frame, roi, profiler)
+
+
+# 不需要读取的关键帧只保留时间
+def skip_frame(job: dict) -> DataFrame:
+    data_frame = DataFrame()
+    data_frame.time_str = job['time_str']
+    return data_frame
+
+
+# 按时间顺序逐帧读取mat数据，workers > 1 时使用进程池并行读取，最多预读workers帧
+# needed为需要读取的任务序号集合，其余任务只返回带有时间的空数据帧；传入profiler时记录每个mat文件的读取性能
+# cache_dir不为空时使用mat解析缓存；读取的数据帧裁剪到公共边界，roi不为空时再限制在roi内
+def iter_keyframes(jobs: list[dict], workers: int = 1, needed: set = None, profiler: BuildProfiler = None,
+                   cache_dir: str = None, roi: list = None):
+    if workers <= 1:
+        for i, job in enumerate(jobs):
+            yield load_frame(job, profiler, cache_dir, roi) if needed is None or i in needed else skip_frame(job)
+        return
+
+    def collect(job, futures):
+        if not futures:
+            return skip_frame(job)
+        data_frame = DataFrame()
+        for key, future in futures.items():
+            grid, record = future.result()
+            setattr(data_frame, key, normalize_grid(grid))
+            if profiler is not None:
+                profiler.add_file(record)
+        data_frame.time_str = job['time_str']
+        return align_frame(data_frame, roi, profiler)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for i, job in enumerate(jobs):
+            if needed is not None and i not in needed:
+                pending.append((job, {}))
+            else:
+                pending.append((job, {key: executor.submit(timed_load, *job[key], True, cache_dir,
+                                                           job.get('digests', {}).get(key))
+                                      for key in GRID_KEYS if key in job}))
+            if len(pending) > workers:
+                yield collect(*pending.popleft())
+        while pending:
+            yield collect(*pending.popleft())
+
+
+# 数据帧中各网格的形状和边界，用于检查所有帧是否位于同一网格上
+def frame_layout(frame: DataFrame) -> dict:
+    layout = {}
+    for key in GRID_KEYS:
+        grid = getattr(frame, key)
+        if grid.dim in (2, 3):
+            layout[key] = {'shape': list(grid.data.shape), 'bounds': np.asarray(grid.bounds, np.float64).tolist()}
+    return layout
+
+
+def same_layout(layout: dict, reference: dict) -> bool:
+    return layout.keys() == reference.keys() and all(
+        layout[key]['shape'] == reference[key]['shape']
+        and np.allclose(layout[key]['bounds'], reference[key]['bounds'], rtol=0, atol=1e-6) for key in layout)
+
+
+# 检查读取的关键帧都位于同一网格上：各帧分别裁剪到自己的公共边界，覆盖范围或采样点不同的帧裁剪后形状不同，
+# 无法写入同一个数据栈和打包文件，也无法相互插值；reference为之前构建时记录的网格，为None时以第一个读取的关键帧为准
+def check_keyframes(keyframes, reference: dict = None):
+    for frame in keyframes:
+        if frame.imaging.dim == 3:
+            layout = frame_layout(frame)
+            if reference is None:
+                reference = layout
+            elif not same_layout(layout, reference):
+                raise ValueError('frame ' + frame.time_str + ' is not on the same grid as the other frames: '
+                                 + str(layout) + ' != ' + str(reference)
+                                 + '; build it separately or crop all frames with --roi/-r')
+        yield frame
+
 
 # 从指定目录中读取所有mat数据文件
-def load_data(file_dir: str) -> list[DataFrame]:
-    files = os.listdir(file_dir)
-    data_frames = []
-
-    # from 2010 to 2015
-    if files[0][:5] == 'APLUW':
-        imagings = {}
-        dopplers = {}
-        diffuses = {}
-        for filename in files:
-            if filename[42:49] == 'IMAGING':
-                imagings[filename[21:32]] = filename
-            elif filename[42:49] == 'DOPPLER':
-                dopplers[filename[21:32]] = filename
-            elif filename[42:49] == 'DIFFUSE':
-                diffuses[filename[21:32]] = filename
-
-        for time_str in imagings.keys():
-            if time_str in dopplers.keys() and time_str in diffuses.keys():
-                data_frame = DataFrame()
-                data_frame.imaging = load_from_mat.load_imaging_from_mat_old(file_dir + '/' + imagings[time_str])
-                data_frame.doppler = load_from_mat.load_doppler_from_mat(file_dir + '/' + dopplers[time_str])
-                data_frame.diffuse = load_from_mat.load_diffuse_from_mat_old(file_dir + '/' + diffuses[time_str])
-                data_frame.time_str = time_str + '00'
-                data_frames.append(data_frame)
-
-    # from 2018 to 2023
-    elif files[0][:5] == 'COVIS':
-        imagings = {}
-        diffuses = {}
-        for filename in files:
-            if filename[22:29] == 'imaging':
-                imagings[filename[6:17]] = filename
-            elif filename[22:29] == 'diffuse':
-                diffuses[filename[6:17]] = filename
-
-        for time_str in imagings.keys():
-            if time_str in diffuses.keys():
-                data_frame = DataFrame()
-                data_frame.imaging = load_from_mat.load_imaging_from_mat(file_dir + '/' + imagings[time_str])
-                data_frame.diffuse = load_from_mat.load_diffuse_from_mat(file_dir + '/' + diffuses[time_str])
-                data_frame.time_str = time_str + '00'
-                data_frames.append(data_frame)
-
-    return data_frames
-
-
-# 对数据帧进行插值，以获取更多数据帧
-def frame_interp(frame0: DataFrame, frame1: DataFrame, frame_number: int) -> list[DataFrame]:
-    frames = [frame0]
-    hours0 = int(frame0.time_str[9:11])
-    hours1 = int(frame1.time_str[9:11])
-    dt = int((hours1 - hours0) * 60 / (frame_number - 1))
-
-    delta = 1 / (frame_number - 1)
-    for i in range(frame_number-2):
-        frame_i = frame0.copy()
-        left = delta * (i + 1)
-        right = delta * (frame_number - i - 2)
-        frame_i.imaging.data = left * frame1.imaging.data + right * frame0.imaging.data
-        frame_i.diffuse.data = left * frame1.diffuse.data + right * frame0.diffuse.data
-        if frame0.doppler.dim == 3:
-            frame_i.doppler.data = left * frame1.doppler.data + right * frame0.doppler.data
-        frame_i.time_str = frame0.time_str[:9] + str(int(hours0 + (i + 1) * dt / 60)).zfill(2) + str((i + 1) * dt % 60).zfill(2)
-        frames.append(frame_i)
-
-    frames.append(frame1)
-    return frames
+def load_data(file_dir: str, workers: int = 1) -> list[DataFrame]:
+    return list(iter_keyframes(collect_jobs(file_dir), workers))
+
+
+# 计算两个关键帧之间的插值时刻，按cadence分钟的间隔依次返回 (时间字符串, left, right)
+# 插值结果为 left * frame1 + right * frame0
+def segment_times(time_str0: str, time_str1: str, cadence: int = 10):
+    time0 = parse_time(time_str0)
+    time1 = parse_time(time_str1)
+    step = timedelta(minutes=cadence)
+    total = (time1 - time0) / step
+    if total <= 0:
+        return
+    delta = 1 / total
+    n = 1
+    while time0 + n * step < time1:
+        yield format_time(time0 + n * step), delta * n, delta * (total - n)
+        n = n + 1
+
+
+# 根据关键帧时间计算所有输出帧的时间
+def frame_schedule(key_times: list[str], cadence: int = 10) -> list[str]:
+    times = key_times[:1]
+    for i in range(1, len(key_times)):
+        times = times + [time_str for time_str, _, _ in segment_times(key_times[i - 1], key_times[i], cadence)]
+        times.append(key_times[i])
+    return times
+
+
+# 计算每个输出帧的依赖：关键帧依赖自身的输入文件，中间帧依赖前后两个关键帧的输入文件和插值时刻
+# 返回 [(时间字符串, 依赖, 依赖的任务序号)]，顺序与frame_schedule一致
+def frame_plan(key_times: list[str], key_digests: list[str], cadence: int = 10) -> list[tuple]:
+    plan = []
+    for i in range(len(key_times)):
+        if i > 0:
+            for time_str, _, _ in segment_times(key_times[i - 1], key_times[i], cadence):
+                plan.append((time_str, text_digest(key_digests[i - 1], key_digests[i], time_str), (i - 1, i)))
+        plan.append((key_times[i], text_digest(key_digests[i]), (i,)))
+    return plan
+
+
+# 只保存关键帧时，记录每个输出帧由哪两个关键帧插值得到：[(时间字符串, 关键帧0, 关键帧1, left, right)]
+# 插值结果为 left * 关键帧1 + right * 关键帧0，关键帧本身的关键帧1为-1
+def keyframe_schedule(key_times: list[str], cadence: int = 10) -> list[tuple]:
+    schedule = []
+    for i in range(len(key_times)):
+        if i > 0:
+            for time_str, left, right in segment_times(key_times[i - 1], key_times[i], cadence):
+                schedule.append((time_str, i - 1, i, left, right))
+        schedule.append((key_times[i], i, -1, 0.0, 1.0))
+    return schedule
+
+
+# 中间帧缓冲池：生成中间帧时取出一个空闲的缓冲帧，写入文件后归还，缓冲帧用尽时阻塞等待
+class FramePool:
+    def __init__(self, size: int):
+        self.frames = queue.Queue()
+        self.buffers = {}
+        for _ in range(size):
+            frame = DataFrame()
+            self.buffers[id(frame)] = {}
+            self.frames.put(frame)
+
+    def acquire(self):
+        frame = self.frames.get()
+        return frame, self.buffers[id(frame)]
+
+    # 关键帧不属于缓冲池，归还时直接忽略
+    def release(self, frame: DataFrame):
+        if id(frame) in self.buffers:
+            self.frames.put(frame)
+
+
+# 逐帧生成插值后的数据帧：关键帧原样返回，中间帧按真实时间间隔插值
+# 传入pool时中间帧使用缓冲池中的缓冲帧，否则每帧重新分配；传入wanted时只生成其中编号的帧
+def iter_frames(keyframes, cadence: int = 10, pool: FramePool = None, wanted: set = None,
+                profiler: BuildProfiler = None):
+    frame0 = None
+    frame_id = 0
+    for frame1 in keyframes:
+        if frame0 is not None:
+            for time_str, left, right in segment_times(frame0.time_str, frame1.time_str, cadence):
+                if wanted is not None and frame_id not in wanted:
+                    frame_id = frame_id + 1
+                    continue
+                out, tmp = pool.acquire() if pool is not None else (DataFrame(), {})
+                with build_profiler.step(profiler, 'interpolate'):
+                    frame = blend_frame(frame0, frame1, left, right, out, tmp)
+                frame.id = frame_id
+                frame.time_str = time_str
+                yield frame
+                frame_id = frame_id + 1
+        frame1.id = frame_id
+        if wanted is None or frame_id in wanted:
+            yield frame1
+        frame_id = frame_id + 1
+        frame0 = frame1
 
 
 # 对数据帧列表进行插值，以获取更多数据帧
-def interp_frames(frames: list[DataFrame]):
-    frame0 = frames[0]
-    hours0 = int(frame0.time_str[9:11])
-    results = [frame0]
-    for i in range(1, len(frames)):
-        frame = frames[i]
-        hours = int(frame.time_str[9:11])
-        new_frames = frame_interp(frame0, frame, (hours - hours0) * 6 + 1)
-        frame0 = frame
-        hours0 = hours
-        results = results + new_frames[1:]
-
-    return results
-
-
-# 从数据帧列表构建数据帧文件，并返回文件名列表
-def build_frames(frames: list[DataFrame], target_dir: str) -> list[str]:
-    frame_index = []
-    for frame in frames:
-        file_name = 'data-' + frame.time_str + '.bin'
-        target_path = target_dir + '/' + file_name
-        with open(target_path, "wb") as file:
-            joblib.dump(frame, file)
-            frame_index.append(file_name)
-            print('build file: ' + target_path)
-    return frame_index
-
-
-# 构建区域文件，并返回文件名
-def build_regions(datas: np.ndarray, target_dir: str) -> str:
-    datas = np.array(datas)
-    regions, marks = region_detector.calculate_region3d(datas)
-    regions, marks = region_detector.region_filter(regions, marks, threshold=100*marks.shape[0])
+def interp_frames(frames: list[DataFrame], cadence: int = 10) -> list[DataFrame]:
+    return list(iter_frames(frames, cadence))
+
+
+# 在磁盘上打开 (时间, x, y, z) 的数据栈，供区域检测使用
+# 已有的数据栈按帧数调整大小，已有帧的数据保持不变；文件不存在时新建
+def open_stack(file_path: str, frame_count: int, frame_shape: tuple, dtype) -> np.memmap:
+    shape = (frame_count,) + tuple(frame_shape)
+    if not os.path.exists(file_path):
+        return np.memmap(file_path, dtype=dtype, mode='w+', shape=shape)
+    os.truncate(file_path, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+    return np.memmap(file_path, dtype=dtype, mode='r+', shape=shape)
+
+
+# 构建区域文件，返回文件名和每帧的区域统计表
+# imaging数据栈和区域标记都保存在磁盘上，区域检测按内存预算(MB)分时间段进行
+# 指定cache_dir时各时间段的局部标记保存在缓存中，frame_deps(每帧的依赖)没有变化的时间段不再重新标记
+# workers > 1 时内存预算由各进程平分，并且至少划分为workers个时间段，由进程池并行标记
+# tracking为True时改为逐帧跟踪区域(见track_regions)，结果与按时间段标记完全一致
+def build_regions(datas: np.ndarray, target_dir: str, memory_budget: int = 2048, cache_dir: str = None,
+                  frame_deps: list[str] = None, workers: int = 1, tracking: bool = False):
+    slab_size = region_detector.slab_frames(datas.shape, memory_budget * 1024 * 1024 // max(workers, 1))
+    if workers > 1:
+        slab_size = min(slab_size, -(-datas.shape[0] // workers))
+
+    # 区域检测，marks为区域标记，tracking时为临时标记，由track_lut映射为区域编号
+    track_lut = None
+    if tracking:
+        marks_path = (cache_dir if cache_dir is not None else target_dir) + '/tracks.stack'
+        regions, track_lut, marks = track_regions(datas, marks_path, cache_dir, frame_deps)
+        if cache_dir is not None:
+            marks_path = None
+    else:
+        marks_path = target_dir + '/marks.stack'
+        regions, marks = label_regions(datas, marks_path, slab_size, cache_dir, frame_deps, workers)
+
+    # 过滤后的区域编号为1..N，标记使用能容纳区域编号的最小整数类型，按帧游程编码后保存(见common.labels)
+    regions, lut = region_detector.filter_lut(regions, marks.shape[0], threshold=100*marks.shape[0])
+    if track_lut is not None:
+        lut = lut[track_lut]
+    compact_path = target_dir + '/marks-compact.stack'
+    compact = np.memmap(compact_path, dtype=lut.dtype, mode='w+', shape=datas.shape)
+    region_detector.remap_marks(marks, lut, compact, slab_size)
+    del marks
+    table = region_detector.region_table(datas, compact)
     region_file = {
         'regions': regions,
-        'marks': marks
+        'marks': compact_labels(compact)
     }
     file_name = 'region' + '.bin'
     target_path = target_dir + '/' + file_name
     with open(target_path, "wb") as file:
         joblib.dump(region_file, file)
         print('build region file: ' + target_path)
+    del region_file, compact
+    if marks_path is not None:
+        os.remove(marks_path)
+    os.remove(compact_path)
+    return file_name, table
+
+
+# 按时间段计算4维连通区域，区域标记写入marks_path处的数据栈，返回区域和区域标记
+def label_regions(datas: np.ndarray, marks_path: str, slab_size: int, cache_dir: str = None,
+                  frame_deps: list[str] = None, workers: int = 1):
+    marks = np.memmap(marks_path, dtype=np.int32, mode='w+', shape=datas.shape)
+    labels = None
+    slab_cache = None
+    if cache_dir is not None:
+        # 只保留与本次划分一致且依赖没有变化的时间段，先写回缓存，避免中断后误用被覆盖的标记
+        ranges = region_detector.slab_ranges(datas.shape[0], slab_size)
+        slab_cache = {key: stats for key, stats in load_slab_cache(cache_dir, frame_deps).items() if key in ranges}
+        save_slab_cache(cache_dir, slab_cache, frame_deps)
+        print('slabs to label: ' + str(len(ranges) - len(slab_cache)) + '/' + str(len(ranges)))
+        labels = open_stack(cache_dir + '/labels.stack', datas.shape[0], datas.shape[1:], np.int32)
+    regions, marks = region_detector.calculate_region3d(datas, slab_size=slab_size, marks=marks, labels=labels,
+                                                        slab_cache=slab_cache, workers=workers)
+    if cache_dir is not None:
+        labels.flush()
+        save_slab_cache(cache_dir, slab_cache, frame_deps)
+        del labels
+    return regions, marks
+
+
+# 逐帧跟踪区域(见region_detector.RegionTracker)，每帧的临时标记写入tracks_path处的数据栈，内存占用与帧数无关
+# 指定cache_dir时跟踪器的状态保存在缓存中：已跟踪的帧的依赖都没有变化时(例如只在末尾增加了新帧)只跟踪新增的帧，
+# 否则从第一帧重新跟踪；返回区域、临时标记到区域编号的查找表以及临时标记
+def track_regions(datas: np.ndarray, tracks_path: str, cache_dir: str = None, frame_deps: list[str] = None):
+    tracker = None
+    state_path = cache_dir + '/tracker.bin' if cache_dir is not None else None
+    if state_path is not None and os.path.exists(state_path) and os.path.exists(tracks_path):
+        with open(state_path, 'rb') as file:
+            deps, tracker = joblib.load(file)
+        if tracker.frame_count > datas.shape[0] or deps != text_digest(*frame_deps[:tracker.frame_count]):
+            tracker = None
+    if tracker is None:
+        tracker = region_detector.RegionTracker()
+        if os.path.exists(tracks_path):
+            os.remove(tracks_path)
+    tracks = open_stack(tracks_path, datas.shape[0], datas.shape[1:], np.int32)
+    print('frames to track: ' + str(datas.shape[0] - tracker.frame_count) + '/' + str(datas.shape[0]))
+
+    for t in range(tracker.frame_count, datas.shape[0]):
+        tracks[t] = tracker.add_frame(datas[t])
+    tracks.flush()
+    if state_path is not None:
+        with open(state_path + '.tmp', 'wb') as file:
+            joblib.dump((text_digest(*frame_deps[:tracker.frame_count]), tracker), file)
+        os.replace(state_path + '.tmp', state_path)
+    regions, lut = tracker.regions()
+    return regions, lut, tracks
+
+
+# 预先计算每帧每个区域的拟合中心线，裁剪方式与可视化时不限制裁剪范围的region区域一致，返回文件名
+# 中心线点数不足以拟合的区域不保存，可视化时仍然实时计算
+def build_centerlines(target_dir: str, source, region_index: str, region_table: np.ndarray) -> str:
+    marks = joblib.load(target_dir + '/' + region_index, mmap_mode='r')['marks']
+    centerlines = {}
+    frame_id = -1
+    imaging = None
+    for row in region_table:
+        if row['frame'] != frame_id:
+            frame_id = int(row['frame'])
+            imaging = source.read_frame(frame_id).imaging
+        region_id = int(row['region'])
+        region_grid = decode_imaging(region_bounds_cut(imaging, marks[frame_id], region_id,
+                                                              [int(v) for v in row['bounds']]))
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', OptimizeWarning)
+                centerlines[(frame_id, region_id)] = fit_centerline(region_grid)
+        except (TypeError, ValueError, RuntimeError):
+            continue
+    del marks
+
+    target_path = target_dir + '/' + CENTERLINE_FILE
+    with open(target_path, 'wb') as file:
+        joblib.dump({'centerlines': centerlines}, file)
+        print('build centerline file: ' + target_path)
+    return CENTERLINE_FILE
+
+
+# 计算一帧中所有区域的doppler产品并写入文件，rows为该帧在区域统计表中的记录，可由进程池调用
+# source_args为创建数据帧来源的参数，该帧没有三维doppler数据时不生成文件，返回None
+def doppler_task(target_dir: str, source_args: tuple, region_index: str, rows: np.ndarray, file_name: str):
+    frame_id = int(rows['frame'][0])
+    frame = frame_source(target_dir, *source_args, dense=False).read_frame(frame_id)
+    if frame.doppler.dim != 3:
+        return None
+    mark = joblib.load(target_dir + '/' + region_index, mmap_mode='r')['marks'][frame_id]
+    products = {}
+    for row in rows:
+        region_id = int(row['region'])
+        imaging_cut = decode_imaging(region_bounds_cut(frame.imaging, mark, region_id,
+                                                              [int(v) for v in row['bounds']]))
+        try:
+            with warnings.catch_warnings(), np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                warnings.simplefilter('ignore', OptimizeWarning)
+                products[region_id] = doppler_products(imaging_cut, frame.doppler)
+        except (TypeError, ValueError, RuntimeError, IndexError):
+            continue
+    with open(target_dir + '/' + file_name, 'wb') as file:
+        joblib.dump(products, file)
     return file_name
 
-# 指定源路径和目标路径，自动完成数据构建
-def build_all(file_dir: str, target_dir: str):
-    frames = load_data(file_dir)
-    new_frames = interp_frames(frames)
-    for i in range(len(new_frames)):
-        new_frames[i].id = i
-    frame_index = build_frames(new_frames, target_dir)
-    datas = []
-    for i in range(len(new_frames)):
-        datas.append(new_frames[i].imaging.data)
-    datas = np.array(datas)
-    region_index = build_regions(datas, target_dir)
+
+# 预先计算每帧每个区域的doppler速度场、热通量场和H0，每帧一个文件，workers > 1 时由进程池并行计算
+# 返回与帧文件对应的产品文件名列表，没有产品的帧为None
+def build_doppler(target_dir: str, source_args: tuple, region_index: str, region_table: np.ndarray,
+                  file_names: list[str], workers: int = 1) -> list:
+    _, starts = np.unique(region_table['frame'], return_index=True)
+    tasks = [(target_dir, source_args, region_index, rows, file_names[int(rows['frame'][0])])
+             for rows in np.split(region_table, starts[1:]) if len(rows) > 0]
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(doppler_task, *zip(*tasks))) if tasks else []
+    else:
+        results = [doppler_task(*task) for task in tasks]
+    print('build doppler files: ' + str(sum(result is not None for result in results)))
+    built = set(result for result in results if result is not None)
+    return [file_name if file_name in built else None for file_name in file_names]
+
+
+# 删除不在keep中的doppler产品文件
+def remove_doppler_files(target_dir: str, keep: list = ()):
+    keep = set(keep)
+    for file_name in os.listdir(target_dir):
+        if file_name.startswith('doppler-') and file_name.endswith('.bin') and file_name not in keep:
+            os.remove(target_dir + '/' + file_name)
+
+
+# 时间段缓存的依赖：时间段内所有帧的依赖
+def slab_digest(frame_deps: list[str], t0: int, t1: int) -> str:
+    return text_digest(t0, t1, *frame_deps[t0:t1])
+
+
+# 读取时间段标记缓存，只保留依赖没有变化的时间段
+def load_slab_cache(cache_dir: str, frame_deps: list[str]) -> dict:
+    slab_cache = {}
+    cache_path = cache_dir + '/slabs.bin'
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as file:
+            cached = joblib.load(file)
+        for (t0, t1), (deps, stats) in cached.items():
+            if t1 <= len(frame_deps) and deps == slab_digest(frame_deps, t0, t1):
+                slab_cache[(t0, t1)] = stats
+    return slab_cache
+
+
+def save_slab_cache(cache_dir: str, slab_cache: dict, frame_deps: list[str]):
+    cache_path = cache_dir + '/slabs.bin'
+    cached = {key: (slab_digest(frame_deps, *key), stats) for key, stats in slab_cache.items()}
+    with open(cache_path + '.tmp', 'wb') as file:
+        joblib.dump(cached, file)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+# 写入index文件；使用打包格式时记录打包文件名，只保存关键帧时记录关键帧文件名和插值计划，
+# region_table为每帧的区域统计表，与index一同读取；centerline_index为预先计算的中心线文件名，
+# doppler_index为每帧的doppler产品文件名，pyramid为降采样数据帧的池化方式，各级数据帧与原始数据帧的文件名相同
+def write_index(target_dir: str, frame_index: list[str], region_index: str, frame_pack: str = None,
+                keyframe_index: list[str] = None, schedule: list[tuple] = None, region_table: np.ndarray = None,
+                centerline_index: str = None, doppler_index: list = None, pyramid: str = None):
     index_file = {
         'frame_files': frame_index,
         'region_file': region_index
     }
+    if frame_pack is not None:
+        index_file['frame_pack'] = frame_pack
+    if schedule is not None:
+        index_file['keyframe_files'] = keyframe_index
+        index_file['frame_schedule'] = schedule
+    if region_table is not None:
+        index_file['region_table'] = region_table
+    if centerline_index is not None:
+        index_file['centerline_file'] = centerline_index
+    if doppler_index is not None:
+        index_file['doppler_files'] = doppler_index
+    if pyramid is not None:
+        index_file['pyramid_levels'] = PYRAMID_LEVELS
+        index_file['pyramid_mode'] = pyramid
     index_path = target_dir + '/index.bin'
     with open(index_path, "wb") as file:
         joblib.dump(index_file, file)
         print('build index file: ' + index_path)
 
 
+# 任务的依赖：所有输入文件的内容hash，同时记录在任务的digests中
+def job_digest(manifest: BuildManifest, job: dict) -> str:
+    job['digests'] = {key: manifest.source_digest(job[key][1]) for key in GRID_KEYS if key in job}
+    return text_digest(*(key + ':' + job['digests'][key] for key in GRID_KEYS if key in job))
+
+
+# 读取已有打包文件中各帧的时间，文件不存在或损坏时返回None
+def pack_times(file_path: str):
+    if not os.path.exists(file_path):
+        return None
+    try:
+        _, meta = read_pack_index(file_path)
+    except (ValueError, OSError):
+        return None
+    return [frame['time_str'] for frame in meta['frames']]
+
+
+# 指定源路径、目标路径和构建选项(BuildOptions)，自动完成数据构建，以下为各选项的含义
+# 数据帧逐帧读取、插值并写入文件，内存中只保留少量数据帧，imaging数据保存在磁盘上的数据栈中
+# workers为并行读取和写入的进程/线程数，cadence为输出帧的间隔(分钟)，memory_budget为区域检测的内存预算(MB)
+# file_format为'pack'时所有数据帧写入同一个打包文件
+# 构建清单记录输入文件和每个输出帧的依赖，再次构建时只重新读取、插值和写入受影响的帧，
+# 区域检测只重新标记受影响的时间段；构建中断后，已完成的帧和阶段不会重复执行；rebuild时忽略构建清单
+# keyframes_only时只保存关键帧，中间帧只用于区域检测，读取时再由关键帧插值得到
+# centerlines时预先计算每帧每个区域的中心线，doppler时预先计算每帧每个区域的速度场和热通量，可视化时直接查找
+# quantize为log10强度的最大误差，指定时imaging保存为uint16编码；只保存关键帧时中间帧在读取时解码、插值后重新编码，
+# 因此编码步长减半，使插值帧的误差同样不超过quantize；区域检测仍使用未量化的数据
+# mat_cache为mat解析缓存目录，按文件内容hash保存解析结果，多次构建同一批数据时不再重复解析，为None时不使用缓存
+# 指定catalog_path时从目录索引中选取原始数据文件，file_dir不为空时先将其扫描进目录索引；
+# start和end为需要构建的帧时间范围(包含两端)，为None时不限制
+# pyramid为'max'或'mean'时同时保存2x/4x/8x降采样的数据帧，分别位于level-1/2/3目录中，格式与原始数据帧相同
+# bricks为块大小，指定时imaging以稀疏分块方式保存，中心线和doppler产品按区域只读取相交的块
+# 所有网格在读取后裁剪到imaging、doppler、diffuse的公共边界内并对齐到各自的采样点，roi不为空时再限制在roi内
+# tracking为True时逐帧跟踪区域，新增帧时只跟踪新增的帧
+def build_all(file_dir: str, target_dir: str, options: BuildOptions = None):
+    options = options if options is not None else BuildOptions()
+    params = {'input_dir': os.path.abspath(file_dir) if options.catalog_path is None else None,
+              'cadence': options.cadence, 'format': options.file_format, 'keyframes_only': options.keyframes_only,
+              'quantize': options.quantize, 'pyramid': options.pyramid, 'bricks': options.bricks,
+              'roi': list(options.roi) if options.roi is not None else None}
+    if options.catalog_path is not None:
+        params['catalog'] = os.path.abspath(options.catalog_path)
+    codec = None
+    if options.quantize is not None:
+        codec = log_codec(options.quantize / 2 if options.keyframes_only else options.quantize)
+    profiler = BuildProfiler()
+    with profiler.stage('plan'):
+        if options.catalog_path is not None:
+            if file_dir is not None:
+                print('scanned directories: ' + str(catalog.scan_catalog(options.catalog_path, [file_dir])))
+            jobs = catalog.select_jobs(options.catalog_path, options.start, options.end)
+        else:
+            jobs = [job for job in collect_jobs(file_dir)
+                    if (options.start is None or job['time_str'] >= options.start)
+                    and (options.end is None or job['time_str'] <= options.end)]
+        # 没有完整的帧时不修改输出目录
+        if not jobs:
+            raise SystemExit('no frames to build: no complete set of raw files found'
+                             + ('' if options.start is None and options.end is None else
+                                ' between ' + (options.start or 'the beginning')
+                                + ' and ' + (options.end or 'the end')))
+        manifest = BuildManifest(target_dir, params, options.rebuild)
+        key_times = [job['time_str'] for job in jobs]
+        key_digests = [job_digest(manifest, job) for job in jobs]
+        plan = frame_plan(key_times, key_digests, options.cadence)
+        frame_index = ['data-' + time_str + '.bin' for time_str, _, _ in plan]
+        frame_deps = [deps for _, deps, _ in plan]
+
+        # stored记录需要保存的帧及其保存序号
+        schedule = None
+        keyframe_index = None
+        stored = None
+        if options.keyframes_only:
+            schedule = keyframe_schedule(key_times, options.cadence)
+            stored = {i: entry[1] for i, entry in enumerate(schedule) if entry[2] < 0}
+            keyframe_index = [frame_index[i] for i in stored]
+
+        # 降采样数据帧的目录，不需要时删除
+        level_dirs = [level_dir(target_dir, level) for level in range(1, PYRAMID_LEVELS + 1)]
+        for dir_path in level_dirs:
+            if options.pyramid is None and os.path.isdir(dir_path):
+                shutil.rmtree(dir_path)
+            elif options.pyramid is not None:
+                os.makedirs(dir_path, exist_ok=True)
+        if options.pyramid is None:
+            level_dirs = []
+
+        # 删除不再需要的帧文件
+        stale_files = manifest.plan_frames({i: (time_str, deps) for i, (time_str, deps, _) in enumerate(plan)})
+        if stored is not None:
+            stale_files = stale_files + [frame_index[i] for i in range(len(plan)) if i not in stored]
+        for file_name in stale_files:
+            for dir_path in [target_dir] + level_dirs:
+                if (options.file_format == 'joblib' and file_name is not None
+                        and os.path.exists(dir_path + '/' + file_name)):
+                    os.remove(dir_path + '/' + file_name)
+
+        # 找出需要生成的帧，以及生成这些帧需要读取的关键帧
+        stack_path = manifest.cache_dir + '/imaging.stack'
+        frame_pack = PACK_FILE if options.file_format == 'pack' else None
+        old_times = pack_times(target_dir + '/' + frame_pack) if frame_pack is not None else None
+        level_times = [pack_times(dir_path + '/' + frame_pack) for dir_path in level_dirs] if frame_pack else []
+        if (manifest.stack is None or not os.path.exists(stack_path)
+                or (frame_pack is not None and old_times is None)
+                or any(times != old_times for times in level_times)):
+            manifest.reset_frames()
+        wanted = set()
+        for i in range(len(plan)):
+            done = manifest.frame_done(i)
+            if stored is not None and i not in stored:
+                pass
+            elif frame_pack is not None:
+                pack_id = stored[i] if stored is not None else i
+                done = done and pack_id < len(old_times) and old_times[pack_id] == plan[i][0]
+            else:
+                done = done and all(os.path.exists(dir_path + '/' + frame_index[i])
+                                    for dir_path in [target_dir] + level_dirs)
+            if not done:
+                wanted.add(i)
+        needed = set(k for i in wanted for k in plan[i][2])
+        print('frames to build: ' + str(len(wanted)) + '/' + str(len(plan)))
+
+    with profiler.stage('frames'):
+        # 各级降采样数据帧与原始数据帧的保存方式相同
+        packs = [None] * (len(level_dirs) + 1)
+        if frame_pack is not None:
+            kept = [i for i in range(len(plan)) if i not in wanted and (stored is None or i in stored)]
+            kept = [stored[i] if stored is not None else i for i in kept]
+            packs = [PackWriter(dir_path + '/' + frame_pack, kept) for dir_path in [target_dir] + level_dirs]
+            manifest.autosave = False
+        levels = [FrameOutput(dir_path, level_pack, stored, codec, options.bricks, profiler=profiler)
+                  for dir_path, level_pack in zip(level_dirs, packs[1:])]
+        output = FrameOutput(target_dir, packs[0], stored, codec, options.bricks, options.pyramid, levels, profiler)
+
+        pool = FramePool(QUEUE_SIZE + options.workers + 1) if options.workers > 1 else FramePool(1)
+        # 只重新生成部分帧时，新读取的关键帧需要与已有的帧位于同一网格上
+        reference = manifest.stack.get('layout') if manifest.stack is not None and len(wanted) < len(plan) else None
+        keyframes = check_keyframes(iter_keyframes(jobs, options.workers, needed, profiler, options.mat_cache,
+                                                   options.roi), reference)
+        frames = iter_frames(keyframes, options.cadence, pool, wanted, profiler)
+        first_frame = next(frames, None)
+        if first_frame is not None:
+            manifest.stack = {'shape': list(first_frame.imaging.data.shape),
+                              'dtype': first_frame.imaging.data.dtype.str, 'layout': frame_layout(first_frame)}
+            frames = itertools.chain([first_frame], frames)
+        stack = open_stack(stack_path, len(plan), manifest.stack['shape'], manifest.stack['dtype'])
+
+        try:
+            if options.workers > 1:
+                build_frames_pipeline(frames, output, options.workers, stack, pool, manifest)
+            else:
+                build_frames(frames, output, stack, pool, manifest)
+        finally:
+            # 清单分批保存，中断时也保存已经完成的帧，下次构建从中断处继续；打包文件在关闭前不保存
+            stack.flush()
+            if manifest.autosave:
+                manifest.save()
+        output.close()
+        manifest.save()
+
+    with profiler.stage('regions'):
+        region_index = 'region' + '.bin'
+        # 切换区域检测方式时重新检测区域；不跟踪时与之前的依赖相同，已有的数据集不需要重新检测
+        region_deps = text_digest(*frame_deps, 'tracking') if options.tracking else text_digest(*frame_deps)
+        table_path = manifest.cache_dir + '/' + REGION_TABLE_FILE
+        if (manifest.stage_done('regions', region_deps) and os.path.exists(target_dir + '/' + region_index)
+                and os.path.exists(table_path)):
+            print('region file is up to date')
+            region_table = np.load(table_path)
+        else:
+            region_index, region_table = build_regions(stack, target_dir, options.memory_budget, manifest.cache_dir,
+                                                       frame_deps, options.workers, options.tracking)
+            np.save(table_path, region_table)
+            manifest.record_stage('regions', region_deps)
+        del stack
+
+    source_args = (frame_index, frame_pack, keyframe_index, schedule)
+    with profiler.stage('centerlines'):
+        centerline_index = None
+        centerline_path = target_dir + '/' + CENTERLINE_FILE
+        if options.centerlines:
+            centerline_index = CENTERLINE_FILE
+            if manifest.stage_done('centerlines', region_deps) and os.path.exists(centerline_path):
+                print('centerline file is up to date')
+            else:
+                source = frame_source(target_dir, *source_args, dense=False)
+                build_centerlines(target_dir, source, region_index, region_table)
+                del source
+                manifest.record_stage('centerlines', region_deps)
+        elif os.path.exists(centerline_path):
+            os.remove(centerline_path)
+
+    with profiler.stage('doppler'):
+        doppler_index = None
+        if options.doppler:
+            doppler_names = ['doppler-' + time_str + '.bin' for time_str, _, _ in plan]
+            if manifest.stage_done('doppler', region_deps):
+                print('doppler files are up to date')
+                doppler_index = [name if os.path.exists(target_dir + '/' + name) else None
+                                 for name in doppler_names]
+            else:
+                remove_doppler_files(target_dir)
+                doppler_index = build_doppler(target_dir, source_args, region_index, region_table, doppler_names,
+                                              options.workers)
+                manifest.record_stage('doppler', region_deps)
+        else:
+            remove_doppler_files(target_dir)
+            manifest.reset_stage('doppler')
+
+    with profiler.stage('index'):
+        write_index(target_dir, frame_index, region_index, frame_pack, keyframe_index, schedule, region_table,
+                    centerline_index, doppler_index, options.pyramid)
+
+    profiler.save(target_dir, params)
+
+
 if __name__ == '__main__':
     args = get_parameters()
-    build_all(args.input_dir, args.output_dir)
-
+    build_all(args.input_dir, args.output_dir, build_options(args))
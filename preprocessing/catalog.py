@@ -0,0 +1,164 @@
+import os
+import re
+import sys
+import sqlite3
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from common.method import parse_time
+from preprocessing import load_from_mat
+
+
+# 两种命名方式的原始数据文件：
+#   2010-2015: APLUWCOVISMBSONAR001_20111001T000000.000Z-IMAGING.mat
+#   2018-2023: COVIS-20191024T000002-imaging1.mat
+# 同一小时内的imaging/doppler/diffuse文件组成一帧，帧时间为该小时的整点
+FILE_PATTERNS = {
+    'APLUW': re.compile(r'^APLUW\w*_(\d{8}T\d{2})(\d{4})\.\d+Z-(IMAGING|DOPPLER|DIFFUSE)\.mat$'),
+    'COVIS': re.compile(r'^COVIS-(\d{8}T\d{2})(\d{4})-(imaging|diffuse)\d*\.mat$')
+}
+
+# 每种命名方式的一帧需要的数据及其读取函数
+FRAME_LOADERS = {
+    'APLUW': {
+        'imaging': load_from_mat.load_imaging_from_mat_old,
+        'doppler': load_from_mat.load_doppler_from_mat,
+        'diffuse': load_from_mat.load_diffuse_from_mat_old
+    },
+    'COVIS': {
+        'imaging': load_from_mat.load_imaging_from_mat,
+        'diffuse': load_from_mat.load_diffuse_from_mat
+    }
+}
+
+CATALOG_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    scheme TEXT NOT NULL,
+    time_str TEXT NOT NULL,
+    acquired TEXT NOT NULL,
+    modality TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_time ON files (time_str);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+'''
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--catalog', '-g', required=True, help='path for the sqlite catalog file')
+    parser.add_argument('--input_dir', '-i', nargs='+', required=True, help='raw data directories to scan')
+    return parser.parse_args()
+
+
+# 解析原始数据文件名，返回(命名方式, 帧时间, 采集时间, 数据类型)，不是原始数据文件时返回None
+# 帧时间为 YYYYmmddTHH00，采集时间为 YYYYmmddTHHMMSS
+def parse_file_name(file_name: str):
+    for scheme, pattern in FILE_PATTERNS.items():
+        match = pattern.match(file_name)
+        if match is not None:
+            hour, rest, modality = match.groups()
+            return scheme, hour + '00', hour + rest, modality.lower()
+    return None
+
+
+# 将文件按帧时间配对，返回按时间排序的读取任务；entries为[(文件路径, 命名方式, 帧时间, 数据类型)]
+# 同一帧同一类型有多个文件时使用entries中靠前的文件，缺少任何一种数据的帧被忽略
+def pair_jobs(entries) -> list[dict]:
+    frames = {}
+    for file_path, scheme, time_str, modality in entries:
+        frame = frames.setdefault((time_str, scheme), {})
+        if modality not in frame:
+            frame[modality] = file_path
+
+    jobs = []
+    for (time_str, scheme), frame in sorted(frames.items()):
+        loaders = FRAME_LOADERS[scheme]
+        if all(modality in frame for modality in loaders):
+            job = {'time_str': time_str}
+            for modality, loader in loaders.items():
+                job[modality] = (loader, frame[modality])
+            jobs.append(job)
+    return jobs
+
+
+# 扫描单个目录中的原始数据文件，返回 [(文件路径, 命名方式, 帧时间, 数据类型)]，按采集时间和文件名排序
+def scan_dir(file_dir: str) -> list[tuple]:
+    entries = []
+    for file_name in os.listdir(file_dir):
+        parsed = parse_file_name(file_name)
+        if parsed is not None:
+            scheme, time_str, acquired, modality = parsed
+            entries.append((acquired, file_name, (file_dir + '/' + file_name, scheme, time_str, modality)))
+    return [entry for _, _, entry in sorted(entries)]
+
+
+def open_catalog(catalog_path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(catalog_path)
+    connection.executescript(CATALOG_SCHEMA)
+    return connection
+
+
+# 扫描原始数据目录(包括子目录，忽略以'.'开头的目录)并更新目录索引
+# 目录的修改时间没有变化时不再重新列出其中的文件，已经不存在的目录从索引中删除，返回重新扫描的目录数
+def scan_catalog(catalog_path: str, roots: list[str]) -> int:
+    connection = open_catalog(catalog_path)
+    scanned = 0
+    with connection:
+        known = dict(connection.execute('SELECT path, mtime FROM dirs'))
+        seen = set()
+        for root in roots:
+            for dir_path, dir_names, file_names in os.walk(os.path.abspath(root)):
+                dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+                seen.add(dir_path)
+                mtime = os.stat(dir_path).st_mtime_ns
+                if known.get(dir_path) == mtime:
+                    continue
+                connection.execute('DELETE FROM files WHERE dir = ?', (dir_path,))
+                rows = []
+                for file_name in file_names:
+                    parsed = parse_file_name(file_name)
+                    if parsed is None:
+                        continue
+                    file_path = dir_path + '/' + file_name
+                    stat = os.stat(file_path)
+                    rows.append((file_path, dir_path) + parsed + (stat.st_size, stat.st_mtime_ns))
+                connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+                connection.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?)', (dir_path, mtime))
+                scanned = scanned + 1
+        roots = [os.path.abspath(root) for root in roots]
+        for dir_path in known:
+            under_root = any(dir_path == root or dir_path.startswith(root + os.sep) for root in roots)
+            if under_root and dir_path not in seen:
+                connection.execute('DELETE FROM files WHERE dir = ?', (dir_path,))
+                connection.execute('DELETE FROM dirs WHERE path = ?', (dir_path,))
+    connection.close()
+    return scanned
+
+
+# 从目录索引中选取帧时间在[start, end]内的文件(时间格式为 YYYYmmddTHHMM，为None时不限制)，配对为读取任务
+def select_jobs(catalog_path: str, start: str = None, end: str = None) -> list[dict]:
+    if start is not None:
+        parse_time(start)
+    if end is not None:
+        parse_time(end)
+    connection = open_catalog(catalog_path)
+    rows = connection.execute('SELECT path, scheme, time_str, modality FROM files '
+                              'WHERE time_str >= ? AND time_str <= ? ORDER BY time_str, acquired, path',
+                              (start or '', end or '~')).fetchall()
+    connection.close()
+    return pair_jobs(rows)
+
+
+if __name__ == '__main__':
+    args = get_parameters()
+    count = scan_catalog(args.catalog, args.input_dir)
+    print('scanned directories: ' + str(count))
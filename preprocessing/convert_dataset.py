@@ -0,0 +1,51 @@
+import os
+import sys
+import joblib
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from common.frame_pack import PackWriter
+from common.frame_source import level_dir
+from preprocessing.builder import PACK_FILE, write_index
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_dir', '-i', required=True, help='path for a dataset built with joblib frame files')
+    parser.add_argument('--remove', '-r', action='store_true', help='remove joblib frame files after conversion')
+    return parser.parse_args()
+
+
+# 将已有的joblib数据集转换为打包格式：所有数据帧(只保存关键帧的数据集为所有关键帧)写入同一个打包文件，并更新index文件
+# 数据集包含降采样数据帧时，每一级分别转换
+def convert_dataset(file_dir: str, remove: bool = False):
+    with open(file_dir + '/index.bin', 'rb') as file:
+        index_file = joblib.load(file)
+    frame_index = index_file['frame_files']
+    stored_index = index_file.get('keyframe_files', frame_index)
+    dir_paths = [level_dir(file_dir, level) for level in range(index_file.get('pyramid_levels', 0) + 1)]
+
+    for dir_path in dir_paths:
+        with PackWriter(dir_path + '/' + PACK_FILE) as pack:
+            for frame_id, file_name in enumerate(stored_index):
+                with open(dir_path + '/' + file_name, 'rb') as file:
+                    frame = joblib.load(file)
+                frame.id = frame_id
+                pack.write_frame(frame)
+                print('pack frame: ' + file_name)
+        print('build pack file: ' + pack.file_path)
+
+    write_index(file_dir, frame_index, index_file['region_file'], PACK_FILE,
+                index_file.get('keyframe_files'), index_file.get('frame_schedule'), index_file.get('region_table'),
+                index_file.get('centerline_file'), index_file.get('doppler_files'), index_file.get('pyramid_mode'))
+
+    if remove:
+        for dir_path in dir_paths:
+            for file_name in stored_index:
+                os.remove(dir_path + '/' + file_name)
+
+
+if __name__ == '__main__':
+    args = get_parameters()
+    convert_dataset(args.input_dir, args.remove)
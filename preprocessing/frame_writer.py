@@ -0,0 +1,192 @@
+import time
+import queue
+import threading
+import numpy as np
+import joblib
+
+from common.entity import DataFrame, GRID_KEYS
+from common.method import log_ceiling, min_log_step, encode_grid, downsample_frame
+from common.frame_pack import PackWriter
+from common.bricks import brick_frame, grid_nbytes
+from preprocessing import profiler as build_profiler
+from preprocessing.profiler import BuildProfiler
+
+
+# 流水线构建时读取阶段和写入阶段之间的队列长度
+QUEUE_SIZE = 8
+
+
+# 数据帧的保存方式：target_dir为保存目录，pack不为None时写入打包文件，否则每帧一个joblib文件
+# stored为{帧编号: 保存序号}时只保存其中的帧，打包文件中按保存序号存放
+# codec不为None时imaging量化编码后保存，bricks(块大小)不为None时imaging以稀疏分块方式保存
+# pyramid(池化方式)不为None时，levels为各级降采样数据帧的保存方式，每一级由上一级降采样得到
+# profiler不为None时记录编码和写文件的性能
+class FrameOutput:
+    def __init__(self, target_dir: str, pack: PackWriter = None, stored: dict = None, codec: dict = None,
+                 bricks: int = None, pyramid: str = None, levels: list = (), profiler: BuildProfiler = None):
+        self.target_dir = target_dir
+        self.pack = pack
+        self.stored = stored
+        self.codec = codec
+        self.bricks = bricks
+        self.pyramid = pyramid
+        self.levels = list(levels)
+        self.profiler = profiler
+
+    # 关闭各级打包文件
+    def close(self):
+        for level in self.levels:
+            level.close()
+        if self.pack is not None:
+            self.pack.close()
+            print('build pack file: ' + self.pack.file_path)
+
+
+# 将单个数据帧按output写入文件，并返回文件名；写入打包文件时文件名仅用于显示，不需要保存的帧返回None
+# 传入的数据帧不变；appends不为空时不直接写入打包文件，而是将(打包文件, 数据帧, 保存序号, 文件名)按写入顺序加入appends，
+# 由调用者用append_frame写入
+def write_frame(frame: DataFrame, output: FrameOutput, appends: list = None) -> str:
+    profiler = output.profiler
+    if output.stored is not None and frame.id not in output.stored:
+        return None
+    coarse = frame
+    for level in output.levels:
+        with build_profiler.step(profiler, 'pyramid'):
+            coarse = downsample_frame(coarse, output.pyramid)
+        write_frame(coarse, level, appends)
+    if output.codec is not None:
+        with build_profiler.step(profiler, 'quantize'):
+            check_codec(frame, output.codec)
+            encoded = DataFrame()
+            encoded.id = frame.id
+            encoded.time_str = frame.time_str
+            for key in GRID_KEYS:
+                setattr(encoded, key, getattr(frame, key))
+            encoded.imaging = encode_grid(frame.imaging, output.codec)
+            frame = encoded
+    if output.bricks is not None:
+        with build_profiler.step(profiler, 'bricks'):
+            frame = brick_frame(frame, output.bricks)
+    file_name = 'data-' + frame.time_str + '.bin'
+    if output.pack is not None:
+        pack_id = output.stored[frame.id] if output.stored is not None else None
+        if appends is not None:
+            appends.append((output.pack, frame, pack_id, file_name))
+        else:
+            append_frame(output.pack, frame, pack_id, file_name, profiler)
+        return file_name
+    wall0, cpu0 = time.perf_counter(), time.thread_time()
+    target_path = output.target_dir + '/' + file_name
+    with open(target_path, "wb") as file:
+        joblib.dump(frame, file)
+        write_bytes = file.tell()
+        print('build file: ' + target_path)
+    if profiler is not None:
+        profiler.add_file(build_profiler.file_record('write', file_name, time.perf_counter() - wall0,
+                                                     time.thread_time() - cpu0, write_bytes=write_bytes))
+    return file_name
+
+
+# 将编码后的数据帧追加到打包文件，pack_id为保存序号(为None时使用frame.id)
+def append_frame(pack: PackWriter, frame: DataFrame, pack_id: int, file_name: str, profiler: BuildProfiler = None):
+    wall0, cpu0 = time.perf_counter(), time.thread_time()
+    pack.write_frame(frame, pack_id)
+    write_bytes = sum(grid_nbytes(getattr(frame, key)) for key in GRID_KEYS)
+    print('pack frame: ' + file_name)
+    if profiler is not None:
+        profiler.add_file(build_profiler.file_record('write', file_name, time.perf_counter() - wall0,
+                                                     time.thread_time() - cpu0, write_bytes=write_bytes))
+
+
+# 检查imaging的最大值在编码范围内，超出时编码被截断，保存的数据不再满足误差要求
+# 错误信息中的误差按-q的含义给出(只保存关键帧时步长减半，见builder.build_all)
+def check_codec(frame: DataFrame, codec: dict):
+    max_value = float(np.max(frame.imaging.data)) if frame.imaging.data.size > 0 else 0.0
+    if max_value > codec['floor'] and np.log10(max_value) > log_ceiling(codec):
+        raise ValueError('imaging of frame ' + frame.time_str + ' exceeds the quantization range: max log10 '
+                         + format(np.log10(max_value), '.3f') + ' > ' + format(log_ceiling(codec), '.3f')
+                         + '; the given --quantize/-q error is too small for this data, use at least '
+                         + format(min_log_step(max_value, codec['floor']) / 2, '.3g') + ' (twice that with -k)')
+
+
+# 逐帧构建数据帧文件，同时写入imaging数据栈，并返回文件名列表
+# pool不为None时写入后将数据帧归还缓冲池，manifest不为None时记录每个完成的帧
+def build_frames(frames, output: FrameOutput, stack=None, pool=None, manifest=None) -> list[str]:
+    frame_index = []
+    for frame in frames:
+        if stack is not None:
+            with build_profiler.step(output.profiler, 'stack'):
+                stack[frame.id] = frame.imaging.data
+        file_name = write_frame(frame, output)
+        if file_name is not None:
+            frame_index.append(file_name)
+        if manifest is not None:
+            manifest.record_frame(frame.id, file_name)
+        if pool is not None:
+            pool.release(frame)
+    return frame_index
+
+
+# 以流水线方式构建数据帧文件：读取和插值在当前线程进行，编码和写文件由workers个线程并行完成，
+# 两个阶段通过有界队列连接，返回文件名列表
+# 打包文件中数据帧的位置取决于追加顺序，因此各线程编码后按帧进入队列的顺序依次追加，结果与串行构建完全一致
+def build_frames_pipeline(frames, output: FrameOutput, workers: int, stack=None, pool=None,
+                          manifest=None) -> list[str]:
+    frame_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    file_names = {}
+    errors = []
+    turn = threading.Condition()
+    next_seq = [0]
+
+    def write_stage():
+        while True:
+            item = frame_queue.get()
+            if item is None:
+                break
+            seq, frame = item
+            appends = [] if output.pack is not None else None
+            file_name = None
+            try:
+                if not errors:
+                    file_name = write_frame(frame, output, appends)
+            except Exception as e:
+                errors.append(e)
+            # 轮到该帧时追加到打包文件，出错时也要让出顺序，避免其他线程一直等待
+            with turn:
+                turn.wait_for(lambda: next_seq[0] == seq)
+                try:
+                    if not errors:
+                        for entry in appends or []:
+                            append_frame(*entry, output.profiler)
+                        if file_name is not None:
+                            file_names[frame.id] = file_name
+                        if manifest is not None:
+                            manifest.record_frame(frame.id, file_name)
+                except Exception as e:
+                    errors.append(e)
+                next_seq[0] = seq + 1
+                turn.notify_all()
+            if pool is not None:
+                pool.release(frame)
+
+    writers = [threading.Thread(target=write_stage) for _ in range(workers)]
+    for writer in writers:
+        writer.start()
+
+    try:
+        for seq, frame in enumerate(frames):
+            if errors:
+                break
+            if stack is not None:
+                with build_profiler.step(output.profiler, 'stack'):
+                    stack[frame.id] = frame.imaging.data
+            frame_queue.put((seq, frame))
+    finally:
+        for _ in writers:
+            frame_queue.put(None)
+        for writer in writers:
+            writer.join()
+    if errors:
+        raise errors[0]
+
+    return [file_names[i] for i in sorted(file_names)]
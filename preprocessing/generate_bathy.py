@@ -1,57 +1,134 @@
+import os
+import sys
 import numpy as np
 import joblib
-from scipy.interpolate import interpn
+import argparse
+from scipy.spatial import cKDTree
 
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+
+from common.resample import resample_linear
+
+
+def get_parameters():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', '-i', default='../res/bathy/filtered_data_all.npy', help='path for bathymetry points (x, y, z)')
+    parser.add_argument('--output', '-o', default='../res/bathy/bathy-2010To2015.bin', help='path for output seabed file')
+    parser.add_argument('--extent', '-e', type=float, nargs=4, default=[-41, 9, -38, 12], metavar=('X0', 'X1', 'Y0', 'Y1'),
+                        help='range of points to grid, grid nodes start at X0, Y0')
+    parser.add_argument('--resolution', '-r', type=float, default=1.0, help='grid spacing before upsampling')
+    parser.add_argument('--kernel', '-k', choices=['corner', 'bilinear', 'idw', 'nearest'], default='corner',
+                        help='how points are spread to grid nodes')
+    parser.add_argument('--neighbors', type=int, default=8, help='number of neighbors for idw')
+    parser.add_argument('--power', type=float, default=2.0, help='distance power for idw')
+    parser.add_argument('--radius', type=float, default=None, help='search radius for idw/nearest (default 2 * resolution)')
+    parser.add_argument('--scale', '-s', type=int, default=2, help='upsampling factor of the output grid')
+    parser.add_argument('--z_offset', type=float, default=1.0, help='value added to gridded depth')
+    parser.add_argument('--bounds', '-b', type=float, nargs=4, default=[-40, 10, -40, 10], metavar=('X0', 'X1', 'Y0', 'Y1'),
+                        help='bounds written to the seabed file')
+    return parser.parse_args()
+
+
+# 二维数据线性重采样
 def scale_data(data, target_size):
-    size = data.shape
-    x1 = np.linspace(0, size[0] - 1, size[0])
-    x2 = np.linspace(0, size[1] - 1, size[1])
-    points = (x1, x2)
+    return resample_linear(data, target_size)
 
-    x1_new = np.linspace(0, size[0] - 1, target_size[0])
-    x2_new = np.linspace(0, size[1] - 1, target_size[1])
-    xx, yy = np.meshgrid(x1_new, x2_new, indexing='ij')
-    new_points = np.array([xx, yy]).T
 
-    result = interpn(points, data, new_points, bounds_error=False, fill_value=True).transpose(1, 0)
-    return result
+# 网格节点数：extent范围内按resolution间隔的节点
+def grid_shape(extent, resolution) -> tuple:
+    return (int(round((extent[1] - extent[0]) / resolution)) + 1,
+            int(round((extent[3] - extent[2]) / resolution)) + 1)
 
 
-if __name__ == '__main__':
-    with open('../res/bathy/filtered_data_all.npy', 'rb') as file:
-        points = joblib.load(file)
-        data = np.zeros((51, 51))
-        weight = np.zeros((51, 51))
-    for p in points:
-        #if -44 < p[0] < 6 and -38 < p[1] < 12:
-        if -41 < p[0] < 9 and -38 < p[1] < 12:
-            print(p)
-            x = (p[0] + 41)
-            y = (p[1] + 38)
-            z = p[2]
-            ii = [
-                int(np.floor(x)),
-                int(np.ceil(x))
-            ]
-            jj = [
-                int(np.floor(y)),
-                int(np.ceil(y))
-            ]
-            for i in range(len(ii)):
-                wx = 1 - abs(ii[i] - x)
-                for j in range(len(jj)):
-                    wy = 1 - abs(jj[j] - y)
-                    w = np.sqrt(wx**2 + wy**2)
-                    data[ii[i]][jj[j]] = data[ii[i]][jj[j]] + w*z
-                    weight[ii[i]][jj[j]] = weight[ii[i]][jj[j]] + w
+# 将散点累加到网格节点上，返回加权值之和与权重之和
+# corner: 每个点累加到floor/ceil组成的四个节点，权重为sqrt(wx^2 + wy^2)，坐标为整数时同一节点会被累加两次
+# bilinear: 双线性权重wx * wy
+# idw: 每个节点取半径内最近的neighbors个点，按距离的-power次方加权
+# nearest: 每个节点取半径内最近的一个点
+def grid_points(points: np.ndarray, extent, resolution: float = 1.0, kernel: str = 'corner', neighbors: int = 8,
+                power: float = 2.0, radius: float = None):
+    shape = grid_shape(extent, resolution)
+    inside = (extent[0] < points[:, 0]) & (points[:, 0] < extent[1]) & \
+             (extent[2] < points[:, 1]) & (points[:, 1] < extent[3])
+    x = (points[inside, 0] - extent[0]) / resolution
+    y = (points[inside, 1] - extent[2]) / resolution
+    z = points[inside, 2]
+
+    if kernel in ('corner', 'bilinear'):
+        x0 = np.floor(x).astype(np.intp)
+        y0 = np.floor(y).astype(np.intp)
+        if kernel == 'corner':
+            xs = [x0, np.ceil(x).astype(np.intp)]
+            ys = [y0, np.ceil(y).astype(np.intp)]
+        else:
+            xs = [x0, np.minimum(x0 + 1, shape[0] - 1)]
+            ys = [y0, np.minimum(y0 + 1, shape[1] - 1)]
+        index = []
+        weights = []
+        for ii in xs:
+            wx = 1 - np.abs(ii - x)
+            for jj in ys:
+                wy = 1 - np.abs(jj - y)
+                index.append(ii * shape[1] + jj)
+                weights.append(np.sqrt(wx ** 2 + wy ** 2) if kernel == 'corner' else wx * wy)
+        index = np.concatenate(index)
+        weights = np.concatenate(weights)
+        data = np.bincount(index, weights * np.tile(z, 4), minlength=shape[0] * shape[1]).reshape(shape)
+        weight = np.bincount(index, weights, minlength=shape[0] * shape[1]).reshape(shape)
+        return data, weight
+
+    if radius is None:
+        radius = 2 * resolution
+    radius = radius / resolution
+    nodes = np.stack(np.meshgrid(np.arange(shape[0]), np.arange(shape[1]), indexing='ij'), axis=-1).reshape(-1, 2)
+    tree = cKDTree(np.stack([x, y], axis=1))
+    k = 1 if kernel == 'nearest' else neighbors
+    distances, indices = tree.query(nodes, k=k, distance_upper_bound=radius)
+    distances = distances.reshape(len(nodes), k)
+    indices = indices.reshape(len(nodes), k)
+    found = np.isfinite(distances)
+    values = np.zeros(distances.shape)
+    values[found] = z[indices[found]]
+
+    if kernel == 'nearest':
+        weights = found.astype(np.float64)
+    else:
+        weights = np.zeros(distances.shape)
+        with np.errstate(divide='ignore'):
+            weights[found] = 1 / distances[found] ** power
+        # 与节点重合的点直接取其值
+        exact = found & (distances == 0)
+        hit = exact.any(axis=1)
+        weights[hit] = exact[hit].astype(np.float64)
+    data = (weights * values).sum(axis=1).reshape(shape)
+    weight = weights.sum(axis=1).reshape(shape)
+    return data, weight
+
+
+# 由散点生成海底地形网格，网格按scale倍线性上采样，返回read_seabed读取的字典
+def generate_bathy(points: np.ndarray, extent, resolution: float = 1.0, kernel: str = 'corner', scale: int = 2,
+                   z_offset: float = 1.0, bounds=None, **kernel_args) -> dict:
+    data, weight = grid_points(points, extent, resolution, kernel, **kernel_args)
     weight[weight == 0] = 1
-    data = data / weight + 1
-    data = scale_data(data, (101, 101))
+    data = data / weight + z_offset
+    data = scale_data(data, ((data.shape[0] - 1) * scale + 1, (data.shape[1] - 1) * scale + 1))
 
+    if bounds is None:
+        bounds = [extent[0], extent[0] + (data.shape[0] - 1) * resolution / scale,
+                  extent[2], extent[2] + (data.shape[1] - 1) * resolution / scale]
     bathy = {
         'data': data,
-        'bounds': [-40, 10, -40, 10, 0, 0],
-        'spacing': [0.5, 0.5]
+        'bounds': list(bounds) + [0, 0],
+        'spacing': [resolution / scale, resolution / scale]
     }
-    with open('../res/bathy/bathy-2010To2015.bin', "wb") as file:
-        joblib.dump(bathy, file)
\ No newline at end of file
+    return bathy
+
+
+if __name__ == '__main__':
+    args = get_parameters()
+    with open(args.input, 'rb') as file:
+        points = joblib.load(file)
+    bathy = generate_bathy(np.asarray(points), args.extent, args.resolution, args.kernel, args.scale, args.z_offset,
+                           args.bounds, neighbors=args.neighbors, power=args.power, radius=args.radius)
+    with open(args.output, "wb") as file:
+        joblib.dump(bathy, file)
@@ -1,13 +1,22 @@
+import os
+import numpy as np
 import scipy.io as sio
 
 from common.entity import UniformGrid
-from common.method import scale_data3d
+from preprocessing.manifest import file_digest
+
+
+# 各读取函数只读取需要的顶层变量；scipy总是完整解析一个变量，因此2010-2015年的数据(所有内容都在covis结构中)
+# 以及diffuse(包含所有类型的网格)不会因此变快，只能通过load_cached的解析缓存避免重复解析
+
+# 解析结果缓存的版本，读取函数的输出发生变化时需要增加
+MAT_CACHE_VERSION = 2
 
 
 # 从2018-2023年预处理后的mat文件中读取imaging数据
 def load_imaging_from_mat(file_path: str, data_type: str = 'Id_filt') -> UniformGrid:
     image = UniformGrid()
-    data = sio.loadmat(file_path)
+    data = sio.loadmat(file_path, variable_names=['imaging'])
     covis = data['imaging'][0][0]
     grid = covis['grid'][0][0]
     bounds = grid['axis'][0]
@@ -22,7 +31,7 @@ def load_imaging_from_mat(file_path: str, data_type: str = 'Id_filt') -> Uniform
 # 从2018-2023年预处理后的mat文件中读取diffuse数据
 def load_diffuse_from_mat(file_path: str, diffuse_type: str = 'decorrelation intensity') -> UniformGrid:
     diffuse = UniformGrid()
-    data = sio.loadmat(file_path)
+    data = sio.loadmat(file_path, variable_names=['diffuse'])
     covis = data['diffuse'][0][0]
     grids = covis['grid'][0]
     for grid in grids:
@@ -38,7 +47,7 @@ def load_diffuse_from_mat(file_path: str, diffuse_type: str = 'decorrelation int
 # 从2010-2015年预处理后的mat文件中读取imaging数据
 def load_imaging_from_mat_old(file_path: str) -> UniformGrid:
     image = UniformGrid()
-    data = sio.loadmat(file_path)
+    data = sio.loadmat(file_path, variable_names=['covis'])
     covis = data['covis'][0][0]
     grid = covis['grid'][0][0]
     bounds = grid['axis'][0]
@@ -49,19 +58,16 @@ def load_imaging_from_mat_old(file_path: str) -> UniformGrid:
     image.dim = 3
     return image
 
-# 从2010-2015年预处理后的mat文件中读取doppler数据
+# 从2010-2015年预处理后的mat文件中读取doppler数据，保持声纳的原始分辨率
 def load_doppler_from_mat(file_path: str) -> UniformGrid:
     doppler = UniformGrid()
-    data = sio.loadmat(file_path)
+    data = sio.loadmat(file_path, variable_names=['covis'])
     covis = data['covis'][0][0]
     grid = covis['grid'][0][0][0][0]
     bounds = grid['axis'][0]
     spacing = grid['spacing'][0][0]
-    spacing = [spacing[0][0][0]/2, spacing[1][0][0]/2, spacing[2][0][0]/2]
-    old_size = grid['v_filt'].shape
-    new_size = ((old_size[0]-1)*2+1, (old_size[1]-1)*2+1, (old_size[2]-1)*2+1)
-    new_data = scale_data3d(grid['v_filt'], new_size)
-    doppler.data = new_data.transpose(1, 0, 2)
+    spacing = [spacing[0][0][0], spacing[1][0][0], spacing[2][0][0]]
+    doppler.data = grid['v_filt'].transpose(1, 0, 2)
     doppler.bounds = bounds
     doppler.spacing = spacing
     doppler.dim = 3
@@ -71,7 +77,7 @@ def load_doppler_from_mat(file_path: str) -> UniformGrid:
 # 从2010-2015年预处理后的mat文件中读取diffuse数据
 def load_diffuse_from_mat_old(file_path: str) -> UniformGrid:
     diffuse = UniformGrid()
-    data = sio.loadmat(file_path)
+    data = sio.loadmat(file_path, variable_names=['covis'])
     covis = data['covis'][0][0]
     grid = covis['grid'][0][0][0][0]
     bounds = grid['axis'][0]
@@ -82,3 +88,39 @@ def load_diffuse_from_mat_old(file_path: str) -> UniformGrid:
     diffuse.spacing = spacing
     diffuse.dim = 2
     return diffuse
+
+
+# 解析结果缓存文件：按mat文件内容的hash和读取函数命名
+def cache_path(cache_dir: str, loader, digest: str) -> str:
+    return cache_dir + '/' + digest + '-' + loader.__name__ + '-v' + str(MAT_CACHE_VERSION) + '.npz'
+
+
+# 读取mat文件，cache_dir不为空时解析结果保存在缓存中，内容相同的mat文件再次读取时直接加载缓存，不再解析
+# digest为mat文件内容的sha1，为空时重新计算；缓存目录不可写时只读取不缓存
+def load_cached(loader, file_path: str, cache_dir: str = None, digest: str = None) -> UniformGrid:
+    if cache_dir is None:
+        return loader(file_path)
+    if digest is None:
+        digest = file_digest(file_path)
+    path = cache_path(cache_dir, loader, digest)
+    if os.path.exists(path):
+        with np.load(path) as cached:
+            grid = UniformGrid()
+            grid.data = cached['data']
+            grid.bounds = cached['bounds']
+            grid.spacing = list(cached['spacing'])
+            grid.dim = int(cached['dim'])
+            return grid
+
+    grid = loader(file_path)
+    if grid.dim == 0:
+        return grid
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as file:
+            np.savez(file, data=grid.data, bounds=grid.bounds, spacing=np.array(grid.spacing), dim=grid.dim)
+        os.replace(temp_path, path)
+    except OSError:
+        pass
+    return grid
@@ -0,0 +1,139 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+CACHE_DIR = '.build'
+
+# 自动保存时每完成SAVE_FRAMES帧或经过SAVE_SECONDS秒保存一次清单，避免每帧重写整个清单；
+# 中断时最多重新生成最近一次保存之后完成的帧
+SAVE_FRAMES = 64
+SAVE_SECONDS = 10.0
+
+
+# 计算文件内容的sha1
+def file_digest(file_path: str, chunk_size: int = 1 << 20) -> str:
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+# 计算若干个值的sha1，用于记录输出数据依赖的输入
+def text_digest(*parts) -> str:
+    return hashlib.sha1('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+
+# 先写入临时文件再替换，保证中断时不会留下不完整的文件
+def save_json(file_path: str, data):
+    temp_path = file_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, file_path)
+
+
+# 构建清单：记录输入文件(大小, 修改时间, 内容hash)、每个输出帧依赖的输入，以及已经完成的构建阶段
+# 参数(params)与上次构建不同时清单作废，重新进行完整构建
+class BuildManifest:
+    def __init__(self, target_dir: str, params: dict, rebuild: bool = False):
+        self.file_path = target_dir + '/' + MANIFEST_FILE
+        self.cache_dir = target_dir + '/' + CACHE_DIR
+        self.lock = threading.Lock()
+        self.autosave = True
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        data = None
+        if not rebuild and os.path.exists(self.file_path):
+            with open(self.file_path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            if data.get('version') != MANIFEST_VERSION or data.get('params') != params:
+                data = None
+        if data is None:
+            data = {'sources': {}, 'frames': {}, 'stages': {}, 'stack': None}
+
+        self.params = params
+        self.sources = data['sources']
+        self.frames = data['frames']
+        self.stages = data['stages']
+        self.stack = data['stack']
+        self.expected = {}
+
+    # 文件大小和修改时间都没有变化时沿用记录的hash，否则重新计算
+    def source_digest(self, file_path: str) -> str:
+        stat = os.stat(file_path)
+        name = os.path.basename(file_path)
+        record = self.sources.get(name)
+        if record is None or record['size'] != stat.st_size or record['mtime'] != stat.st_mtime_ns:
+            record = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': file_digest(file_path)}
+            self.sources[name] = record
+        return record['hash']
+
+    # 设置本次构建中每一帧的期望依赖 {帧编号: (时间, 依赖)}，删除不再需要的帧记录并返回其文件名
+    def plan_frames(self, plan: dict) -> list[str]:
+        self.expected = plan
+        times = set(time_str for time_str, _ in plan.values())
+        stale_files = []
+        for time_str in list(self.frames.keys()):
+            if time_str not in times:
+                stale_files.append(self.frames.pop(time_str)['file'])
+        return stale_files
+
+    # 帧记录中的编号和依赖都与本次构建一致时，该帧无需重新生成
+    def frame_done(self, frame_id: int) -> bool:
+        time_str, deps = self.expected[frame_id]
+        record = self.frames.get(time_str)
+        return record is not None and record['id'] == frame_id and record['deps'] == deps
+
+    def record_frame(self, frame_id: int, file_name: str):
+        with self.lock:
+            time_str, deps = self.expected[frame_id]
+            self.frames[time_str] = {'id': frame_id, 'file': file_name, 'deps': deps}
+            self.unsaved = self.unsaved + 1
+            if self.autosave and (self.unsaved >= SAVE_FRAMES or time.monotonic() - self.saved_at >= SAVE_SECONDS):
+                self.save_locked()
+
+    def reset_frames(self):
+        with self.lock:
+            self.frames.clear()
+            self.stages.clear()
+
+    def stage_done(self, stage: str, deps: str) -> bool:
+        return self.stages.get(stage) == deps
+
+    def record_stage(self, stage: str, deps: str):
+        with self.lock:
+            self.stages[stage] = deps
+            self.save_locked()
+
+    def reset_stage(self, stage: str):
+        with self.lock:
+            if self.stages.pop(stage, None) is not None:
+                self.save_locked()
+
+    def save(self):
+        with self.lock:
+            self.save_locked()
+
+    def save_locked(self):
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        save_json(self.file_path, {
+            'version': MANIFEST_VERSION,
+            'params': self.params,
+            'sources': self.sources,
+            'frames': self.frames,
+            'stages': self.stages,
+            'stack': self.stack
+        })
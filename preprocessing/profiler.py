@@ -0,0 +1,172 @@
+import os
+import time
+import json
+import threading
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+REPORT_FILE = 'build_report.json'
+
+
+# 当前进程及已结束子进程的CPU时间(秒)
+def cpu_time() -> float:
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+# 当前进程通过read/write系统调用读写的字节数，不支持时返回(0, 0)
+def io_counters() -> tuple:
+    try:
+        with open('/proc/self/io', 'r') as file:
+            counters = dict(line.split(':') for line in file.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+# 重置当前进程的内存峰值(VmHWM)，不支持时峰值从进程启动开始计算
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+# 当前进程的内存峰值(字节)，不支持时返回None
+def peak_rss():
+    try:
+        with open('/proc/self/status', 'r') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return None
+
+
+# 单个文件的性能记录，可在进程池中生成后返回给主进程
+def file_record(step: str, file_path: str, wall: float, cpu: float, read_bytes: int = 0, write_bytes: int = 0) -> dict:
+    return {
+        'step': step,
+        'file': os.path.basename(file_path),
+        'wall': wall,
+        'cpu': cpu,
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes,
+        'peak_rss': peak_rss(),
+        'pid': os.getpid()
+    }
+
+
+# profiler为None时不记录
+def step(profiler, name: str):
+    return profiler.step(name) if profiler is not None else nullcontext()
+
+
+def format_bytes(size) -> str:
+    if size is None:
+        return '-'
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return '{:.1f}{}'.format(size, unit) if unit != 'B' else '{}B'.format(size)
+        size = size / 1024
+
+
+# 构建过程的性能记录
+# stage为依次执行的构建阶段，记录墙上时间、CPU时间(含已结束的子进程)、读写字节数和内存峰值；
+# step为阶段内多次交替执行的步骤(读取mat、插值、写文件等)，累计墙上时间和线程CPU时间，可由多个线程同时调用；
+# 文件记录为每个输入/输出文件的读写耗时，进程池中读取的文件的字节数计入所在阶段
+class BuildProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_time()
+        self.stages = []
+        self.steps = {}
+        self.files = []
+
+    @contextmanager
+    def stage(self, name: str):
+        reset_peak_rss()
+        first_file = len(self.files)
+        wall0, cpu0, io0 = time.perf_counter(), cpu_time(), io_counters()
+        try:
+            yield
+        finally:
+            io1 = io_counters()
+            remote = [record for record in self.files[first_file:] if record['pid'] != os.getpid()]
+            self.stages.append({
+                'name': name,
+                'wall': time.perf_counter() - wall0,
+                'cpu': cpu_time() - cpu0,
+                'read_bytes': io1[0] - io0[0] + sum(record['read_bytes'] for record in remote),
+                'write_bytes': io1[1] - io0[1] + sum(record['write_bytes'] for record in remote),
+                'peak_rss': peak_rss()
+            })
+
+    @contextmanager
+    def step(self, name: str):
+        wall0, cpu0 = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add_step(name, time.perf_counter() - wall0, time.thread_time() - cpu0)
+
+    def add_step(self, name: str, wall: float, cpu: float, read_bytes: int = 0, write_bytes: int = 0):
+        with self.lock:
+            entry = self.steps.setdefault(name, {'count': 0, 'wall': 0.0, 'cpu': 0.0, 'read_bytes': 0,
+                                                 'write_bytes': 0})
+            entry['count'] += 1
+            entry['wall'] += wall
+            entry['cpu'] += cpu
+            entry['read_bytes'] += read_bytes
+            entry['write_bytes'] += write_bytes
+
+    def add_file(self, record: dict):
+        self.add_step(record['step'], record['wall'], record['cpu'], record['read_bytes'], record['write_bytes'])
+        with self.lock:
+            self.files.append(record)
+
+    def report(self) -> dict:
+        return {
+            'total': {'wall': time.perf_counter() - self.start_wall, 'cpu': cpu_time() - self.start_cpu,
+                      'peak_rss': max((stage['peak_rss'] or 0 for stage in self.stages), default=0)},
+            'stages': self.stages,
+            'steps': self.steps,
+            'files': self.files
+        }
+
+    # 打印各阶段和各步骤的汇总表
+    def print_summary(self, report: dict):
+        row = '{:<14}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'
+        print(row.format('stage', 'count', 'wall(s)', 'cpu(s)', 'read', 'write', 'peak rss'))
+        for stage in report['stages']:
+            print(row.format(stage['name'], '', '{:.2f}'.format(stage['wall']), '{:.2f}'.format(stage['cpu']),
+                             format_bytes(stage['read_bytes']), format_bytes(stage['write_bytes']),
+                             format_bytes(stage['peak_rss'])))
+        for name, entry in report['steps'].items():
+            print(row.format('  ' + name, entry['count'], '{:.2f}'.format(entry['wall']),
+                             '{:.2f}'.format(entry['cpu']), format_bytes(entry['read_bytes']),
+                             format_bytes(entry['write_bytes']), ''))
+        total = report['total']
+        print(row.format('total', '', '{:.2f}'.format(total['wall']), '{:.2f}'.format(total['cpu']), '', '',
+                         format_bytes(total['peak_rss'])))
+
+    # 打印汇总表并将报告写入目标目录
+    def save(self, target_dir: str, params: dict = None) -> str:
+        report = self.report()
+        report['params'] = params
+        self.print_summary(report)
+        report_path = target_dir + '/' + REPORT_FILE
+        with open(report_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=1)
+        print('build report file: ' + report_path)
+        return report_path
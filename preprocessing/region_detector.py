@@ -1,83 +1,362 @@
+import mmap
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import queue
+from scipy import ndimage
 
+from common.entity import Region, REGION_TABLE_DTYPE
 
-from common.entity import Region
 
+# 4维(时间, x, y, z)区域的邻接结构：只有坐标在一个维度上相差1的体素相邻，共8个邻居
+STRUCTURE4D = ndimage.generate_binary_structure(4, 1)
 
-def calculate_region3d(datas, threshold=1e-6, interval=4):
-    region_group = []
-    size = datas.shape
-    marks = np.zeros(size, np.int32)
 
-    # 3维区域扩散
-    def region_growing3d(region_id, seed, th=threshold):
-        que = queue.Queue()
-        que.put(seed)
-        marks[seed] = -1
+# 每个体素在分段标记时大约占用的内存(字节)：阈值掩码、int32标记以及统计时的临时数组
+BYTES_PER_VOXEL = 16
+
+
+# 根据内存预算(字节)计算每个时间段包含的帧数
+def slab_frames(shape, memory_budget) -> int:
+    frame_voxels = int(np.prod(shape[1:]))
+    return max(1, int(memory_budget // (frame_voxels * BYTES_PER_VOXEL)))
+
+
+# 按slab_size帧划分时间段，返回[(t0, t1)]
+def slab_ranges(frame_count: int, slab_size: int) -> list[tuple]:
+    return [(t0, min(t0 + slab_size, frame_count)) for t0 in range(0, frame_count, slab_size)]
+
+
+# 并查集，用于合并被时间段边界或帧边界分开的连通分量
+class UnionFind:
+    def __init__(self, size):
+        self.parent = list(range(size))
+
+    # 增加count个单独的元素，返回第一个新元素
+    def add(self, count):
+        first = len(self.parent)
+        self.parent.extend(range(first, first + count))
+        return first
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    # 返回每个元素所在集合的根
+    def roots(self):
+        parent = np.asarray(self.parent, np.int64)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                return parent
+            parent = grand
+
+
+# 对从第t0帧开始的时间段block进行连通分量标记
+# 返回局部标记(从1开始)以及每个标记的体素数量、4维包围盒和第一个种子点的全局遍历序号(没有种子点时为-1)
+def label_slab(block, t0, threshold=1e-6, interval=4):
+    labels, count = ndimage.label(np.asarray(block) > threshold, structure=STRUCTURE4D)
+
+    counts = np.bincount(labels.ravel(), minlength=count + 1)[1:]
+    bounds = np.zeros((count, 8), np.int64)
+    for i, slices in enumerate(ndimage.find_objects(labels)):
+        for axis in range(4):
+            bounds[i, axis * 2] = slices[axis].start
+            bounds[i, axis * 2 + 1] = slices[axis].stop - 1
+    bounds[:, 0:2] += t0
+
+    # 种子点按(h, i, j, k)顺序遍历，时间段内的遍历序号加上之前所有帧的种子点数即为全局序号
+    seeds = labels[:, ::interval, ::interval, ::interval]
+    seed_labels, first_index = np.unique(seeds.ravel(), return_index=True)
+    first_seed = np.full(count, -1, np.int64)
+    first_seed[seed_labels[seed_labels > 0] - 1] = first_index[seed_labels > 0] + t0 * int(np.prod(seeds.shape[1:]))
+
+    stats = {
+        'count': counts,
+        'bounds': bounds,
+        'seed': first_seed
+    }
+    return labels, stats
+
+
+# 磁盘上的memmap只传递文件信息，由子进程自己映射，避免在进程间复制数据；其他数组返回None
+def memmap_spec(array):
+    if isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap) and array.flags.c_contiguous:
+        return array.filename, array.dtype.str, array.shape, array.offset
+    return None
+
+
+def open_memmap(spec, mode):
+    file_name, dtype, shape, offset = spec
+    return np.memmap(file_name, dtype=dtype, mode=mode, shape=shape, offset=offset)
+
+
+# 子进程中标记一个时间段：source为memmap信息或时间段数据；target为memmap信息时局部标记直接写入其中，否则返回局部标记
+def label_slab_task(source, target, t0, t1, threshold=1e-6, interval=4):
+    if isinstance(source, tuple):
+        block = open_memmap(source, 'r')[t0:t1]
+    else:
+        block = source
+    labels, stats = label_slab(block, t0, threshold, interval)
+    if target is None:
+        return labels, stats
+    out = open_memmap(target, 'r+')
+    out[t0:t1] = labels
+    out.flush()
+    return None, stats
+
+
+# 使用进程池并行标记多个时间段，最多同时处理workers * 2个时间段，结果写入labels和slab_cache
+def label_slabs_parallel(datas, ranges, labels, slab_cache, threshold=1e-6, interval=4, workers=2):
+    source = memmap_spec(datas)
+    target = memmap_spec(labels)
+
+    def collect(t0, t1, future):
+        slab_labels, slab_cache[(t0, t1)] = future.result()
+        if slab_labels is not None:
+            labels[t0:t1] = slab_labels
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for t0, t1 in ranges:
+            block = source if source is not None else np.asarray(datas[t0:t1])
+            pending.append((t0, t1, executor.submit(label_slab_task, block, target, t0, t1, threshold, interval)))
+            if len(pending) > workers * 2:
+                collect(*pending.popleft())
+        while pending:
+            collect(*pending.popleft())
+
+
+# 汇总合并后的连通分量：roots为每个分量所在集合的根(从0开始)，counts、bounds、seeds为每个分量的体素数、4维包围盒和
+# 第一个种子点的全局遍历序号(没有种子点时为-1)；包含种子点的集合按第一个种子点的顺序编号为区域
+# 返回区域列表以及每个根对应的区域编号(不是区域的为0)
+def merge_components(roots, counts, bounds, seeds):
+    size = len(roots)
+    root_counts = np.zeros(size, np.int64)
+    root_bounds = np.zeros((size, 8), np.int64)
+    root_bounds[:, 0::2] = np.iinfo(np.int64).max
+    root_seeds = np.full(size, np.iinfo(np.int64).max)
+    np.add.at(root_counts, roots, counts)
+    for axis in range(4):
+        np.minimum.at(root_bounds[:, axis * 2], roots, bounds[:, axis * 2])
+        np.maximum.at(root_bounds[:, axis * 2 + 1], roots, bounds[:, axis * 2 + 1])
+    has_seed = seeds >= 0
+    np.minimum.at(root_seeds, roots[has_seed], seeds[has_seed])
+
+    seeded = np.nonzero(root_seeds < np.iinfo(np.int64).max)[0]
+    seeded = seeded[np.argsort(root_seeds[seeded])]
+    root_ids = np.zeros(size, np.int32)
+    root_ids[seeded] = np.arange(1, len(seeded) + 1, dtype=np.int32)
+
+    region_group = []
+    for region_id, root in enumerate(seeded, start=1):
         region = Region()
         region.id = region_id
-        region.bounds[0] = size[0]
-        region.bounds[2] = size[1]
-        region.bounds[4] = size[2]
-        region.bounds[6] = size[3]
-
-        while not que.empty():
-            pnt = que.get()
-            if datas[pnt] > th:
-                marks[pnt] = region_id
-                region.count = region.count + 1
-                region.bounds[0] = min(region.bounds[0], pnt[0])
-                region.bounds[1] = max(region.bounds[1], pnt[0])
-                region.bounds[2] = min(region.bounds[2], pnt[1])
-                region.bounds[3] = max(region.bounds[3], pnt[1])
-                region.bounds[4] = min(region.bounds[4], pnt[2])
-                region.bounds[5] = max(region.bounds[5], pnt[2])
-                region.bounds[6] = min(region.bounds[6], pnt[3])
-                region.bounds[7] = max(region.bounds[7], pnt[3])
-            else:
-                continue
-
-            dt = [1, -1, 0,  0, 0,  0, 0,  0]
-            dx = [0,  0, 1, -1, 0,  0, 0,  0]
-            dy = [0,  0, 0,  0, 1, -1, 0,  0]
-            dz = [0,  0, 0,  0, 0,  0, 1, -1]
-            max_t = size[0] - 1
-            max_x = size[1] - 1
-            max_y = size[2] - 1
-            max_z = size[3] - 1
-
-            for ii in range(8):
-                t = pnt[0] + dt[ii]
-                x = pnt[1] + dx[ii]
-                y = pnt[2] + dy[ii]
-                z = pnt[3] + dz[ii]
-
-                if 0 <= t <= max_t and 0 <= x <= max_x and 0 <= y <= max_y and 0 <= z <= max_z and marks[t][x][y][z] == 0:
-                    que.put((t, x, y, z))
-                    marks[t][x][y][z] = -1
-        return region
-
-    # 间隔选取种子点计算区域
-    for h in range(size[0]):
-        for i in range(0, size[1], interval):
-            for j in range(0, size[2], interval):
-                for k in range(0, size[3], interval):
-                    if marks[h][i][j][k] == 0:
-                        region = region_growing3d(len(region_group) + 1, (h, i, j, k))
-                        if region.count > 0:
-                            region_group.append(region)
+        region.count = int(root_counts[root])
+        region.bounds = [int(v) for v in root_bounds[root]]
+        region_group.append(region)
+    return region_group, root_ids
+
+
+# 计算4维连通区域
+# 阈值以上的体素按8邻域进行连通分量标记；只有包含种子点(x, y, z坐标均为interval的倍数)的分量才作为区域，
+# 区域编号按照种子点(h, i, j, k)的遍历顺序依次分配，与逐点区域生长的结果一致
+# datas可以是磁盘上的memmap，此时按slab_size帧一段依次处理，相邻时间段边界上的分量通过并查集合并，
+# marks可传入预先创建的(例如memmap)输出数组
+# labels用于保存各时间段的局部标记(默认直接使用marks)；slab_cache为{(t0, t1): 统计信息}，
+# 其中的时间段认为labels中的局部标记仍然有效，不再重新标记，新标记的时间段会加入slab_cache
+# workers > 1 时各时间段在进程池中并行标记，结果与串行标记完全一致
+def calculate_region3d(datas, threshold=1e-6, interval=4, slab_size=None, marks=None, labels=None, slab_cache=None,
+                       workers=1):
+    size = datas.shape
+    if slab_size is None:
+        slab_size = size[0]
+    if marks is None:
+        marks = np.zeros(size, np.int32)
+    if labels is None:
+        labels = marks
+    if slab_cache is None:
+        slab_cache = {}
+
+    # 第一遍：分段标记，局部标记写入labels
+    missing = [(t0, t1) for t0, t1 in slab_ranges(size[0], slab_size) if (t0, t1) not in slab_cache]
+    if workers > 1 and len(missing) > 1:
+        label_slabs_parallel(datas, missing, labels, slab_cache, threshold, interval, workers)
+    else:
+        for t0, t1 in missing:
+            slab_labels, slab_cache[(t0, t1)] = label_slab(datas[t0:t1], t0, threshold, interval)
+            labels[t0:t1] = slab_labels
+            del slab_labels
+
+    # 相邻时间段边界上同时为前景的标记对加上偏移量后记录下来
+    slab_stats = []
+    offsets = []
+    offset = 0
+    pairs = []
+    for t0, t1 in slab_ranges(size[0], slab_size):
+        stats = slab_cache[(t0, t1)]
+        if t0 > 0:
+            last_frame = np.asarray(labels[t0 - 1])
+            first_frame = np.asarray(labels[t0])
+            joined = (last_frame > 0) & (first_frame > 0)
+            pairs.append(np.unique(np.stack([last_frame[joined] + offsets[-1], first_frame[joined] + offset], axis=1),
+                                   axis=0))
+        slab_stats.append(stats)
+        offsets.append(offset)
+        offset = offset + len(stats['count'])
+
+    # 合并跨时间段的分量，汇总各分量的统计信息
+    union_find = UnionFind(offset + 1)
+    for pair in pairs:
+        for a, b in pair:
+            union_find.union(a, b)
+    roots = union_find.roots()[1:] - 1
+
+    if offset > 0:
+        region_group, root_ids = merge_components(roots, np.concatenate([stats['count'] for stats in slab_stats]),
+                                                  np.concatenate([stats['bounds'] for stats in slab_stats]),
+                                                  np.concatenate([stats['seed'] for stats in slab_stats]))
+    else:
+        region_group, root_ids = [], np.zeros(0, np.int32)
+    lut = np.zeros(offset + 1, np.int32)
+    lut[1:] = root_ids[roots]
+
+    # 第二遍：将局部标记替换为区域编号
+    for (t0, t1), slab_offset, stats in zip(slab_ranges(size[0], slab_size), offsets, slab_stats):
+        slab_lut = np.zeros(len(stats['count']) + 1, np.int32)
+        slab_lut[1:] = lut[slab_offset + 1:slab_offset + len(stats['count']) + 1]
+        marks[t0:t1] = slab_lut[labels[t0:t1]]
+
     return region_group, marks
 
 
-def region_filter(regions, marks, threshold=100):
-    new_regions = []
-    mask = np.zeros(marks.shape, np.uint8)
-    for region in regions:
-        if region.count > threshold and region.bounds[0] == 0 and region.bounds[1] == marks.shape[0] - 1:
-            new_regions.append(region)
-            mask[marks == region.id] = 1
+# 逐帧跟踪区域：每帧单独进行三维连通分量标记，再与上一帧在同一体素上同时为前景的分量连接
+# 一个分量与上一帧的多个分量重叠时这些分量合并为一个区域，一个区域在下一帧分裂为多个分量时各分量仍属于该区域，
+# 因此结果与calculate_region3d的4维连通区域完全一致(包括区域编号)，但只需要保存上一帧的标记和每个分量的统计信息
+# add_frame返回该帧的临时标记(在所有帧中唯一)，由调用者保存；regions汇总到目前为止的区域，并返回临时标记到区域编号的查找表
+# 跟踪器可以保存(joblib)，新数据到来时继续添加帧，之前保存的临时标记仍然有效
+class RegionTracker:
+    def __init__(self, threshold=1e-6, interval=4):
+        self.threshold = threshold
+        self.interval = interval
+        self.frame_count = 0
+        self.union_find = UnionFind(1)
+        self.stats = []
+        self.last = None
+
+    # 添加下一帧(x, y, z)的数据，返回该帧的临时标记(int32，0为背景)
+    def add_frame(self, data) -> np.ndarray:
+        labels, stats = label_slab(np.asarray(data)[np.newaxis], self.frame_count, self.threshold, self.interval)
+        count = len(stats['count'])
+        offset = self.union_find.add(count) - 1
+        if offset + count > np.iinfo(np.int32).max:
+            raise OverflowError('too many components to track: ' + str(offset + count))
+        mark = labels[0]
+        np.add(mark, offset, out=mark, where=mark > 0)
+
+        if self.last is not None:
+            joined = (self.last > 0) & (mark > 0)
+            for a, b in np.unique(np.stack([self.last[joined], mark[joined]], axis=1), axis=0):
+                self.union_find.union(int(a), int(b))
+        self.stats.append(stats)
+        self.last = mark
+        self.frame_count = self.frame_count + 1
+        return mark
+
+    # 到目前为止的区域，以及临时标记到区域编号的查找表(int32)
+    def regions(self):
+        roots = self.union_find.roots()[1:] - 1
+        lut = np.zeros(len(roots) + 1, np.int32)
+        if len(roots) == 0:
+            return [], lut
+        region_group, root_ids = merge_components(roots, np.concatenate([stats['count'] for stats in self.stats]),
+                                                  np.concatenate([stats['bounds'] for stats in self.stats]),
+                                                  np.concatenate([stats['seed'] for stats in self.stats]))
+        lut[1:] = root_ids[roots]
+        return region_group, lut
+
+
+# 能够容纳区域编号0..count的最小整数类型
+def label_dtype(count: int) -> np.dtype:
+    for dtype in (np.uint8, np.uint16):
+        if count <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int32)
+
+
+# 计算区域过滤的查找表：保留体素数量足够、且在所有帧中都存在的区域，按原来的顺序重新编号为1..N，其余标记映射为0
+# 各区域的体素数和时间范围使用标记时汇总的统计信息，不再遍历标记；返回重新编号后的区域和查找表
+def filter_lut(regions, frame_count: int, threshold=100):
+    ids = np.array([region.id for region in regions], np.int64)
+    counts = np.array([region.count for region in regions], np.int64)
+    spans = np.array([region.bounds[:2] for region in regions], np.int64).reshape(-1, 2)
+    keep = (counts > threshold) & (spans[:, 0] == 0) & (spans[:, 1] == frame_count - 1)
+
+    new_ids = np.arange(1, np.count_nonzero(keep) + 1)
+    lut = np.zeros(ids.max(initial=0) + 1, label_dtype(len(new_ids)))
+    lut[ids[keep]] = new_ids
+    new_regions = [regions[i] for i in np.flatnonzero(keep)]
+    for region, new_id in zip(new_regions, new_ids):
+        region.id = int(new_id)
+    return new_regions, lut
+
+
+# 通过查找表一次替换所有标记，结果写入out(默认为marks本身)；marks可以是磁盘上的memmap，此时按slab_size帧一段依次处理
+def remap_marks(marks, lut: np.ndarray, out=None, slab_size=None):
+    if out is None:
+        out = marks
+    if slab_size is None:
+        slab_size = marks.shape[0]
+    for t0 in range(0, marks.shape[0], slab_size):
+        t1 = min(t0 + slab_size, marks.shape[0])
+        out[t0:t1] = lut[marks[t0:t1]]
+    return out
+
+
+# 过滤区域并将保留的区域重新编号为1..N，见filter_lut；标记原地替换，保持marks的类型
+def region_filter(regions, marks, threshold=100, slab_size=None):
+    new_regions, lut = filter_lut(regions, marks.shape[0], threshold)
+    return new_regions, remap_marks(marks, lut, slab_size=slab_size)
+
+
+# 统计一帧中每个区域的体素数、紧致边界、质心、imaging最大值和平均值，mark为该帧的区域标记
+def frame_region_table(frame_id, mark, data):
+    voxels = np.flatnonzero(mark)
+    if voxels.size == 0:
+        return np.zeros(0, REGION_TABLE_DTYPE)
+    ids = mark.ravel()[voxels]
+    values = np.asarray(data).ravel()[voxels]
+    size = int(ids.max()) + 1
+    counts = np.bincount(ids, minlength=size)
+    present = np.flatnonzero(counts)
+
+    table = np.zeros(len(present), REGION_TABLE_DTYPE)
+    table['frame'] = frame_id
+    table['region'] = present
+    table['count'] = counts[present]
+    objects = ndimage.find_objects(mark)
+    for i, region in enumerate(present):
+        table['bounds'][i] = [v for sl in objects[region - 1] for v in (sl.start, sl.stop - 1)]
+    coords = np.unravel_index(voxels, mark.shape)
+    for axis in range(3):
+        table['centroid'][:, axis] = np.bincount(ids, coords[axis], size)[present] / counts[present]
+    table['max'] = ndimage.maximum(values, ids, present)
+    table['mean'] = np.bincount(ids, values, size)[present] / counts[present]
+    table['top'] = table['bounds'][:, 5]
+    return table
 
-    marks[mask == 0] = 0
-    return new_regions, marks
 
+# 逐帧统计区域，得到按帧编号、区域编号排序的区域统计表
+def region_table(datas, marks):
+    tables = [frame_region_table(t, marks[t], datas[t]) for t in range(marks.shape[0])]
+    return np.concatenate(tables) if tables else np.zeros(0, REGION_TABLE_DTYPE)
@@ -0,0 +1,35 @@
+import numpy as np
+
+from common.method import log_codec, log_ceiling, min_log_step, encode_log, decode_log, decode_intensity, LOG_FLOOR
+
+
+# 编码范围内的强度解码后log10误差不超过给定误差，不大于floor的值编码为0、解码为0
+def test_log_round_trip():
+    rng = np.random.default_rng(0)
+    error = 0.001
+    codec = log_codec(error)
+    data = 10 ** rng.uniform(-8, 2, 10000)
+    codes = encode_log(data, codec)
+    assert codes.dtype == np.uint16
+    np.testing.assert_array_less(np.abs(decode_log(codes, codec) - np.log10(data)), error + 1e-5)
+    np.testing.assert_allclose(np.log10(decode_intensity(codes, codec)), np.log10(data), rtol=0, atol=error + 1e-9)
+
+    low = np.array([0.0, LOG_FLOOR / 10, LOG_FLOOR])
+    assert np.all(encode_log(low, codec) == 0)
+    assert np.all(decode_intensity(encode_log(low, codec), codec) == 0)
+
+
+# 不超过log_ceiling的值仍满足误差要求；min_log_step给出的步长能够覆盖最大值
+def test_log_ceiling():
+    error = 1e-5
+    codec = log_codec(error)
+    ceiling = log_ceiling(codec)
+    inside = np.array([10 ** (ceiling - 1e-3)])
+    assert abs(decode_log(encode_log(inside, codec), codec)[0] - np.log10(inside[0])) <= error + 1e-4
+
+    max_value = 1e3
+    assert np.log10(max_value) > ceiling
+    wide = log_codec(min_log_step(max_value) / 2)
+    assert log_ceiling(wide) >= np.log10(max_value)
+    codes = encode_log(np.array([max_value]), wide)
+    assert abs(np.log10(decode_intensity(codes, wide)[0]) - np.log10(max_value)) <= min_log_step(max_value) / 2 + 1e-9
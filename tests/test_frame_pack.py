@@ -0,0 +1,103 @@
+import os
+
+import numpy as np
+
+from common.entity import DataFrame, UniformGrid, GRID_KEYS
+from common.frame_pack import PackWriter, PackReader
+from common.bricks import brick_frame, densify_frame
+from common.method import log_codec, encode_grid
+
+
+def make_grid(data, dim=3):
+    grid = UniformGrid()
+    grid.data = data
+    grid.bounds = np.array([0.0, 1.0, -2.0, 2.0, 0.5, 3.0])
+    grid.spacing = [0.25, 0.5, 0.125]
+    grid.dim = dim
+    return grid
+
+
+# imaging中只有少数非零的团块，便于分块存储
+def make_frame(frame_id, seed):
+    rng = np.random.default_rng(seed)
+    imaging = np.zeros((20, 17, 12))
+    imaging[2:7, 3:9, 1:5] = rng.random((5, 6, 4)) + 1e-3
+    frame = DataFrame()
+    frame.id = frame_id
+    frame.time_str = '20191024T' + format(frame_id, '04d')
+    frame.imaging = make_grid(imaging)
+    frame.doppler = make_grid(rng.random((4, 5, 6)).astype(np.float32))
+    frame.diffuse = make_grid(rng.random((8, 9)), dim=2)
+    return frame
+
+
+def assert_same_frame(frame, expected):
+    assert frame.time_str == expected.time_str
+    for key in GRID_KEYS:
+        grid, expected_grid = getattr(frame, key), getattr(expected, key)
+        np.testing.assert_array_equal(grid.data, expected_grid.data)
+        assert grid.data.dtype == expected_grid.data.dtype
+        np.testing.assert_array_equal(grid.bounds, expected_grid.bounds)
+        assert list(grid.spacing) == list(expected_grid.spacing)
+        assert grid.dim == expected_grid.dim
+        assert grid.codec == expected_grid.codec
+
+
+# 数据帧按任意顺序写入，读取时按编号得到相同的网格
+def test_pack_round_trip(tmp_path):
+    file_path = str(tmp_path / 'frames.pack')
+    frames = [make_frame(i, i) for i in range(4)]
+    with PackWriter(file_path) as pack:
+        for frame in reversed(frames):
+            pack.write_frame(frame)
+    reader = PackReader(file_path)
+    assert len(reader) == len(frames)
+    assert reader.time_strs() == [frame.time_str for frame in frames]
+    for frame in frames:
+        assert_same_frame(reader.read_frame(frame.id), frame)
+
+
+# 量化编码和分块存储的imaging读取并转换为普通网格后与写入前一致
+def test_pack_bricks_round_trip(tmp_path):
+    file_path = str(tmp_path / 'frames.pack')
+    frames = []
+    for i in range(3):
+        frame = make_frame(i, i)
+        frame.imaging = encode_grid(frame.imaging, log_codec(0.001))
+        frames.append(frame)
+    with PackWriter(file_path) as pack:
+        for frame in frames:
+            pack.write_frame(brick_frame(frame, 8))
+    reader = PackReader(file_path)
+    for frame in frames:
+        assert_same_frame(densify_frame(reader.read_frame(frame.id)), frame)
+
+
+# 追加写入时保留的数据帧不变；不再使用的字节过多时压缩文件，压缩后不留临时文件
+def test_pack_keep_and_compact(tmp_path):
+    file_path = str(tmp_path / 'frames.pack')
+    frames = [make_frame(i, i) for i in range(6)]
+    with PackWriter(file_path) as pack:
+        for frame in frames:
+            pack.write_frame(frame)
+
+    replaced = make_frame(5, 100)
+    with PackWriter(file_path, keep_ids=range(5)) as pack:
+        assert pack.temp_path is None
+        pack.write_frame(replaced)
+    reader = PackReader(file_path)
+    for frame in frames[:5] + [replaced]:
+        assert_same_frame(reader.read_frame(frame.id), frame)
+    del reader
+
+    size = os.path.getsize(file_path)
+    rewritten = [make_frame(i, 200 + i) for i in range(2, 6)]
+    with PackWriter(file_path, keep_ids=[0, 1]) as pack:
+        assert pack.temp_path is not None
+        for frame in rewritten:
+            pack.write_frame(frame)
+    assert os.path.getsize(file_path) < size
+    assert not os.path.exists(file_path + '.tmp')
+    reader = PackReader(file_path)
+    for frame in frames[:2] + rewritten:
+        assert_same_frame(reader.read_frame(frame.id), frame)
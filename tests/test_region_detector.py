@@ -0,0 +1,59 @@
+import numpy as np
+from scipy import ndimage
+
+from preprocessing import region_detector
+
+
+# 平滑后的随机数据，阈值以上的体素形成若干在时间上分裂、合并的团块
+def make_datas(shape=(9, 14, 12, 10), seed=0):
+    rng = np.random.default_rng(seed)
+    datas = ndimage.gaussian_filter(rng.random(shape), (0.6, 1.2, 1.2, 1.2))
+    return np.maximum(datas - np.quantile(datas, 0.9), 0)
+
+
+def region_summary(regions):
+    return [(region.id, region.count, region.bounds) for region in regions]
+
+
+# 只划分为一个时间段时，区域为完整4维标记中包含种子点的分量，每个分量对应一个区域编号
+def test_single_slab_matches_full_label():
+    datas = make_datas()
+    regions, marks = region_detector.calculate_region3d(datas)
+    labels, count = ndimage.label(datas > 1e-6, structure=region_detector.STRUCTURE4D)
+    assert count > 1 and len(regions) > 1
+
+    seeded = np.unique(labels[:, ::4, ::4, ::4])
+    seeded = seeded[seeded > 0]
+    region_ids = set()
+    for label in range(1, count + 1):
+        ids = np.unique(marks[labels == label])
+        assert len(ids) == 1
+        assert (ids[0] > 0) == (label in seeded)
+        if ids[0] > 0:
+            assert ids[0] not in region_ids
+            region_ids.add(ids[0])
+    assert np.all(marks[labels == 0] == 0)
+    assert region_ids == set(range(1, len(regions) + 1))
+    assert [region.count for region in regions] == [int(np.sum(marks == i)) for i in range(1, len(regions) + 1)]
+
+
+# 分时间段标记后由并查集合并，结果(包括区域编号)与不分段完全一致
+def test_slabs_match_single_slab():
+    datas = make_datas()
+    regions, marks = region_detector.calculate_region3d(datas)
+    assert any(region.bounds[1] > region.bounds[0] for region in regions)
+    for slab_size in (1, 2, 4):
+        slab_regions, slab_marks = region_detector.calculate_region3d(datas, slab_size=slab_size)
+        assert region_summary(slab_regions) == region_summary(regions)
+        np.testing.assert_array_equal(slab_marks, marks)
+
+
+# 逐帧跟踪得到的临时标记经查找表映射后与4维标记完全一致
+def test_tracker_matches_single_slab():
+    datas = make_datas()
+    regions, marks = region_detector.calculate_region3d(datas)
+    tracker = region_detector.RegionTracker()
+    tracks = np.stack([tracker.add_frame(data) for data in datas])
+    tracked_regions, lut = tracker.regions()
+    assert region_summary(tracked_regions) == region_summary(regions)
+    np.testing.assert_array_equal(lut[tracks], marks)
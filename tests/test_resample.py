@@ -0,0 +1,42 @@
+import numpy as np
+from scipy.interpolate import interpn
+
+from common.resample import resample_linear, sample_linear
+
+
+def interpn_grid(data, target_size):
+    axes = [np.arange(n) for n in data.shape]
+    targets = [np.linspace(0, n - 1, m) for n, m in zip(data.shape, target_size)]
+    points = np.stack(np.meshgrid(*targets, indexing='ij'), axis=-1)
+    return interpn(axes, data, points)
+
+
+# 放大、缩小以及尺寸不变的维度都与interpn的线性插值一致
+def test_resample_linear_matches_interpn():
+    rng = np.random.default_rng(0)
+    data = rng.random((5, 7, 6))
+    for target_size in [(9, 4, 11), (5, 7, 6), (2, 13, 6), (1, 7, 3)]:
+        result = resample_linear(data, target_size)
+        assert result.shape == target_size
+        np.testing.assert_allclose(result, interpn_grid(data, target_size), rtol=0, atol=1e-12)
+
+
+# 指定dtype和out时结果写入out，精度为dtype
+def test_resample_linear_out():
+    rng = np.random.default_rng(1)
+    data = rng.random((6, 5, 4))
+    out = np.empty((3, 8, 4), np.float32)
+    result = resample_linear(data, out.shape, out=out)
+    assert result is out
+    np.testing.assert_allclose(out, interpn_grid(data, out.shape), rtol=0, atol=1e-6)
+
+
+# 任意坐标上的采样与interpn一致，超出范围的坐标取边界值
+def test_sample_linear_matches_interpn():
+    rng = np.random.default_rng(2)
+    data = rng.random((4, 6, 5))
+    positions = [np.array([-1.0, 0.5, 2.25, 3.0]), np.array([0.0, 4.75, 7.0]), np.array([1.5, 3.2])]
+    expected = interpn([np.arange(n) for n in data.shape], data,
+                       np.stack(np.meshgrid(*[np.clip(p, 0, n - 1) for p, n in zip(positions, data.shape)],
+                                            indexing='ij'), axis=-1))
+    np.testing.assert_allclose(sample_linear(data, positions), expected, rtol=0, atol=1e-12)
@@ -0,0 +1,106 @@
+# ============================================================
+# 在后台线程中预读数据帧
+# ============================================================
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from common.entity import DataFrame, GRID_KEYS
+from common.bricks import grid_nbytes
+
+
+# 数据帧中各网格占用的内存(字节)
+def frame_nbytes(frame: DataFrame) -> int:
+    return sum(grid_nbytes(getattr(frame, key)) for key in GRID_KEYS)
+
+
+# 数据帧预读：读取某一帧后，在后台线程中读取其后和其前各radius帧(帧编号循环，与播放时一致)
+# 读取的数据帧保存在按最近使用顺序淘汰的缓存中，缓存总大小不超过memory_budget(MB)，前后切换和播放时直接从内存中取得
+# 预读的帧数同时受内存预算限制，避免预读的帧把当前帧挤出缓存；当前帧改变时取消还没有开始的预读
+# 数据来源不能被多个线程同时读取时(thread_safe不为True，例如InterpFrameSource)，所有读取依次进行
+# 缓存的数据帧会被多次返回，不能被原地修改
+class FramePrefetcher:
+    def __init__(self, source, radius: int = 4, memory_budget: int = 1024, workers: int = 2):
+        self.source = source
+        self.radius = radius
+        self.memory_budget = memory_budget * 1024 * 1024
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.read_lock = None if getattr(source, 'thread_safe', False) else threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+    # 读取数据帧，level为降采样级别(只有PyramidFrameSource支持)，并开始预读前后的帧
+    def read_frame(self, frame_id: int, level: int = 0) -> DataFrame:
+        key = (frame_id, level)
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                self.cache.move_to_end(key)
+            future = self.pending.get(key)
+        if entry is not None:
+            frame, nbytes = entry
+        elif future is not None and not future.cancelled():
+            frame, nbytes = future.result()
+        else:
+            frame, nbytes = self.load(key)
+        self.prefetch(frame_id, level, nbytes)
+        return frame
+
+    # 读取一帧并放入缓存，超出内存预算时淘汰最久未使用的帧
+    def load(self, key: tuple) -> tuple:
+        try:
+            if self.read_lock is None:
+                frame = self.read_source(*key)
+            else:
+                with self.read_lock:
+                    frame = self.read_source(*key)
+            nbytes = frame_nbytes(frame)
+            with self.lock:
+                if key not in self.cache:
+                    self.cache[key] = (frame, nbytes)
+                    self.cache_bytes = self.cache_bytes + nbytes
+                while self.cache_bytes > self.memory_budget and len(self.cache) > 1:
+                    _, (_, evicted) = self.cache.popitem(last=False)
+                    self.cache_bytes = self.cache_bytes - evicted
+            return frame, nbytes
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def read_source(self, frame_id: int, level: int) -> DataFrame:
+        if level == 0:
+            return self.source.read_frame(frame_id)
+        return self.source.read_frame(frame_id, level)
+
+    # 预读frame_id前后的帧，按距离由近到远、先后再前的顺序提交，nbytes为一帧的大小，用于估计缓存能容纳的帧数
+    def prefetch(self, frame_id: int, level: int, nbytes: int):
+        size = len(self.source)
+        count = min(self.radius * 2, self.memory_budget // max(nbytes, 1) - 1)
+        keys = []
+        for step in range(1, self.radius + 1):
+            for offset in (step, -step):
+                key = ((frame_id + offset) % size, level)
+                if len(keys) < count and key != (frame_id, level) and key not in keys:
+                    keys.append(key)
+        with self.lock:
+            for key, future in list(self.pending.items()):
+                if key not in keys and future.cancel():
+                    del self.pending[key]
+            for key in keys:
+                if key not in self.cache and key not in self.pending:
+                    self.pending[key] = self.executor.submit(self.load, key)
+
+    # 取消所有预读并清空缓存，例如切换到其他文件组时
+    def clear(self):
+        with self.lock:
+            for key, future in list(self.pending.items()):
+                if future.cancel():
+                    del self.pending[key]
+            self.cache.clear()
+            self.cache_bytes = 0
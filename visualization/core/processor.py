@@ -6,9 +6,9 @@ import numpy as np
 import queue
 import vtk
 from vtkmodules.util import numpy_support
-from scipy.optimize import curve_fit
 
 from common.entity import DataFrame, UniformGrid
+from common.method import cut_uniform, calculate_bounds
 
 
 # ------------------------------------------------------------
@@ -53,59 +53,7 @@ def to_vtk_image3d(grid):
 # 进行数据裁剪
 # ------------------------------------------------------------
 
-# 计算公共边界
-def calculate_bounds(frame: DataFrame) -> list:
-    image = frame.imaging
-    doppler = frame.doppler
-    diffuse = frame.diffuse
-
-    bounds_2d = []
-    bounds_3d = []
-    if image.dim == 3:
-        bounds_2d.append(image.bounds[:4])
-        bounds_3d.append(image.bounds[4:])
-    if doppler.dim == 3:
-        bounds_2d.append(doppler.bounds[:4])
-        bounds_3d.append(doppler.bounds[4:])
-    if diffuse.dim == 2:
-        bounds_2d.append(diffuse.bounds[:4])
-    arr2d = np.array(bounds_2d)
-    arr3d = np.array(bounds_3d)
-    return [max(arr2d[:, 0]), min(arr2d[:, 1]), max(arr2d[:, 2]), min(arr2d[:, 3]), max(arr3d[:, 0]), min(arr3d[:, 1])]
-
-
-# 对均匀网格数据进行裁剪
-def cut_uniform(old_data: UniformGrid, new_bounds: list) -> UniformGrid:
-    new_data = old_data.copy()
-    old_bounds = old_data.bounds
-    spacing = old_data.spacing
-    dim = old_data.dim
-    size = new_data.data.shape
-
-    delta = []
-    for i in range(dim*2):
-        delta.append(int((abs(new_bounds[i] - old_bounds[i])) / spacing[int(i / 2)]))
-
-    new_data.bounds = new_bounds
-    if dim == 2:
-        new_data.data = new_data.data[delta[0]:size[0]-delta[1], delta[2]:size[1]-delta[3]]
-    elif dim == 3:
-        new_data.data = new_data.data[delta[0]:size[0]-delta[1], delta[2]:size[1]-delta[3], delta[4]:size[2]-delta[5]]
-    return new_data
-
-
-# 对所有声纳数据进行裁剪
-def cut_all(sonar_data, bounds):
-    cut_all_data = []
-    if sonar_data.imaging.dim == 3:
-        cut_all_data.image = cut_uniform(sonar_data.imaging, bounds)
-    if sonar_data.doppler.dim == 3:
-        cut_all_data.doppler = cut_uniform(sonar_data.doppler, bounds)
-    if sonar_data.bathy.dim == 2:
-        cut_all_data.bathy = cut_uniform(sonar_data.bathy, bounds)
-    if sonar_data.diffuse.dim == 2:
-        cut_all_data.diffuse = cut_uniform(sonar_data.diffuse, bounds)
-    return cut_all_data
+# 计算公共边界(calculate_bounds)和裁剪所有网格(cut_all)见common.method
 
 
 # ------------------------------------------------------------
@@ -200,55 +148,3 @@ def calculate_region(data, threshold=1e-6, interval=4):
 #         points.append((local_points[0] * spacing[0] + bounds[0], local_points[1] * spacing[1] + bounds[2],
 #                        local_points[2] * spacing[2] + bounds[4]))
 #     return points
-
-
-def calculate_centerline_points(region_grid: UniformGrid, interval=1):
-    bounds = region_grid.bounds
-    spacing = region_grid.spacing
-    points = []
-    for z in range(0, region_grid.data.shape[2], interval):
-        plane_data = region_grid.data[:, :, z]
-        max_v = np.max(plane_data)
-        if max_v > 1e-9:
-            max_points = np.where(plane_data == max_v)
-            points.append((max_points[0][0] * spacing[0] + bounds[0], max_points[1][0] * spacing[1] + bounds[2],
-                        z * spacing[2] + bounds[4]))
-    return points
-
-
-# 多项式函数曲线拟合
-def poly_curve_fit(points):
-    points_array = np.array(points)
-    x = points_array[:, 0]
-    y = points_array[:, 1]
-    z = points_array[:, 2]
-
-    def curve_func(t, a0, a1, a2):
-        return a0 + a1 * t + a2 * t ** 2
-
-    p0 = [1, 1, 1]
-    params_x, pcov_x = curve_fit(curve_func, z, x, p0)
-    params_y, pcov_x = curve_fit(curve_func, z, y, p0)
-
-    xx = curve_func(z, *params_x)
-    yy = curve_func(z, *params_y)
-
-    new_points = []
-    for i in range(len(points)):
-        new_points.append((xx[i], yy[i], z[i]))
-
-    return new_points, [params_x, params_y]
-
-
-# 计算曲率
-def calculate_curvature(points, params):
-    K = []
-    for p in points:
-        (x, y, z) = p
-        x1 = 2*params[0][0]*z + params[0][1]
-        x2 = 2*params[0][0]
-        y1 = 2*params[1][0]*z + params[1][1]
-        y2 = 2*params[1][0]
-        k = abs(x1*y2 - x2*y1)/np.sqrt(x1**2 + y1**2)
-        K.append(k)
-    return K
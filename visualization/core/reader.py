@@ -2,10 +2,15 @@
 # 从预处理后的文件中读取数据
 # ============================================================
 
+import os
 import joblib
+import numpy as np
 import json
 
-from common.entity import DataFrame, UniformGrid
+from common.entity import UniformGrid
+from common.method import decode_log, decode_intensity
+from common.frame_source import read_frame, JoblibFrameSource, PackFrameSource, InterpFrameSource, \
+    PyramidFrameSource, level_dir, frame_source, decode_imaging
 
 
 def read_index(file_path: str):
@@ -16,12 +21,69 @@ def read_index(file_path: str):
         return frame_files, region_file
 
 
-def read_frame(file_path: str) -> DataFrame:
+# 根据index文件打开数据集，返回帧文件名列表、区域文件名、数据帧来源和index文件的内容
+# index中的区域统计表(region_table)、中心线文件(centerline_file)和doppler产品文件(doppler_files)在旧数据集中可能不存在
+# 数据集包含降采样数据帧(pyramid_levels)时返回PyramidFrameSource，可通过read_frame(frame_id, level)读取指定级别
+def open_frames(file_path: str):
+    file_dir = os.path.dirname(file_path)
     with open(file_path, 'rb') as file:
-        data_file = joblib.load(file)
-        return data_file
+        index_file = joblib.load(file)
+    frame_files = index_file['frame_files']
+    sources = [frame_source(file_dir, frame_files, index_file.get('frame_pack'), index_file.get('keyframe_files'),
+                            index_file.get('frame_schedule'), level)
+               for level in range(index_file.get('pyramid_levels', 0) + 1)]
+    source = sources[0] if len(sources) == 1 else PyramidFrameSource(sources)
+    return frame_files, index_file['region_file'], source, index_file
+
+
+# 区域统计表中某一帧的所有记录
+def frame_regions(table: np.ndarray, frame_id: int) -> np.ndarray:
+    begin, end = np.searchsorted(table['frame'], [frame_id, frame_id + 1])
+    return table[begin:end]
+
+
+# 区域统计表中某一帧某个区域的记录，区域不在该帧中时返回None
+def find_region(table: np.ndarray, frame_id: int, region_id: int):
+    rows = frame_regions(table, frame_id)
+    i = np.searchsorted(rows['region'], region_id)
+    if i < len(rows) and rows['region'][i] == region_id:
+        return rows[i]
+    return None
+
+
+# 某一帧中与裁剪范围相交的区域记录，bounds为[min_x, max_x, min_y, max_y, min_z, max_z]，grid为该帧的imaging网格
+def regions_in_bounds(table: np.ndarray, frame_id: int, bounds: list, grid: UniformGrid) -> np.ndarray:
+    rows = frame_regions(table, frame_id)
+    inside = np.ones(len(rows), bool)
+    for axis in range(3):
+        lower = rows['bounds'][:, axis * 2] * grid.spacing[axis] + grid.bounds[axis * 2]
+        upper = rows['bounds'][:, axis * 2 + 1] * grid.spacing[axis] + grid.bounds[axis * 2]
+        inside &= (lower <= bounds[axis * 2 + 1]) & (upper >= bounds[axis * 2])
+    return rows[inside]
+
+
+# imaging网格的log10强度，小于floor的值取floor，返回新的网格；量化存储时由编码直接线性解码，不再计算log10
+def log_imaging(grid: UniformGrid, floor: float) -> UniformGrid:
+    log_grid = UniformGrid()
+    if grid.codec is None:
+        log_grid.data = np.log10(np.maximum(grid.data, floor))
+    else:
+        log_grid.data = np.maximum(decode_log(grid.data, grid.codec), np.float32(np.log10(floor)))
+    log_grid.bounds = grid.bounds
+    log_grid.spacing = grid.spacing
+    log_grid.dim = grid.dim
+    return log_grid
 
 
+# imaging网格强度的最小值和最大值
+def imaging_range(grid: UniformGrid) -> tuple:
+    min_value, max_value = np.min(grid.data), np.max(grid.data)
+    if grid.codec is not None:
+        min_value, max_value = decode_intensity(np.array([min_value, max_value]), grid.codec)
+    return float(min_value), float(max_value)
+
+
+# 读取区域文件，marks为压缩存储的CompactLabels(旧数据集为四维数组)，都可以按帧编号索引得到一帧的标记
 def read_regions(file_path: str):
     with open(file_path, 'rb') as file:
         regions_file = joblib.load(file)
@@ -29,6 +91,18 @@ def read_regions(file_path: str):
         marks = regions_file['marks']
         return regions, marks
 
+# 读取预先计算的中心线 {(帧编号, 区域编号): {'points', 'params', 'curvature'}}
+def read_centerlines(file_path: str) -> dict:
+    with open(file_path, 'rb') as file:
+        return joblib.load(file)['centerlines']
+
+
+# 读取一帧预先计算的doppler产品 {区域编号: {'bounds', 'spacing', 'center_points', 'velocity', 'heat_flux', 'H0'}}
+def read_doppler_products(file_path: str) -> dict:
+    with open(file_path, 'rb') as file:
+        return joblib.load(file)
+
+
 def read_seabed(file_path: str) -> UniformGrid:
     with open(file_path, 'rb') as file:
         fdata = joblib.load(file)
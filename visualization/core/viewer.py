@@ -11,6 +11,8 @@ import math
 from vtkmodules.qt.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
 
 from common.entity import UniformGrid, DataFrame
+from common import method
+from common.doppler import doppler_bounds_cut
 from visualization.core import doppler_processor, processor, reader
 from visualization.gui.signal_group import signals
 
@@ -84,6 +86,9 @@ class Viewer:
     # ------------------------------------------------------------
     regions = []
     marks = np.ndarray
+    region_table = None
+    centerlines = None
+    doppler_products = None
     frame = DataFrame()
     bounds = []
 
@@ -343,37 +348,55 @@ class Viewer:
             self.remove_velocity_streamline(region_id)
 
 
-    # 计算region区域
-    def imaging_bounds_cut(self, region_id):
+    # region的体素边界，有区域统计表时使用区域在当前帧中的紧致边界
+    def region_voxel_bounds(self, region_id):
         region_bounds = [0, 0, 0, 0, 0, 0]
         for region in self.regions:
             if region.id == region_id:
                 region_bounds = region.bounds[2:]
                 break
-        spacing = self.frame.imaging.spacing
-        for i in range(len(region_bounds)):
-            region_bounds[i] = region_bounds[i] * spacing[int(i/2)] + self.frame.imaging.bounds[int(i/2) * 2]
-        region_bounds[0] = max(region_bounds[0], self.bounds[0])
-        region_bounds[1] = min(region_bounds[1], self.bounds[1])
-        region_bounds[2] = max(region_bounds[2], self.bounds[2])
-        region_bounds[3] = min(region_bounds[3], self.bounds[3])
-        region_bounds[4] = max(region_bounds[4], self.bounds[4])
-        region_bounds[5] = min(region_bounds[5], self.bounds[5])
-        region_grid = processor.cut_uniform(self.frame.imaging, region_bounds)
-        mark_grid = self.frame.imaging.copy()
-        mark_grid.data = self.marks[self.frame.id]
-        region_marks = processor.cut_uniform(mark_grid, region_bounds).data
-        region_grid.data[region_marks != region_id] = 1e-9
-        return region_grid
+        if self.region_table is not None:
+            row = reader.find_region(self.region_table, self.frame.id, region_id)
+            if row is not None:
+                region_bounds = [int(v) for v in row['bounds']]
+        return region_bounds
+
+    # 计算region区域，decode为False时量化存储的imaging保持编码，不解码为强度
+    def imaging_bounds_cut(self, region_id, decode=True):
+        region_grid = method.region_bounds_cut(self.frame.imaging, self.marks[self.frame.id], region_id,
+                                               self.region_voxel_bounds(region_id), self.bounds)
+        return reader.decode_imaging(region_grid) if decode else region_grid
 
     def doppler_bounds_cut(self, imaging_cut: UniformGrid, doppler: UniformGrid):
-        doppler_cut = imaging_cut.copy()
-        cut_bounds = [0, 0, 0, 0, 0, 0]
+        return doppler_bounds_cut(imaging_cut, doppler)
+
+    # region在当前帧中的边界是否完全位于裁剪范围内，此时预先计算的结果与实时计算的结果一致
+    def region_inside_crop(self, region_id):
+        if self.region_table is None:
+            return False
+        row = reader.find_region(self.region_table, self.frame.id, region_id)
+        if row is None:
+            return False
+        imaging = self.frame.imaging
         for i in range(6):
-            cut_bounds[i] = int((imaging_cut.bounds[i] - doppler.bounds[int(i / 2) * 2]) / imaging_cut.spacing[int(i / 2)])
-        doppler_cut.data = doppler.data[cut_bounds[0]:cut_bounds[1] + 1, cut_bounds[2]:cut_bounds[3] + 1, cut_bounds[4]:cut_bounds[5] + 1]
-        doppler_cut.data[imaging_cut.data <= 1e-9] = 1e-9
-        return doppler_cut
+            value = row['bounds'][i] * imaging.spacing[int(i/2)] + imaging.bounds[int(i/2) * 2]
+            if (i % 2 == 0 and value < self.bounds[i]) or (i % 2 == 1 and value > self.bounds[i]):
+                return False
+        return True
+
+    # 查找构建时预先计算的doppler产品(速度场、热通量场、H0)，不存在或区域被裁剪时返回None
+    def lookup_doppler(self, region_id):
+        if self.doppler_products is None or not self.region_inside_crop(region_id):
+            return None
+        return self.doppler_products.get(region_id)
+
+    # 由预先计算的doppler产品得到doppler裁剪网格(不含数据)
+    def doppler_products_grid(self, products):
+        grid = UniformGrid()
+        grid.bounds = products['bounds'].tolist()
+        grid.spacing = products['spacing'].tolist()
+        grid.dim = 3
+        return grid
 
 
     # ------------------------------------------------------------
@@ -386,9 +409,7 @@ class Viewer:
         strid = str(region_id)
 
         if strid not in self.volume_set:
-            image = self.imaging_bounds_cut(region_id)
-            image.data[image.data < 1e-6] = 1e-6
-            image.data = np.log10(image.data)
+            image = reader.log_imaging(self.imaging_bounds_cut(region_id, decode=False), 1e-6)
             image.data = image.data + 6
 
             # to vtk file
@@ -478,9 +499,8 @@ class Viewer:
     def draw_contour(self, region_id):
         strid = str(region_id)
         if strid not in self.contour_set:
-            region_grid = self.imaging_bounds_cut(region_id)
-            region_grid.data[region_grid.data < 1e-7] = 1e-7
-            region_grid.data = np.log10(region_grid.data) + 6
+            region_grid = reader.log_imaging(self.imaging_bounds_cut(region_id, decode=False), 1e-7)
+            region_grid.data = region_grid.data + 6
             vtk_image = processor.to_vtk_image3d(region_grid)
 
             contour = vtk.vtkContourFilter()
@@ -554,20 +574,26 @@ class Viewer:
     centerline_points = {}
     centerline_curvatures = {}
 
+    # 查找构建时预先计算的中心线，不存在或区域被裁剪时返回None
+    def lookup_centerline(self, region_id):
+        if self.centerlines is None or not self.region_inside_crop(region_id):
+            return None
+        return self.centerlines.get((self.frame.id, region_id))
+
+    # 计算中心线的点和曲率，优先使用预先计算的结果
     def calculate_centerline(self, region_id):
-        region_grid = self.imaging_bounds_cut(region_id)
-        points = processor.calculate_centerline_points(region_grid)
-        curve_points, params = processor.poly_curve_fit(points)
-        return curve_points, params
+        centerline = self.lookup_centerline(region_id)
+        if centerline is None:
+            centerline = method.fit_centerline(self.imaging_bounds_cut(region_id))
+        return centerline['points'].tolist(), centerline['curvature'].tolist()
 
 
     def draw_centerline(self, region_id):
         strid = str(region_id)
         if strid not in self.centerline_set:
-            points, params = self.calculate_centerline(region_id)
+            points, K = self.calculate_centerline(region_id)
 
             vtk_points = vtk.vtkPoints()
-            K = processor.calculate_curvature(points, params)
             scalars = vtk.vtkDoubleArray()
             scalars.SetNumberOfComponents(1)
             line = vtk.vtkCellArray()
@@ -737,8 +763,10 @@ class Viewer:
             vtk_image.GetPointData().SetActiveVectors("G")
             vtk_image.GetPointData().SetActiveScalars("v")
 
-            centerline_points = processor.calculate_centerline_points(region_grid)
-            centerline_points, _ = processor.poly_curve_fit(centerline_points)
+            centerline = self.lookup_centerline(region_id)
+            if centerline is None:
+                centerline = method.fit_centerline(region_grid)
+            centerline_points = centerline['points']
 
             points = vtk.vtkPoints()
             for i in range(len(centerline_points)):
@@ -819,14 +847,20 @@ class Viewer:
     def draw_heat_flux(self, region_id):
         strid = str(region_id)
         if strid not in self.heat_flux_set:
-            imaging_cut = self.imaging_bounds_cut(region_id)
-            doppler_cut = self.doppler_bounds_cut(imaging_cut, self.frame.doppler)
+            products = self.lookup_doppler(region_id)
+            if products is not None:
+                doppler_cut = self.doppler_products_grid(products)
+                H_field = products['heat_flux'].astype(np.float64)
+            else:
+                imaging_cut = self.imaging_bounds_cut(region_id)
+                doppler_cut = self.doppler_bounds_cut(imaging_cut, self.frame.doppler)
 
-            # convert Doppler Data unit from cm to m
-            doppler_cut.data = doppler_cut.data * 0.01
+                # convert Doppler Data unit from cm to m
+                doppler_cut.data = doppler_cut.data * 0.01
 
-            v_field, centerline = doppler_processor.get_velocity_field(imaging_cut, doppler_cut)
-            H, H_field = doppler_processor.get_heat_flux_field(v_field, centerline)
+                v_field, centerline = doppler_processor.get_velocity_field(imaging_cut, doppler_cut,
+                                                                          self.lookup_centerline(region_id))
+                H, H_field = doppler_processor.get_heat_flux_field(v_field, centerline)
 
             H_field = scipy.ndimage.gaussian_filter(H_field, sigma=1.1)
             H_field[H_field <= 0] = 1e-9
@@ -934,10 +968,17 @@ class Viewer:
     def draw_velocity_streamline(self, region_id):
         strid = str(region_id)
         if strid not in self.velocity_streamline_set:
-            imaging_cut = self.imaging_bounds_cut(region_id)
-            doppler_cut = self.doppler_bounds_cut(imaging_cut, self.frame.doppler)
+            products = self.lookup_doppler(region_id)
+            if products is not None:
+                doppler_cut = self.doppler_products_grid(products)
+                v_field = products['velocity'].astype(np.float64)
+                centerline = {'center_points': products['center_points']}
+            else:
+                imaging_cut = self.imaging_bounds_cut(region_id)
+                doppler_cut = self.doppler_bounds_cut(imaging_cut, self.frame.doppler)
 
-            v_field, centerline = doppler_processor.get_velocity_field(imaging_cut, doppler_cut)
+                v_field, centerline = doppler_processor.get_velocity_field(imaging_cut, doppler_cut,
+                                                                          self.lookup_centerline(region_id))
 
             v_value = np.sqrt(np.power(v_field[:,:,:,0], 2) + np.power(v_field[:,:,:,1], 2) + np.power(v_field[:,:,:,2], 2))
 
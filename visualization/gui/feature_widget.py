@@ -10,6 +10,7 @@ from PyQt6.QtWidgets import QScrollArea, QVBoxLayout, QGraphicsDropShadowEffect,
     QTreeWidget
 
 from visualization.core import reader, processor
+from visualization.core.prefetcher import FramePrefetcher
 from visualization.gui.signal_group import signals
 from common.entity import DataFrame
 
@@ -516,8 +517,7 @@ class ContourWidget(FeatureItem):
 
 
     def on_frame_loaded(self, frame: DataFrame, group_index: int, frame_index: int, group_size: int):
-        data = frame.imaging.data
-        self.init_slider_range(data)
+        self.init_slider_range(frame.imaging)
 
 
     def slider_value_changed(self):
@@ -526,9 +526,8 @@ class ContourWidget(FeatureItem):
         self.text_right.setText("{:.6f}".format(true_value))
 
 
-    def init_slider_range(self, data):
-        min_data_value = np.min(data)
-        max_data_value = np.max(data)
+    def init_slider_range(self, imaging):
+        min_data_value, max_data_value = reader.imaging_range(imaging)
         min_value = math.log10(max(1e-6, min_data_value)) + 6
         max_value = math.log10(max(1e-6, max_data_value)) + 6
 
@@ -686,12 +685,18 @@ class FileWidget(QWidget):
             self.file_dir = ''
             self.region_name = ''
             self.file_names = []
+            self.frames = None
+            self.index = {}
 
     # 所有的文件组
     file_groups = []
     group_ptr = -1
     file_ptr = -1
 
+    # 数据帧预读：当前帧前后各预读的帧数，以及缓存数据帧的内存预算(MB)
+    prefetch_radius = 4
+    prefetch_memory = 1024
+
     def __init__(self):
         super().__init__()
 
@@ -745,7 +750,8 @@ class FileWidget(QWidget):
 
         group = self.FileGroup()
         group.file_dir = os.path.dirname(index_file_path)
-        group.file_names, group.region_name = reader.read_index(index_file_path)
+        group.file_names, group.region_name, frames, group.index = reader.open_frames(index_file_path)
+        group.frames = FramePrefetcher(frames, self.prefetch_radius, self.prefetch_memory)
         self.file_groups.append(group)
 
         # 添加到tree
@@ -761,16 +767,31 @@ class FileWidget(QWidget):
 
     # 选择文件并读取
     def file_selected(self, group_ptr: int, file_ptr: int):
+        group = self.file_groups[group_ptr]
         if self.group_ptr != group_ptr:
+            # 释放之前文件组缓存的数据帧
+            if self.group_ptr >= 0:
+                self.file_groups[self.group_ptr].frames.clear()
             # 加载region文件
-            region_file_path = self.file_groups[group_ptr].file_dir + '/' + self.file_groups[group_ptr].region_name
+            region_file_path = group.file_dir + '/' + group.region_name
             regions, marks = reader.read_regions(region_file_path)
             #print(marks.shape)
-            signals.load_region.emit(regions, marks)
-
-        # 读取数据帧文件
-        frame_file_path = self.file_groups[group_ptr].file_dir + '/' + self.file_groups[group_ptr].file_names[file_ptr]
-        frame = reader.read_frame(frame_file_path)
+            signals.load_region.emit(regions, marks, group.index.get('region_table'))
+            # 加载预先计算的中心线
+            centerlines = None
+            if group.index.get('centerline_file') is not None:
+                centerlines = reader.read_centerlines(group.file_dir + '/' + group.index['centerline_file'])
+            signals.load_centerlines.emit(centerlines)
+
+        # 加载该帧预先计算的doppler产品
+        products = None
+        doppler_files = group.index.get('doppler_files')
+        if doppler_files is not None and doppler_files[file_ptr] is not None:
+            products = reader.read_doppler_products(group.file_dir + '/' + doppler_files[file_ptr])
+        signals.load_doppler_products.emit(products)
+
+        # 读取数据帧文件，前后的帧在后台预读
+        frame = group.frames.read_frame(file_ptr)
         self.group_ptr = group_ptr
         self.file_ptr = file_ptr
         signals.load_frame.emit(frame, self.group_ptr, self.file_ptr, len(self.file_groups[self.group_ptr].file_names))
@@ -11,7 +11,7 @@ import time, os
 
 from common.entity import UniformGrid, DataFrame
 from visualization.gui.signal_group import signals
-from visualization.core import processor
+from visualization.core import processor, reader
 
 
 class MinimapCamera(vtk.vtkInteractorStyleTrackballCamera):
@@ -39,6 +39,7 @@ class MinimapCamera(vtk.vtkInteractorStyleTrackballCamera):
 class Minimap(QWidget):
     regions = []
     marks = np.ndarray
+    region_table = None
     mark_slice = np.ndarray
     seafloor = UniformGrid()
     frame = DataFrame()
@@ -153,9 +154,10 @@ class Minimap(QWidget):
         self.renderer.AddActor(self.seafloor_actor)
 
 
-    def load_region(self, regions: list, marks: np.ndarray):
+    def load_region(self, regions: list, marks, region_table):
         self.regions = regions
         self.marks = marks
+        self.region_table = region_table
 
 
     def load_frame(self, frame: DataFrame, group_index: int, frame_index: int, group_size: int):
@@ -175,9 +177,20 @@ class Minimap(QWidget):
 
         mark = self.marks[self.frame_index]
         self.mark_slice = np.max(mark, axis=2)
+
+        # 有区域统计表时只绘制当前帧中存在且与裁剪范围相交的区域，并使用区域在该帧中的紧致边界
+        frame_bounds = {}
+        if self.region_table is not None:
+            xy_bounds = list(self.bounds[:4]) + [-np.inf, np.inf]
+            for row in reader.regions_in_bounds(self.region_table, self.frame_index, xy_bounds, imaging):
+                frame_bounds[int(row['region'])] = [int(v) for v in row['bounds']]
+
         for region in self.regions:
+            if self.region_table is not None and region.id not in frame_bounds:
+                continue
+            voxel_bounds = frame_bounds.get(region.id, region.bounds[2:])
             region_grid = UniformGrid()
-            region_grid.bounds = region.bounds[2:]
+            region_grid.bounds = list(voxel_bounds)
             for i in range(6):
                 region_grid.bounds[i] = region_grid.bounds[i] * imaging.spacing[int(i/2)] + imaging.bounds[int(i/2) * 2]
 
@@ -188,9 +201,9 @@ class Minimap(QWidget):
             region_grid.spacing = imaging.spacing
             region_grid.dim = 3
 
-            region_marks = mark[region.bounds[2]:region.bounds[3], region.bounds[4]:region.bounds[5], region.bounds[6]:region.bounds[7]]
-            region_marks[region_marks != region.id] = 0
-            region_grid.data = region_marks
+            region_marks = mark[voxel_bounds[0]:voxel_bounds[1] + 1, voxel_bounds[2]:voxel_bounds[3] + 1,
+                                voxel_bounds[4]:voxel_bounds[5] + 1]
+            region_grid.data = np.where(region_marks == region.id, region_marks, 0)
 
             vtk_region = processor.to_vtk_image3d(region_grid)
             contour = vtk.vtkContourFilter()
@@ -7,12 +7,18 @@ from common.entity import DataFrame, UniformGrid
 class SignalGroup(QObject):
     # --------------------------------------------------
     # 加载region
-    # params: regions: list, marks: np.ndarray
+    # params: regions: list, marks: CompactLabels(旧数据集为np.ndarray), region_table: np.ndarray(旧数据集为None)
     # --------------------------------------------------
     # 读取region文件后触发
-    load_region = pyqtSignal(list, np.ndarray)
+    load_region = pyqtSignal(list, object, object)
     # 将region数据保存至viewer后触发
-    region_loaded = pyqtSignal(list, np.ndarray)
+    region_loaded = pyqtSignal(list, object)
+    # 读取预先计算的中心线后触发，数据集没有中心线文件时为None
+    # params: centerlines: dict
+    load_centerlines = pyqtSignal(object)
+    # 读取一帧预先计算的doppler产品后触发，在load_frame之前，没有产品时为None
+    # params: products: dict
+    load_doppler_products = pyqtSignal(object)
 
 
     # --------------------------------------------------
@@ -97,6 +97,8 @@ class VTKWidget(QWidget):
         # global slots
         # --------------------------------------------------
         signals.load_region.connect(self.on_region_load)
+        signals.load_centerlines.connect(self.on_centerlines_load)
+        signals.load_doppler_products.connect(self.on_doppler_products_load)
         signals.load_frame.connect(self.on_frame_load)
         signals.frame_rendering.connect(self.on_frame_rendering)
         signals.bounds_changed.connect(self.on_bounds_changed)
@@ -130,11 +132,20 @@ class VTKWidget(QWidget):
     # basic workflow
     # --------------------------------------------------
     # 加载新的区域数据时
-    def on_region_load(self, regions: list, marks: np.ndarray):
+    def on_region_load(self, regions: list, marks, region_table):
         self.viewer.regions = regions
         self.viewer.marks = marks
+        self.viewer.region_table = region_table
         signals.region_loaded.emit(regions, marks)
 
+    # 加载预先计算的中心线时
+    def on_centerlines_load(self, centerlines):
+        self.viewer.centerlines = centerlines
+
+    # 加载一帧预先计算的doppler产品时
+    def on_doppler_products_load(self, products):
+        self.viewer.doppler_products = products
+
     # 每一帧数据加载时
     def on_frame_load(self, frame: DataFrame, group_index: int, frame_index: int, group_size: int):
         self.group_index = group_index